@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the single-pass bitmask histogram against scanning once per bit.
+
+Run with the girder_worker_tasks directory on the python path, e.g.:
+
+    PYTHONPATH=girder_worker_tasks python benchmarks/bitmask_histogram.py
+
+Sizes are in GB of pixel data.
+"""
+
+import argparse
+import time
+
+import numpy
+
+from histogram import histogram
+
+
+def perBitHistogram(array, label):
+    if label:
+        array = array[numpy.nonzero(array)]
+    hist = numpy.zeros(array.dtype.itemsize*8 + 1 - label)
+    if not label:
+        hist[0] = (array == 0).sum()
+    binEdges = numpy.arange(label, hist.shape[0] + label)
+    for i in range(1, hist.shape[0] + label):
+        hist[i - label] = (array & 1 << i - 1 > 0).sum()
+    return hist, binEdges
+
+
+def singlePassHistogram(array, label):
+    return histogram._bitmaskHistogram(lambda: iter([array]), label)
+
+
+def timeCall(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1,2,4',
+                        help='comma-separated array sizes in GB')
+    parser.add_argument('--dtypes', default='uint8,uint16,uint32',
+                        help='comma-separated unsigned integer dtypes')
+    parser.add_argument('--label', action='store_true')
+    args = parser.parse_args()
+
+    print('%-8s %6s %12s %14s %8s' % (
+        'dtype', 'GB', 'per bit (s)', 'one pass (s)', 'speedup'))
+    for dtypeName in args.dtypes.split(','):
+        dtype = numpy.dtype(dtypeName)
+        for size in args.sizes.split(','):
+            count = int(float(size) * 1024 ** 3) // dtype.itemsize
+            # Sparse bitmasks, as in label images: mostly zero, with a few
+            # bits set elsewhere.
+            array = numpy.zeros(count, dtype=dtype)
+            mask = numpy.random.randint(0, 4, count) == 0
+            array[mask] = numpy.random.randint(
+                1, numpy.iinfo(dtype).max, mask.sum(), dtype=dtype)
+            del mask
+            perBitTime, expected = timeCall(
+                perBitHistogram, array, args.label)
+            singlePassTime, result = timeCall(
+                singlePassHistogram, array, args.label)
+            if (expected[0].tolist() != result[0].tolist() or
+                    expected[1].tolist() != result[1].tolist()):
+                raise Exception('Histograms differ for %s %s GB' % (
+                    dtypeName, size))
+            print('%-8s %6s %12.3f %14.3f %7.1fx' % (
+                dtypeName, size, perBitTime, singlePassTime,
+                perBitTime / singlePassTime))
+            del array, expected, result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the exact-count integer histogram path against numpy.histogram.
+
+Run with the girder_worker_tasks directory on the python path, e.g.:
+
+    PYTHONPATH=girder_worker_tasks python benchmarks/integer_histogram.py
+
+Sizes are in GB of pixel data.  Arrays are generated in memory, so the
+largest size needs roughly three times that much free RAM for the numpy
+path's temporary copies.
+"""
+
+import argparse
+import time
+
+import numpy
+
+from histogram import histogram
+
+
+def numpyHistogram(array, label, bins):
+    if label:
+        array = array[numpy.nonzero(array)]
+    if array.dtype == numpy.uint8:
+        bins = numpy.arange(int(array.min()), int(array.max()) + 2)
+    return numpy.histogram(array, bins=bins)
+
+
+def countHistogram(array, label, bins):
+    info = numpy.iinfo(array.dtype)
+    offset = int(info.min)
+    counts = histogram._countIntegers(
+        lambda: iter([array]), label, offset, int(info.max) - offset + 1)
+    return histogram._rebinIntegerCounts(counts, offset, array.dtype, bins)
+
+
+def timeCall(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1,2,4',
+                        help='comma-separated array sizes in GB')
+    parser.add_argument('--dtypes', default='uint8,uint16',
+                        help='comma-separated integer dtypes')
+    parser.add_argument('--bins', type=int, default=256)
+    parser.add_argument('--label', action='store_true')
+    args = parser.parse_args()
+
+    print('%-8s %6s %12s %12s %8s' % (
+        'dtype', 'GB', 'numpy (s)', 'bincount (s)', 'speedup'))
+    for dtypeName in args.dtypes.split(','):
+        dtype = numpy.dtype(dtypeName)
+        info = numpy.iinfo(dtype)
+        for size in args.sizes.split(','):
+            count = int(float(size) * 1024 ** 3) // dtype.itemsize
+            array = numpy.random.randint(
+                int(info.min), int(info.max) + 1, count, dtype=dtype)
+            numpyTime, expected = timeCall(
+                numpyHistogram, array, args.label, args.bins)
+            countTime, result = timeCall(
+                countHistogram, array, args.label, args.bins)
+            if (expected[0].tolist() != result[0].tolist() or
+                    expected[1].tolist() != result[1].tolist()):
+                raise Exception('Histograms differ for %s %s GB' % (
+                    dtypeName, size))
+            print('%-8s %6s %12.3f %12.3f %7.1fx' % (
+                dtypeName, size, numpyTime, countTime,
+                numpyTime / countTime))
+            del array, expected, result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure the throughput and peak memory of histogramming synthetic TIFFs.
+
+Run with the girder_worker_tasks directory on the python path, e.g.:
+
+    PYTHONPATH=girder_worker_tasks python benchmarks/suite.py \
+        --sizes 0.1,1 --output results.json
+
+Images are generated from a fixed seed for each combination of dtype, size
+in GB of pixel data, layout (strips or tiles), and content (random values,
+sparse labels, or sparse bitmasks), and are kept in --directory so that later
+runs read the same files.  Each case runs computeHistogram in a fresh
+process, so that its peak memory is its own.  Tiled and multi-GB images are
+written with tifffile; without it only stripped images that fit in memory
+can be generated, and other cases are reported as skipped.
+
+The results are printed as JSON.  With --baseline, cases that are slower or
+use more memory than the baseline by more than --tolerance are listed as
+regressions and the exit code is 1.  --save-baseline stores the results to
+compare later runs against.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy
+import PIL.Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from histogram import histogram, metrics
+
+
+# Tile and strip size of the generated images.
+TILE_SIZE = 256
+
+# Width of the generated images, unless they are too small for it.
+IMAGE_WIDTH = 8192
+
+# Images with more bytes than this are written as BigTIFF.
+BIGTIFF_SIZE = 2 ** 32 - 2 ** 25
+
+# PIL modes of the dtypes that PIL can write, for when tifffile is missing.
+PIL_MODES = {'uint8': 'L', 'uint16': 'I;16', 'int32': 'I', 'float32': 'F'}
+
+CONTENTS = ('random', 'label', 'bitmask')
+LAYOUTS = ('strips', 'tiles')
+METHODS = ('exact',) + histogram.FLOAT_METHODS
+
+
+def imageShape(size, dtype):
+    """
+    Get the shape of an image with about size GB of pixel data.
+    """
+    pixels = max(1, int(size * 1024 ** 3) // dtype.itemsize)
+    width = IMAGE_WIDTH if pixels >= IMAGE_WIDTH * TILE_SIZE else TILE_SIZE
+    return max(1, pixels // width), width
+
+
+def generateRows(dtype, content, seed, top, height, width):
+    """
+    Generate a band of an image.  Each band of TILE_SIZE rows has its own
+    seed, so that an image is the same however it is written.
+    """
+    state = numpy.random.RandomState([seed, top // TILE_SIZE])
+    shape = (height, width)
+    if content == 'random':
+        if dtype.kind == 'f':
+            return state.standard_normal(shape).astype(dtype)
+        info = numpy.iinfo(dtype)
+        return state.randint(int(info.min), int(info.max) + 1, shape,
+                             dtype=dtype)
+    # Labels and bitmasks are sparse, as in segmentations: mostly zero.
+    array = numpy.zeros(shape, dtype=dtype)
+    mask = state.randint(0, 4, shape) == 0
+    if content == 'label':
+        array[mask] = state.randint(1, 256, int(mask.sum()))
+    else:
+        array[mask] = dtype.type(1) << state.randint(
+            0, dtype.itemsize * 8, int(mask.sum())).astype(dtype)
+    return array
+
+
+def _bands(dtype, content, seed, shape):
+    for top in range(0, shape[0], TILE_SIZE):
+        yield generateRows(dtype, content, seed, top,
+                           min(TILE_SIZE, shape[0] - top), shape[1])
+
+
+def _tiles(bands, shape):
+    for band in bands:
+        padded = numpy.zeros((TILE_SIZE, -(-shape[1] // TILE_SIZE) *
+                              TILE_SIZE), dtype=band.dtype)
+        padded[:band.shape[0], :band.shape[1]] = band
+        for left in range(0, padded.shape[1], TILE_SIZE):
+            yield padded[:, left:left + TILE_SIZE]
+
+
+def writeImage(path, dtype, content, layout, shape, seed):
+    """
+    Write a synthetic TIFF.
+
+    :returns: None, or the reason it could not be written.
+    """
+    bands = _bands(dtype, content, seed, shape)
+    if tifffile is not None:
+        kwargs = {'tile': (TILE_SIZE, TILE_SIZE)} if layout == 'tiles' else {
+            'rowsperstrip': TILE_SIZE}
+        tifffile.imwrite(
+            path, _tiles(bands, shape) if layout == 'tiles' else bands,
+            shape=shape, dtype=dtype,
+            bigtiff=shape[0] * shape[1] * dtype.itemsize >= BIGTIFF_SIZE,
+            **kwargs)
+        return None
+    if layout == 'tiles':
+        return 'tiled images need tifffile'
+    if dtype.name not in PIL_MODES:
+        return 'PIL cannot write %s images without tifffile' % dtype.name
+    if shape[0] * shape[1] * dtype.itemsize >= BIGTIFF_SIZE:
+        return 'images over 4 GB need tifffile'
+    image = PIL.Image.fromarray(numpy.concatenate(list(bands)),
+                                PIL_MODES[dtype.name])
+    image.save(path, tiffinfo={278: TILE_SIZE})
+    return None
+
+
+def runCase(path, label, bins, bitmask, streaming, workers, floatMethod):
+    """
+    Histogram an image, recording the time, chunk metrics, and peak memory.
+    This runs in its own process.
+    """
+    taskMetrics = metrics.TaskMetrics()
+    start = time.perf_counter()
+    with metrics.collecting(taskMetrics):
+        hist = histogram.computeHistogram(
+            path, label, bins, bitmask, streaming, workers, floatMethod)[0]
+    seconds = time.perf_counter() - start
+    result = taskMetrics.result()
+    return {
+        'seconds': seconds,
+        'counted': int(hist.sum()),
+        'phases': result['phases'],
+        'pixelsRead': result['counters'].get('pixelsRead'),
+        # The process only runs this case, so its peak is the case's.
+        'peakRss': result['counters'].get('processPeakRss'),
+        'peakRssIncrease': result['counters'].get('peakRssIncrease'),
+    }
+
+
+def caseKey(case):
+    return '%(dtype)s-%(size)sGB-%(layout)s-%(content)s-%(method)s-' \
+        'w%(workers)d-%(reading)s' % case
+
+
+def runCases(args):
+    directory = args.directory or tempfile.mkdtemp(prefix='histogram-bench-')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for dtypeName in args.dtypes.split(','):
+        dtype = numpy.dtype(dtypeName)
+        for size in args.sizes.split(','):
+            shape = imageShape(float(size), dtype)
+            for layout in args.layouts.split(','):
+                for content in args.contents.split(','):
+                    if content == 'bitmask' and dtype.kind != 'u':
+                        continue
+                    path = os.path.join(directory, '%s-%s-%s-%s.tiff' % (
+                        dtypeName, size, layout, content))
+                    skipped = None
+                    if not os.path.exists(path):
+                        skipped = writeImage(path, dtype, content, layout,
+                                             shape, args.seed)
+                    results.extend(imageCases(
+                        args, context, path, skipped, {
+                            'dtype': dtypeName, 'size': size,
+                            'layout': layout, 'content': content,
+                            'shape': list(shape)}))
+    return results
+
+
+def imageCases(args, context, path, skipped, image):
+    dtype = numpy.dtype(image['dtype'])
+    results = []
+    for method in args.methods.split(','):
+        # Single-pass methods only differ for floats and wide integers.
+        if method != 'exact' and histogram._isSmallInteger(dtype):
+            continue
+        for workers in [int(value) for value in args.workers.split(',')]:
+            for streaming in args.streaming:
+                case = dict(image, method=method, workers=workers,
+                            reading='streaming' if streaming else 'whole')
+                case['key'] = caseKey(case)
+                if skipped:
+                    case['skipped'] = skipped
+                    results.append(case)
+                    continue
+                runs = []
+                for _ in range(args.repeat):
+                    with concurrent.futures.ProcessPoolExecutor(
+                            1, mp_context=context) as executor:
+                        runs.append(executor.submit(
+                            runCase, path, image['content'] == 'label',
+                            args.bins, image['content'] == 'bitmask',
+                            streaming, workers,
+                            None if method == 'exact' else method).result())
+                # The fastest run is the least disturbed by other load.
+                case.update(min(runs, key=lambda run: run['seconds']))
+                case['peakRss'] = max(run['peakRss'] or 0 for run in runs)
+                case['pixels'] = image['shape'][0] * image['shape'][1]
+                case['pixelsPerSecond'] = case['pixels'] / case['seconds']
+                results.append(case)
+                print('%-48s %10.3f s %12.0f pixels/s %8.1f MB' % (
+                    case['key'], case['seconds'], case['pixelsPerSecond'],
+                    case['peakRss'] / 1024 ** 2), file=sys.stderr)
+    return results
+
+
+def findRegressions(results, baseline, tolerance):
+    """
+    Compare results to a baseline.
+
+    :returns: a list of the measurements that are worse than the baseline by
+        more than the tolerance.
+    """
+    baselineCases = {case['key']: case for case in baseline['cases']}
+    regressions = []
+    for case in results:
+        previous = baselineCases.get(case['key'])
+        if not previous or 'skipped' in case or 'skipped' in previous:
+            continue
+        for measure, worse in (
+                ('pixelsPerSecond', lambda value, base: (
+                    value < base * (1 - tolerance))),
+                ('peakRss', lambda value, base: (
+                    value > base * (1 + tolerance)))):
+            if previous.get(measure) and worse(case[measure],
+                                               previous[measure]):
+                regressions.append({
+                    'key': case['key'],
+                    'measure': measure,
+                    'baseline': previous[measure],
+                    'value': case[measure],
+                    'change': case[measure] / previous[measure] - 1,
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='0.01,0.1',
+                        help='comma-separated image sizes in GB')
+    parser.add_argument('--dtypes', default='uint8,uint16,int32,float32',
+                        help='comma-separated dtypes')
+    parser.add_argument('--layouts', default=','.join(LAYOUTS),
+                        help='comma-separated layouts: %s' % ', '.join(
+                            LAYOUTS))
+    parser.add_argument('--contents', default=','.join(CONTENTS),
+                        help='comma-separated contents: %s' % ', '.join(
+                            CONTENTS))
+    parser.add_argument('--methods', default=','.join(METHODS),
+                        help='comma-separated methods for float and wide '
+                        'integer images: %s' % ', '.join(METHODS))
+    parser.add_argument('--workers', default='1',
+                        help='comma-separated numbers of threads')
+    parser.add_argument('--streaming', default='false,true',
+                        help='comma-separated values of streaming to run')
+    parser.add_argument('--bins', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each case, of which the fastest is '
+                        'reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory',
+                        help='directory for the generated images, which are '
+                        'reused if they exist')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which a measure may be worse than '
+                        'the baseline')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--save-baseline',
+                        help='file to write the results to as a baseline')
+    args = parser.parse_args()
+    args.streaming = [value.strip().lower() in ('true', '1', 'yes')
+                      for value in args.streaming.split(',')]
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'tifffile': getattr(tifffile, '__version__', None),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'cases': runCases(args),
+    }
+    if args.baseline:
+        with open(args.baseline) as infile:
+            results['regressions'] = findRegressions(
+                results['cases'], json.load(infile), args.tolerance)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as outfile:
+                outfile.write(output + '\n')
+    print(output)
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
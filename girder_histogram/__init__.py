@@ -23,6 +23,7 @@
 
 import datetime
 import json
+import threading
 
 from bson.objectid import ObjectId
 
@@ -32,6 +33,7 @@ from girder.settings import SettingDefault
 from girder.exceptions import ValidationException
 from girder.models.item import Item
 from girder.models.notification import Notification
+from girder.models.setting import Setting
 from girder.utility import setting_utilities
 
 from girder_jobs.constants import JobStatus
@@ -39,7 +41,9 @@ from girder_jobs.models.job import Job
 
 from .constants import PluginSettings
 from .rest import HistogramResource
+from .models.aggregate import HistogramAggregate
 from .models.histogram import Histogram
+from histogram import formats
 from girder.utility.model_importer import ModelImporter
 
 
@@ -53,13 +57,65 @@ def _onRemoveItem(event):
         histogramModel.remove(histogram)
 
 
+def _onRemoveFolder(event):
+    """
+    When a folder is deleted, we delete its cached combined histograms.
+    """
+    HistogramAggregate().removeWithQuery({'folderId': ObjectId(event.info['_id'])})
+
+
 def _onRemoveFile(event):
     """
-    When a histogram file is deleted, we remove the parent histogram.
+    When a histogram file is deleted, we remove the parent histogram.  When a
+    tile counts file is deleted, the histogram no longer has them.
     """
     histogramModel = Histogram()
     for histogram in Histogram().find({'fileId': ObjectId(event.info['_id'])}):
         histogramModel.remove(histogram, keepFile=True)
+    histogramModel.collection.update_many(
+        {'tilesFileId': ObjectId(event.info['_id'])},
+        {'$unset': {'tilesFileId': ''}})
+
+
+def _onSaveFolder(event):
+    """
+    When a folder is saved, its access may have changed, so we give the
+    histograms of its items the same access.
+    """
+    Histogram().updateAccess(event.info)
+
+
+# Ids of the items being saved by each thread that are moving to another
+# folder.
+_movingItems = threading.local()
+
+
+def _onSaveItemBefore(event):
+    """
+    Before an item is saved, note whether it is moving to another folder.
+    Only the item's stored folder is read, so other saves don't query
+    histograms.
+    """
+    item = event.info
+    if '_id' not in item:
+        return
+    stored = Item().collection.find_one({'_id': item['_id']},
+                                        {'folderId': True})
+    if stored and stored.get('folderId') != item.get('folderId'):
+        if not hasattr(_movingItems, 'ids'):
+            _movingItems.ids = set()
+        _movingItems.ids.add(item['_id'])
+
+
+def _onSaveItem(event):
+    """
+    When an item has moved to another folder, its histograms get the access
+    of the new folder.
+    """
+    ids = getattr(_movingItems, 'ids', None)
+    if ids and event.info['_id'] in ids:
+        ids.discard(event.info['_id'])
+        Histogram().updateItemAccess(event.info)
 
 
 def _onUpload(event):
@@ -75,7 +131,10 @@ def _onUpload(event):
           }
         }
 
-    bins, label, and bitmask arguments are optional
+    bins, label, and bitmask arguments are optional.  If the
+    histogram.upload_threads setting is not 0, histograms of uncompressed
+    images in a filesystem assetstore are computed before the upload
+    finishes.
     """
     file_ = event.info['file']
     user = event.info['currentUser']
@@ -99,19 +158,35 @@ def _onUpload(event):
             logger.warning(msg % file_['_id'])
             return
         histograms = list(Histogram().find({'fakeId': fakeId}, limit=2))
-        if len(histograms) == 1:
+        if len(histograms) == 1 and ref.get('tiles'):
+            Histogram().attachTiles(histograms[0], file_)
+        elif len(histograms) == 1:
             histogram = histograms[0]
             del histogram['expected']
-            histogram['fileId'] = file_['_id']
-            Histogram().save(histogram)
+            attached = Histogram().attachFile(histogram, file_)
+            # Batch jobs upload an error file for images that failed.
+            Histogram().updateBatchJobs(
+                attached or histogram, success=attached is not None)
         else:
             msg = 'Failed to retrieve histogram for file %s using fakeId %s.'
             logger.warning(msg % (file_['_id'], fakeId))
             return
     elif isinstance(ref.get('histogram'), dict):
         item = Item().load(file_['itemId'], force=True)
-        Histogram().createHistogram(item, file_, user, token,
-                                    **ref['histogram'])
+        params = {key: value for key, value in ref['histogram'].items()
+                  if key in ('bins', 'label', 'bitmask')}
+        Histogram().createUploadHistogram(item, file_, user=user, token=token,
+                                          **params)
+
+
+def _onFinalizeUpload(event):
+    """
+    When a histogram file has been uploaded, record how long the upload took
+    before the file is attached to its histogram.
+    """
+    upload = event.info.get('upload')
+    if upload:
+        Histogram().recordUpload(upload)
 
 
 def _updateJob(event):
@@ -125,7 +200,8 @@ def _updateJob(event):
         job = event.info
     meta = job.get('meta', {})
     if (meta.get('creator') != 'histogram' or
-            meta.get('task') != 'createHistogram'):
+            meta.get('task') not in ('createHistogram', 'createHistogramBatch',
+                                     'createHistogramVariants')):
         return
     status = job['status']
     if event.name == 'model.job.remove' and status not in (
@@ -133,13 +209,27 @@ def _updateJob(event):
         status = JobStatus.CANCELED
     if status not in (JobStatus.ERROR, JobStatus.CANCELED, JobStatus.SUCCESS):
         return
-    histograms = list(Histogram().find({'fakeId': meta.get('fakeId')}, limit=2))
-    if len(histograms) != 1:
-        msg = 'Failed to retrieve histogram using fakeId %s.'
-        logger.warning(msg % meta.get('fakeId'))
-        return
-    histogram = histograms[0]
-    if histogram.get('expected'):
+    batch = meta.get('task') in ('createHistogramBatch',
+                                 'createHistogramVariants')
+    fakeIds = meta.get('fakeIds', []) if batch else [meta.get('fakeId')]
+    for fakeId in fakeIds:
+        histograms = list(Histogram().find({'fakeId': fakeId}, limit=2))
+        if len(histograms) != 1:
+            msg = 'Failed to retrieve histogram using fakeId %s.'
+            logger.warning(msg % fakeId)
+            continue
+        _finishHistogram(event, job, histograms[0], status, batch)
+
+
+def _finishHistogram(event, job, histogram, status, batch=False):
+    """
+    Update a histogram when the job computing it has ended.
+
+    :param batch: True if the job computed several histograms.  Histograms
+        that were uploaded before a batch job failed are kept.
+    """
+    expected = histogram.get('expected')
+    if expected:
         # We can get a SUCCESS message before we get the upload message, so
         # don't clear the expected status on success.
         if status != JobStatus.SUCCESS:
@@ -155,10 +245,11 @@ def _updateJob(event):
         else:  # ERROR
             msg = 'FAILED: Histogram creation failed'
         msg += ' for item %s' % histogram['itemId']
-        msg += ', file %s' % histogram['fileId']
-    if status == JobStatus.SUCCESS:
+        msg += ', file %s' % histogram.get('fileId')
+    if status == JobStatus.SUCCESS or (batch and not expected):
         Histogram().save(histogram)
     else:
+        Histogram().updateBatchJobs(histogram, success=False)
         Histogram().remove(histogram)
     if msg and event.name != 'model.job.remove':
         Job().updateJob(job, progressMessage=msg)
@@ -168,7 +259,7 @@ def _updateJob(event):
             data={
                 'histogram_id': histogram['_id'],
                 'item_id': histogram['itemId'],
-                'file_id': histogram['fileId'],
+                'file_id': histogram.get('fileId'),
                 'fakeId': histogram['fakeId'],
                 'success': status == JobStatus.SUCCESS,
                 'status': status
@@ -180,6 +271,9 @@ def _updateJob(event):
 
 @setting_utilities.validator({
     PluginSettings.DEFAULT_BINS,
+    PluginSettings.WORKERS,
+    PluginSettings.INLINE_SIZE,
+    PluginSettings.UPLOAD_THREADS,
 })
 def validateNonnegativeInteger(doc):
     val = doc['value']
@@ -193,9 +287,28 @@ def validateNonnegativeInteger(doc):
     doc['value'] = val
 
 
+@setting_utilities.validator(PluginSettings.ACCESS_MIGRATED)
+def validateBoolean(doc):
+    if not isinstance(doc['value'], bool):
+        msg = '%s must be a boolean.' % doc['key']
+        raise ValidationException(msg, 'value')
+
+
+@setting_utilities.validator(PluginSettings.FORMAT)
+def validateFormat(doc):
+    if doc['value'] not in formats.FORMATS:
+        msg = '%s must be one of %s.' % (doc['key'], ', '.join(formats.FORMATS))
+        raise ValidationException(msg, 'value')
+
+
 # Default settings values
 SettingDefault.defaults.update({
     PluginSettings.DEFAULT_BINS: 256,
+    PluginSettings.WORKERS: 1,
+    PluginSettings.FORMAT: 'json',
+    PluginSettings.INLINE_SIZE: 65536,
+    PluginSettings.UPLOAD_THREADS: 0,
+    PluginSettings.ACCESS_MIGRATED: False,
 })
 
 class HistogramPlugin(plugin.GirderPlugin):
@@ -203,11 +316,25 @@ class HistogramPlugin(plugin.GirderPlugin):
     CLIENT_SOURCE_PATH = 'web_client'
     def load(self, info):
         ModelImporter.registerModel('histogram', Histogram, 'histogram')
+        ModelImporter.registerModel('histogram_aggregate', HistogramAggregate,
+                                    'histogram')
         info['apiRoot'].histogram = HistogramResource()
 
         events.bind('model.item.remove', 'Histogram', _onRemoveItem)
         events.bind('model.file.remove', 'Histogram', _onRemoveFile)
+        events.bind('model.folder.remove', 'Histogram', _onRemoveFolder)
+        events.bind('model.folder.save.after', 'Histogram', _onSaveFolder)
+        events.bind('model.item.save', 'Histogram', _onSaveItemBefore)
+        events.bind('model.item.save.after', 'Histogram', _onSaveItem)
+        events.bind('model.file.finalizeUpload.after', 'Histogram',
+                    _onFinalizeUpload)
         events.bind('data.process', 'Histogram', _onUpload)
         events.bind('jobs.job.update.after', 'Histogram', _updateJob)
         events.bind('model.job.save', 'Histogram', _updateJob)
         events.bind('model.job.remove', 'Histogram', _updateJob)
+        # Histograms from before they inherited their items' access are only
+        # visible to admins until they are given it, which is done once.
+        if not Setting().get(PluginSettings.ACCESS_MIGRATED):
+            Histogram().inheritMissingAccess()
+            Setting().set(PluginSettings.ACCESS_MIGRATED, True)
+        Histogram().ensureInFlightIndex()
@@ -25,3 +25,16 @@
 # Settings where plugin information is stored
 class PluginSettings(object):
     DEFAULT_BINS = 'histogram.default_bins'
+    # Number of threads used to compute one histogram; 0 uses every core.
+    WORKERS = 'histogram.workers'
+    # File format of new histograms: 'json' or 'binary'.
+    FORMAT = 'histogram.format'
+    # Histogram files up to this many bytes are also stored in the histogram
+    # document; 0 disables this.
+    INLINE_SIZE = 'histogram.inline_size'
+    # Number of server threads that compute histograms requested on upload
+    # of uncompressed images; 0 leaves them to worker jobs.
+    UPLOAD_THREADS = 'histogram.upload_threads'
+    # True once histograms from before they inherited their items' access
+    # have been given it.
+    ACCESS_MIGRATED = 'histogram.access_migrated'
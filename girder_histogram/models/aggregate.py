@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder plugin framework and tests adapted from Kitware Inc. source and
+#  documentation by the Imaging and Visualization Group, Advanced Biomedical
+#  Computational Science, Frederick National Laboratory for Cancer Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+
+import datetime
+
+from bson.binary import Binary
+
+from girder.constants import SortDir
+from girder.models.item import Item
+from girder.models.model_base import Model
+from girder.models.setting import Setting
+
+from ..constants import PluginSettings
+from .histogram import Histogram
+from histogram import formats
+
+
+class HistogramAggregate(Model):
+    """
+    Combined histograms of all of the items in a folder.  Each is cached with
+    the IDs of the histograms it was computed from, and is only recomputed
+    when those change.
+    """
+    def initialize(self):
+        self.name = 'histogram_aggregate'
+        self.ensureIndices([([
+            ('folderId', 1),
+            ('bins', 1),
+            ('label', 1),
+            ('bitmask', 1),
+            ('floatMethod', 1),
+        ], {})])
+
+    def findMembers(self, folder, bins, label, bitmask, floatMethod=None):
+        """
+        Find the histograms to combine for a folder: the most recent completed
+        histogram with the given parameters of each item in the folder.
+        Histograms counted with a different floatMethod are not combined, so
+        exact and single-pass counts are never mixed.
+
+        :param folder: the folder document.
+        :param floatMethod: the single-pass method of the histograms to
+            combine, or None for exact histograms.
+        :returns: a sorted list of histogram IDs.
+        """
+        items = Item().find({'folderId': folder['_id']}, fields=['_id'])
+        histograms = Histogram().find({
+            'itemId': {'$in': [item['_id'] for item in items]},
+            'bins': bins,
+            'label': label,
+            'bitmask': bitmask,
+            'floatMethod': floatMethod,
+            'expected': {'$exists': False},
+            'fileId': {'$exists': True},
+        }, sort=[('_id', SortDir.ASCENDING)], fields=['_id', 'itemId'])
+        members = {}
+        for histogram in histograms:
+            members[histogram['itemId']] = histogram['_id']
+        return sorted(members.values())
+
+    def aggregateFolder(self, folder, bins=None, label=False, bitmask=False,
+                        floatMethod=None):
+        """
+        Get the combined histogram of the items in a folder, computing it if
+        the folder's histograms have changed since it was cached.
+
+        :param folder: the folder document.
+        :param bins: number of bins in the histograms to combine.
+        :param label: whether to combine histograms of label images.
+        :param bitmask: whether to combine histograms of bitmask values.
+        :param floatMethod: the single-pass method of the histograms to
+            combine, or None to combine exact histograms.
+        :returns: the aggregate document.  Its data is None if no item in the
+            folder has a matching histogram.
+        """
+        if bins is None:
+            bins = Setting().get(PluginSettings.DEFAULT_BINS)
+        query = {
+            'folderId': folder['_id'],
+            'bins': bins,
+            'label': label,
+            'bitmask': bitmask,
+            'floatMethod': floatMethod,
+        }
+        memberIds = self.findMembers(folder, bins, label, bitmask,
+                                     floatMethod)
+        aggregate = self.findOne(query)
+        if aggregate is not None and aggregate['memberIds'] == memberIds:
+            return aggregate
+        histogram = Histogram().mergeHistograms(
+            list(Histogram().find({'_id': {'$in': memberIds}})), bins)
+        aggregate = dict(query)
+        aggregate.update({
+            'memberIds': memberIds,
+            'data': (None if histogram is None else
+                     Binary(formats.dumps(histogram, 'binary'))),
+            'updated': datetime.datetime.utcnow(),
+        })
+        self.collection.update_one(query, {'$set': aggregate}, upsert=True)
+        return self.findOne(query)
+
+    def getData(self, aggregate):
+        """
+        Get the contents of a combined histogram.
+
+        :param aggregate: the aggregate document.
+        :returns: a dictionary like Histogram().getData, or None.
+        """
+        if aggregate.get('data') is None:
+            return None
+        data = formats.loads(bytes(aggregate['data']))
+        data['histograms'] = len(aggregate['memberIds'])
+        return data
+
+    def validate(self, aggregate):
+        return aggregate
@@ -21,57 +21,1014 @@
 #  limitations under the License.
 ###############################################################################
 
+import concurrent.futures
+import datetime
+import io
 import json
+import math
 import os.path
+import threading
 import uuid
 
+import large_image
+import numpy
+from bson.binary import Binary
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from girder.constants import AccessType
+from girder import logger
+from girder.constants import AccessType, SortDir
+from girder.exceptions import FilePathException
 from girder.models.model_base import AccessControlledModel
 from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
 from girder.models.setting import Setting
+from girder.models.upload import Upload
 
+from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
 from girder_worker.girder_plugin import utils
 
 from ..constants import PluginSettings
 
-from girder_worker_utils.transforms.girder_io import GirderFileId, GirderUploadToItem
+from girder_worker_utils.transforms.girder_io import GirderUploadToItem
+from histogram import formats, operations, readers
+from histogram.cache import GirderFileIdCached
 from histogram.histogram import histogram as histogramExecutor
+from histogram.histogram import histogramBatch as histogramBatchExecutor
+from histogram.histogram import computeArrayHistogram, histogramResult
+from histogram.histogram import computeMappedHistogram
+
+# Requests for a histogram that is still being computed share its job unless
+# the job was started longer ago than this, in which case it is assumed to
+# have been lost.
+IN_FLIGHT_TIMEOUT = datetime.timedelta(hours=6)
+
+# Only one histogram with the same values of these fields can be in flight.
+# Fields that are only stored when set, such as frames, are null otherwise.
+IN_FLIGHT_KEY = ('itemId', 'sourceFileId', 'bins', 'label', 'bitmask',
+                 'frames', 'tiles', 'floatMethod')
+
+# How many times to try reserving a histogram when other requests for the
+# same histogram conflict with it.
+RESERVE_ATTEMPTS = 3
+
+# Approximate histograms are computed from the smallest pyramid level that is
+# at least this many pixels wide or high.
+APPROXIMATE_SIZE = 1024
+
+# Number of completed histograms with other numbers of bins that are tried
+# when deriving a histogram instead of computing it.
+DERIVE_CANDIDATES = 5
+
+# Threads that compute histograms of uploaded files, shared by all requests
+# so that uploads cannot use more than histogram.upload_threads cores.
+_uploadPool = None
+_uploadPoolSize = 0
+_uploadPoolLock = threading.Lock()
+
+
+def _getUploadPool(size):
+    global _uploadPool, _uploadPoolSize
+
+    with _uploadPoolLock:
+        if _uploadPool is None or _uploadPoolSize != size:
+            if _uploadPool is not None:
+                _uploadPool.shutdown(wait=False)
+            _uploadPool = concurrent.futures.ThreadPoolExecutor(size)
+            _uploadPoolSize = size
+        return _uploadPool
+
+
+def _floatMethodQuery(floatMethod):
+    # Histograms computed exactly (without a floatMethod) also satisfy
+    # requests for a single-pass method.
+    if floatMethod is None:
+        return None
+    return {'$in': [None, floatMethod]}
 
 
 class Histogram(AccessControlledModel):
     def initialize(self):
         self.name = 'histogram'
-        self.ensureIndices(['itemId', 'fakeId', 'fileId'])
+        # Searches and cache lookups select histograms by their item or
+        # source with the same parameters.  The compound indices also serve
+        # queries on just their first fields.
+        self.ensureIndices(['fakeId', 'fileId', 'tilesFileId', 'jobId', 'folderId', ([
+            ('itemId', 1),
+            ('bins', 1),
+            ('label', 1),
+            ('bitmask', 1),
+        ], {}), ([
+            ('sourceFileId', 1),
+            ('bins', 1),
+            ('label', 1),
+            ('bitmask', 1),
+        ], {}), ([
+            ('sourceSha512', 1),
+            ('sourceSize', 1),
+            ('bins', 1),
+            ('label', 1),
+            ('bitmask', 1),
+        ], {})])
         self.exposeFields(AccessType.READ, (
             '_id',
             'itemId',  # computed histogram of this item
+            'sourceFileId',  # file the histogram was computed from
             'bins',
             'label',
             'bitmask',
             'fakeId',
+            'jobId',  # job computing the histogram
             'fileId',  # file containing computed histogram
+            'format',  # format of the histogram file
+            'approximate',  # sampling of a histogram that is being computed
+            'frames',  # whether each frame of a stack is also counted
+            'floatMethod',  # single-pass method for float images, if any
+            'tiles',  # whether the counts of a grid of tiles are stored
+            'tilesFileId',  # file containing the tile counts
+            'metrics',  # timings and counters of the job that computed it
         ))
 
+    def attachFile(self, histogram, file_):
+        """
+        Record the file containing a computed histogram.  If the file is
+        small enough, its contents are also stored in the histogram document
+        so that they can be read without going through the assetstore.
+
+        :param histogram: the histogram document.
+        :param file_: the uploaded histogram file.
+        :returns: the saved histogram document, or None if the file records
+            that the histogram could not be computed, in which case the
+            histogram and file are removed.
+        """
+        histogram['fileId'] = file_['_id']
+        histogram.pop('data', None)
+        histogram.pop('approximate', None)
+        uploadSeconds = histogram.pop('uploadSeconds', None)
+        inline = file_.get('size', 0) <= Setting().get(
+            PluginSettings.INLINE_SIZE)
+        with File().open(file_) as handle:
+            if inline:
+                data = formats.loads(handle.read())
+            else:
+                data = formats.readHeader(handle)
+            metrics = data.pop('metrics', None)
+        if data.get('error'):
+            logger.warning('Histogram %s could not be computed: %s' % (
+                histogram['_id'], data['error']))
+            self.remove(histogram)
+            return None
+        if inline:
+            histogram['data'] = Binary(formats.dumps(data, 'binary'))
+        if metrics:
+            if uploadSeconds is not None:
+                metrics['phases']['upload'] = uploadSeconds
+            self._recordMetrics(histogram, metrics)
+        mimeType = formats.MIME_TYPES[histogram.get('format', 'json')]
+        if file_.get('mimeType') != mimeType:
+            file_['mimeType'] = mimeType
+            File().save(file_)
+        return self.save(histogram)
+
+    def attachTiles(self, histogram, file_):
+        """
+        Record the file containing the tile counts of a histogram.  The
+        counts are only read to find the histograms of regions, so they are
+        kept out of the histogram file and document.
+
+        :param histogram: the histogram document.
+        :param file_: the uploaded tile counts file.
+        """
+        # Only this field is updated, so that other changes to the histogram
+        # are kept.
+        self.collection.update_one(
+            {'_id': histogram['_id']},
+            {'$set': {'tilesFileId': file_['_id']}})
+        histogram['tilesFileId'] = file_['_id']
+        mimeType = formats.MIME_TYPES['binary']
+        if file_.get('mimeType') != mimeType:
+            file_['mimeType'] = mimeType
+            File().save(file_)
+
+    def recordUpload(self, upload):
+        """
+        Record how long the upload of a histogram file took, from when it was
+        started to when it was finalized, so that it can be added to the
+        metrics of the histogram when the file is attached.  Both times are
+        taken by the server, since the clock of the worker may differ.
+
+        :param upload: the finalized upload document.
+        """
+        try:
+            ref = json.loads(upload.get('reference') or '')
+        except (TypeError, ValueError):
+            return
+        if (not isinstance(ref, dict) or not ref.get('isHistogram') or
+                not ref.get('fakeId') or ref.get('tiles') or
+                not upload.get('created')):
+            return
+        seconds = (datetime.datetime.utcnow() -
+                   upload['created']).total_seconds()
+        self.collection.update_one(
+            {'fakeId': ref['fakeId']},
+            {'$set': {'uploadSeconds': max(0, seconds)}})
+
+    def _recordMetrics(self, histogram, metrics):
+        """
+        Store the metrics of the job that computed a histogram on the
+        histogram and in the job's meta.
+
+        :param histogram: the histogram document.
+        :param metrics: the metrics from the histogram file, with phases and
+            counters.
+        """
+        histogram['metrics'] = metrics
+        fakeId = histogram['fakeId']
+        Job().collection.update_many(
+            {'meta.fakeId': fakeId}, {'$set': {'meta.metrics': metrics}})
+        Job().collection.update_many(
+            {'meta.fakeIds': fakeId},
+            {'$set': {'meta.metrics.%s' % fakeId: metrics}})
+
+    def getMetrics(self, limit=1000):
+        """
+        Summarize the metrics of recently computed histograms.
+
+        :param limit: the number of most recent histograms to summarize.
+        :returns: a dictionary with the number of histograms summarized and,
+            for each phase and counter, the count, total, mean, maximum, and
+            50th, 90th, and 99th percentiles of its values.
+        """
+        values = {'phases': {}, 'counters': {}}
+        count = 0
+        for histogram in self.find(
+                {'metrics': {'$exists': True}},
+                sort=[('_id', SortDir.DESCENDING)], limit=limit,
+                fields=['metrics']):
+            count += 1
+            for kind, entries in values.items():
+                for key, value in histogram['metrics'].get(kind, {}).items():
+                    entries.setdefault(key, []).append(value)
+        result = {'histograms': count}
+        for kind, entries in values.items():
+            result[kind] = {}
+            for key, entryValues in entries.items():
+                entryValues = numpy.array(entryValues, dtype=float)
+                p50, p90, p99 = numpy.percentile(entryValues, [50, 90, 99])
+                result[kind][key] = {
+                    'count': len(entryValues),
+                    'total': float(entryValues.sum()),
+                    'mean': float(entryValues.mean()),
+                    'p50': float(p50),
+                    'p90': float(p90),
+                    'p99': float(p99),
+                    'max': float(entryValues.max()),
+                }
+        return result
+
+    def inheritAccess(self, histogram, folder):
+        """
+        Give a histogram the access of its item.  Items have the access of
+        their folder, which is copied to the histogram so that searches can
+        check permissions in the query.
+
+        :param histogram: the histogram document.  It is modified but not
+            saved.
+        :param folder: the folder of the histogram's item.
+        :returns: the histogram document.
+        """
+        histogram['folderId'] = folder['_id']
+        self.copyAccessPolicies(folder, histogram)
+        return histogram
+
+    def setExplicitAccess(self, histogram, access, public=None, user=None):
+        """
+        Give a histogram its own access.  It keeps this access when the access
+        of its folder changes or its item moves.
+
+        :param histogram: the histogram document.
+        :param access: the access control list.
+        :param public: if not None, whether the histogram is public.
+        :param user: the user setting the access.
+        :returns: the saved histogram document.
+        """
+        histogram['explicitAccess'] = True
+        if public is not None:
+            self.setPublic(histogram, public)
+        return self.setAccessList(histogram, access, save=True, user=user)
+
+    def updateAccess(self, folder, item=None):
+        """
+        Give histograms the current access of their folder, after the folder's
+        access has changed or an item has moved into it.  Histograms that were
+        given their own access keep it.
+
+        :param folder: the folder.
+        :param item: if given, only update the histograms of this item.
+            Otherwise, update the histograms of every item in the folder.
+        :returns: the number of histograms updated.
+        """
+        update = self.inheritAccess({}, folder)
+        if item:
+            query = {'itemId': item['_id']}
+            # Histograms with their own access still move with their item.
+            self.collection.update_many(
+                dict(query, explicitAccess=True,
+                     folderId={'$ne': folder['_id']}),
+                {'$set': {'folderId': folder['_id']}})
+        else:
+            query = {'folderId': folder['_id']}
+        query['explicitAccess'] = {'$ne': True}
+        query['$or'] = [{key: {'$ne': value}} for key, value in update.items()]
+        return self.collection.update_many(
+            query, {'$set': update}).modified_count
+
+    def updateItemAccess(self, item):
+        """
+        Give the histograms of an item that has moved to another folder the
+        access of that folder.
+
+        :param item: the item.
+        :returns: the number of histograms updated.
+        """
+        return self.updateAccess(
+            Folder().load(item['folderId'], force=True), item)
+
+    def inheritMissingAccess(self):
+        """
+        Give histograms that were created before histograms inherited access
+        the access of their items.  Histograms that had already been given
+        access of their own keep it.  This only changes histograms without a
+        folderId, so it can be run more than once.
+
+        :returns: the number of histograms updated.
+        """
+        query = {'folderId': {'$exists': False}}
+        self.collection.update_many(dict(query, **{'$or': [
+            {'public': True},
+            {'access.users.0': {'$exists': True}},
+            {'access.groups.0': {'$exists': True}},
+        ]}), {'$set': {'explicitAccess': True}})
+        itemIds = {}
+        for item in Item().find({'_id': {'$in': self.collection.distinct(
+                'itemId', query)}}, fields=['folderId']):
+            itemIds.setdefault(item['folderId'], []).append(item['_id'])
+        updated = 0
+        for folder in Folder().find({'_id': {'$in': list(itemIds)}}):
+            folderQuery = dict(query, itemId={'$in': itemIds[folder['_id']]})
+            self.collection.update_many(
+                dict(folderQuery, explicitAccess=True),
+                {'$set': {'folderId': folder['_id']}})
+            updated += self.collection.update_many(
+                folderQuery,
+                {'$set': self.inheritAccess({}, folder)}).modified_count
+        return updated
+
+    def getData(self, histogram, frame=None):
+        """
+        Get the contents of a computed histogram, from the histogram document
+        if they are stored there, or from the histogram file.
+
+        :param histogram: the histogram document.
+        :param frame: if not None, get the histogram of this frame of a
+            histogram computed with frames.
+        :returns: a dictionary with bins, label, bitmask, hist, and binEdges,
+            where hist and binEdges are numpy arrays, or None if the histogram
+            has not been computed.
+        """
+        if histogram.get('data') is not None:
+            data = formats.loads(bytes(histogram['data']))
+        elif not histogram.get('fileId'):
+            return None
+        else:
+            file_ = File().load(histogram['fileId'], force=True)
+            if not file_:
+                return None
+            with File().open(file_) as handle:
+                data = formats.loads(handle.read())
+        if frame is not None:
+            data = operations.frameHistogram(data, frame)
+        return data
+
+    def getQuantiles(self, histogram, q, frame=None):
+        """
+        Find the values below which fractions of the pixels of a histogram
+        fall, using the stored cumulative counts if the histogram has them.
+
+        :param histogram: the histogram document.
+        :param q: a list of fractions between 0 and 1.
+        :param frame: if not None, use the histogram of this frame.
+        :returns: a dictionary with q and either values or, for multi-channel
+            histograms, channels with values keyed by channel name.  None if
+            the histogram has not been computed.
+        """
+        data = self.getData(histogram, frame)
+        if data is None:
+            return None
+        if data.get('bitmask'):
+            raise ValueError('Bitmask histograms do not have quantiles.')
+        result = {'q': q}
+        if 'channels' in data:
+            result['channels'] = {
+                name: operations.quantiles(
+                    entry['hist'], entry['binEdges'], q,
+                    entry.get('cumulative'))
+                for name, entry in data['channels'].items()}
+        else:
+            result['values'] = operations.quantiles(
+                data['hist'], data['binEdges'], q, data.get('cumulative'))
+        return result
+
+    def getRegion(self, histogram, left, top, right, bottom):
+        """
+        Get the histogram of a region of the source image of a histogram
+        computed with tiles.  Only the strips, tiles, or mapped rows of the
+        source file under the edges of the region are read.  The file is
+        opened with the same readers as the worker that counted the tiles,
+        so that both see the same pixels.  Images that can only be decoded
+        whole, e.g. PNGs, are read whole.
+
+        :param histogram: the histogram document.
+        :param left: the left edge of the region in pixels.
+        :param top: the top edge of the region.
+        :param right: the right edge of the region, exclusive.
+        :param bottom: the bottom edge of the region, exclusive.
+        :returns: a dictionary like getData with a region entry, or None if
+            the histogram or its tile counts have not been computed.
+        """
+        if not histogram.get('tiles'):
+            raise ValueError('The histogram was not computed with tiles.')
+        data = self.getData(histogram)
+        if data is None or not histogram.get('tilesFileId'):
+            return None
+        tilesFile = File().load(histogram['tilesFileId'], force=True)
+        if not tilesFile:
+            return None
+        with File().open(tilesFile) as handle:
+            tiles = formats.loads(handle.read())
+        file_ = File().load(histogram['sourceFileId'], force=True)
+        if not file_:
+            raise ValueError('The source file of the histogram is missing.')
+        try:
+            path = File().getLocalFilePath(file_)
+        except FilePathException:
+            raise ValueError('The source file of the histogram is not in a '
+                             'filesystem assetstore.')
+        # Only the chunks of the image under the edges of the region are
+        # decoded, so prefer readers that can skip the others.
+        image = readers.openImage(path, ('mapped',))
+        if not image.mapped and not image.tiled:
+            image = readers.openImage(path, ('tiled',))
+        return operations.regionHistogram(
+            data, tiles, left, top, right, bottom, image.readRegion)
+
+    def mergeHistograms(self, histograms, bins=None):
+        """
+        Combine computed histograms into the histogram of all of their pixels.
+        Histograms with different bin edges are re-binned.
+
+        :param histograms: a list of completed histogram documents with the
+            same label and bitmask values.
+        :param bins: the number of bins to re-bin into, if needed.
+        :returns: a dictionary like getData, or None if there are no
+            histograms.
+        """
+        data = [self.getData(histogram) for histogram in histograms]
+        return operations.merge([entry for entry in data if entry is not None],
+                                bins)
+
     def remove(self, histogram, **kwargs):
+        fileIds = [histogram.get('tilesFileId')]
         if not kwargs.get('keepFile'):
-            fileId = histogram.get('fileId')
+            fileIds.append(histogram.get('fileId'))
+        for fileId in fileIds:
             if fileId:
                 file_ = File().load(fileId, force=True)
                 if file_:
                     File().remove(file_)
         return super(Histogram, self).remove(histogram, **kwargs)
 
-    def createHistogramJob(self, item, file_, user=None, token=None,
-                           notify=False, bins=None, label=False, bitmask=False):
+    def findCached(self, file_, bins, label, bitmask, frames=False,
+                   floatMethod=None, tiles=False):
+        """
+        Find a completed histogram computed from a file with the same contents
+        and with the same parameters.
+
+        :param file_: the source file.
+        :param bins: number of bins in the histogram.
+        :param label: whether the histogram is of a label image.
+        :param bitmask: whether the histogram is of bitmask values.
+        :param frames: whether the histogram must have per-frame counts.
+        :param floatMethod: the single-pass method used for float images, or
+            None for exact histograms.  Exact histograms are also found for
+            requests with a method.
+        :param tiles: whether the histogram must have tile counts.
+        :returns: a histogram document or None.
+        """
+        if not file_.get('sha512') or file_.get('size') is None:
+            return None
+        query = {
+            'sourceSha512': file_['sha512'],
+            'sourceSize': file_['size'],
+            'bins': bins,
+            'label': label,
+            'bitmask': bitmask,
+            'expected': {'$exists': False},
+            'fileId': {'$exists': True},
+        }
+        if frames:
+            query['frames'] = True
+        if tiles:
+            query['tilesFileId'] = {'$exists': True}
+        query['floatMethod'] = _floatMethodQuery(floatMethod)
+        return self.findOne(query)
+
+    def copyHistogram(self, histogram, item, file_, user=None):
+        """
+        Copy a completed histogram, including its histogram file, to another
+        item.  The copy records the original as copiedFrom, but not the job,
+        batch jobs, or metrics of the original, since no job computed the
+        copy.
+
+        :param histogram: the histogram to copy.
+        :param item: the item to copy the histogram to.
+        :param file_: the source file in the item that the copy describes.
+        :param user: the user creating the copy.
+        :returns: the new histogram document.
+        """
+        histogramFile = File().load(histogram['fileId'], force=True)
+        histogramFile = File().copyFile(histogramFile, user, item=item)
+        copy = {
+            key: value for key, value in histogram.items()
+            if key not in ('_id', 'notify', 'jobId', 'batchJobIds',
+                           'metrics', 'tilesFileId')}
+        tilesFile = None
+        if histogram.get('tilesFileId'):
+            tilesFile = File().load(histogram['tilesFileId'], force=True)
+        if tilesFile:
+            copy['tilesFileId'] = File().copyFile(
+                tilesFile, user, item=item)['_id']
+        copy.update({
+            'itemId': item['_id'],
+            'sourceFileId': file_['_id'],
+            'fakeId': uuid.uuid4().hex,
+            'fileId': histogramFile['_id'],
+            'copiedFrom': histogram['_id'],
+        })
+        self.inheritAccess(copy, Folder().load(item['folderId'], force=True))
+        return self.save(copy)
+
+    def evictCached(self, file_=None):
+        """
+        Stop reusing existing histograms for new requests.  The histograms
+        themselves are kept.
+
+        :param file_: if given, only evict histograms computed from files with
+            the same contents as this file.  Otherwise, evict all histograms.
+        :returns: the number of histograms evicted.
+        """
+        query = {'sourceSha512': {'$exists': True}}
+        if file_ is not None:
+            if not file_.get('sha512'):
+                return 0
+            query = {'sourceSha512': file_['sha512'],
+                     'sourceSize': file_.get('size')}
+        result = self.collection.update_many(
+            query, {'$unset': {'sourceSha512': '', 'sourceSize': ''}})
+        return result.modified_count
+
+    def findSourceFiles(self, items):
+        """
+        Find the image file to compute a histogram from in each of several
+        items, using a single query.
+
+        :param items: a list of item documents.
+        :returns: a dictionary of source file documents keyed by item ID.
+            Items without an image file are omitted.
+        """
+        query = {
+            'itemId': {'$in': [item['_id'] for item in items]},
+            # query should find the same file(tiff) used for creating histogram
+            # but this will always find most recent json histogram
+            '$or': [{'mimeType': {'$regex': '^image/'}},
+                    {'mimeType': 'application/octet-stream'},
+                    {'exts': ['tif']}],
+        }
+        files = {}
+        for file_ in File().find(query, sort=[('_id', SortDir.ASCENDING)]):
+            files.setdefault(file_['itemId'], file_)
+        return files
+
+    def _newHistogram(self, item, file_, bins, label, bitmask, fileFormat,
+                      folder=None):
+        histogram = {
+            'itemId': item['_id'],
+            'sourceFileId': file_['_id'],
+            'bins': bins,
+            'label': label,
+            'bitmask': bitmask,
+            'fakeId': uuid.uuid4().hex,
+            'format': fileFormat,
+            'created': datetime.datetime.utcnow(),
+        }
+        if file_.get('sha512'):
+            histogram['sourceSha512'] = file_['sha512']
+            histogram['sourceSize'] = file_.get('size')
+        if folder is None:
+            folder = Folder().load(item['folderId'], force=True)
+        return self.inheritAccess(histogram, folder)
+
+    def deriveHistogram(self, item, file_, user=None, bins=None, label=False,
+                        bitmask=False, fileFormat=None):
+        """
+        Create a histogram without running a job by re-binning a completed
+        histogram of the same file contents with a different number of bins.
+        This is only done when the result is exactly what a job would compute,
+        so only exact histograms without per-frame or tile counts are
+        re-binned.
+
+        :param item: the item to add the histogram to.
+        :param file_: the source file.
+        :returns: the new histogram document, or None if no histogram could be
+            derived.
+        """
         if bins is None:
             bins = Setting().get(PluginSettings.DEFAULT_BINS)
+        if fileFormat is None:
+            fileFormat = Setting().get(PluginSettings.FORMAT)
+        sources = [{'sourceFileId': file_['_id']}]
+        if file_.get('sha512'):
+            sources.append({'sourceSha512': file_['sha512'],
+                            'sourceSize': file_.get('size')})
+        candidates = self.find({
+            '$or': sources,
+            'bins': {'$ne': bins},
+            'label': label,
+            'bitmask': bitmask,
+            'expected': {'$exists': False},
+            'fileId': {'$exists': True},
+            'floatMethod': None,
+            'frames': {'$ne': True},
+            'tiles': {'$ne': True},
+        }, sort=[('bins', SortDir.DESCENDING)], limit=DERIVE_CANDIDATES)
+        for candidate in candidates:
+            data = self.getData(candidate)
+            derived = operations.derive(data, bins) if data else None
+            if derived is not None:
+                break
+        else:
+            return None
+        histogram = self._newHistogram(
+            item, file_, bins, label, bitmask, fileFormat)
+        histogram['derivedFrom'] = candidate['_id']
+        histogram = self.save(histogram)
+        return self._storeHistogram(histogram, item, derived, user=user)
+
+    def _storeHistogram(self, histogram, item, data, user=None):
+        """
+        Upload the contents of a histogram computed on the server as its
+        file.
+
+        :param histogram: the histogram document.
+        :param item: the item to add the file to.
+        :param data: the histogram file contents.
+        :returns: the saved histogram document.
+        """
+        fileFormat = histogram['format']
+        contents = formats.dumps(data, fileFormat)
+        histogramFile = Upload().uploadFromFile(
+            io.BytesIO(contents), len(contents),
+            'histogram%s' % formats.EXTENSIONS[fileFormat],
+            parentType='item', parent=item, user=user,
+            mimeType=formats.MIME_TYPES[fileFormat])
+        return self.attachFile(histogram, histogramFile)
+
+    def _reserveHistogram(self, item, file_, user=None, notify=True,
+                          bins=None, label=False, bitmask=False, cache=True,
+                          fileFormat=None, batchJob=None, frames=False,
+                          floatMethod=None, tiles=False):
+        """
+        Get a histogram document for a file, reusing a cached or in-flight
+        histogram if possible, or adding a new document that is expected to
+        be computed.  Histograms with per-frame or tile counts are reused for
+        requests without them, but not the other way around.
+
+        :returns: (histogram, isNew).  If isNew is True, a job must be started
+            to compute the histogram.
+        """
+        if bins is None:
+            bins = Setting().get(PluginSettings.DEFAULT_BINS)
+        if fileFormat is None:
+            fileFormat = Setting().get(PluginSettings.FORMAT)
+        if fileFormat not in formats.FORMATS:
+            raise ValueError('Unknown histogram format: %s' % fileFormat)
         if file_['itemId'] != item['_id']:
             raise ValueError('The file must be in the item.')
+        if cache:
+            reused = self._reuseHistogram(
+                item, file_, user, bins, label, bitmask, fileFormat, frames,
+                floatMethod, tiles)
+            if reused:
+                return reused, False
+        histogram, query, update = self._reservation(
+            item, file_, notify, bins, label, bitmask, fileFormat, batchJob,
+            frames, floatMethod, tiles)
+        fakeId = histogram['fakeId']
+        for attempt in range(RESERVE_ATTEMPTS):
+            try:
+                inFlight = self.collection.find_one_and_update(
+                    query, update, upsert=True)
+            except DuplicateKeyError:
+                # Another request added the same histogram first, in which
+                # case trying again finds it, or an abandoned histogram holds
+                # the key.
+                self._removeAbandoned(histogram)
+                continue
+            if inFlight is not None:
+                return inFlight, False
+            return self.findOne({'fakeId': fakeId}), True
+        raise ValueError('The histogram could not be reserved.')
+
+    def _reuseHistogram(self, item, file_, user, bins, label, bitmask,
+                        fileFormat, frames=False, floatMethod=None,
+                        tiles=False):
+        """
+        Find a completed histogram of a file's contents, copying it to the
+        item if it belongs to another, or derive one from a histogram with
+        other bins.
+
+        :returns: a histogram document, or None if none can be reused.
+        """
+        cached = self.findCached(
+            file_, bins, label, bitmask, frames, floatMethod, tiles)
+        if cached:
+            if cached['itemId'] == item['_id']:
+                return cached
+            return self.copyHistogram(cached, item, file_, user=user)
+        if frames or tiles:
+            return None
+        return self.deriveHistogram(
+            item, file_, user=user, bins=bins, label=label, bitmask=bitmask,
+            fileFormat=fileFormat)
+
+    def _reservation(self, item, file_, notify, bins, label, bitmask,
+                     fileFormat, batchJob=None, frames=False,
+                     floatMethod=None, tiles=False, folder=None):
+        """
+        Build a new in-flight histogram and the upsert that adds it unless a
+        histogram of the file with the same parameters is already in flight.
+
+        :returns: (histogram, query, update).
+        """
+        histogram = self._newHistogram(
+            item, file_, bins, label, bitmask, fileFormat, folder)
+        histogram.update({
+            'expected': True,
+            'notify': notify,
+        })
+        if frames:
+            histogram['frames'] = True
+        if floatMethod:
+            histogram['floatMethod'] = floatMethod
+        if tiles:
+            histogram['tiles'] = True
+        update = {'$setOnInsert': histogram}
+        if batchJob is not None:
+            update['$addToSet'] = {'batchJobIds': batchJob['_id']}
+        # Either find a histogram of the same file with the same parameters
+        # that is still being computed, or add this one.  The unique in-flight
+        # index makes concurrent requests that both add it conflict, so that
+        # they share a single job.
+        query = {
+            'itemId': item['_id'],
+            'sourceFileId': file_['_id'],
+            'bins': bins,
+            'label': label,
+            'bitmask': bitmask,
+            'expected': True,
+            'created': {'$gt': histogram['created'] - IN_FLIGHT_TIMEOUT},
+        }
+        if frames:
+            query['frames'] = True
+        if tiles:
+            query['tiles'] = True
+        query['floatMethod'] = _floatMethodQuery(floatMethod)
+        return histogram, query, update
+
+    def _reserveHistograms(self, items, files, user=None, notify=True,
+                           bins=None, label=False, bitmask=False, cache=True,
+                           fileFormat=None, batchJob=None):
+        """
+        Reserve histograms of many files, as _reserveHistogram does for one.
+        The folders of the items are loaded once and the new histograms are
+        added with a single bulk write.  Reservations that conflict with
+        concurrent requests are retried one at a time.
+
+        :param items: a list of item documents.
+        :param files: a dictionary of the source file of each item, keyed by
+            item ID.
+        :returns: a list of (histogram, isNew) tuples in the order of items.
+        """
+        if bins is None:
+            bins = Setting().get(PluginSettings.DEFAULT_BINS)
+        if fileFormat is None:
+            fileFormat = Setting().get(PluginSettings.FORMAT)
+        if fileFormat not in formats.FORMATS:
+            raise ValueError('Unknown histogram format: %s' % fileFormat)
+        results = [None] * len(items)
+        pending = []
+        for index, item in enumerate(items):
+            reused = cache and self._reuseHistogram(
+                item, files[item['_id']], user, bins, label, bitmask,
+                fileFormat)
+            if reused:
+                results[index] = (reused, False)
+            else:
+                pending.append(index)
+        folders = {folder['_id']: folder for folder in Folder().find({
+            '_id': {'$in': list({items[index]['folderId']
+                                 for index in pending})}})}
+        reservations = [self._reservation(
+            items[index], files[items[index]['_id']], notify, bins, label,
+            bitmask, fileFormat, batchJob,
+            folder=folders[items[index]['folderId']]) for index in pending]
+        upserted, conflicts = {}, set()
+        if reservations:
+            try:
+                upserted = self.collection.bulk_write([
+                    UpdateOne(query, update, upsert=True)
+                    for _, query, update in reservations],
+                    ordered=False).upserted_ids
+            except BulkWriteError as exc:
+                upserted = {entry['index']: entry['_id']
+                            for entry in exc.details.get('upserted', [])}
+                conflicts = {error['index']
+                             for error in exc.details['writeErrors']}
+        added = {histogram['_id']: histogram for histogram in self.find(
+            {'_id': {'$in': list(upserted.values())}})}
+        for position, index in enumerate(pending):
+            item = items[index]
+            inFlight = None
+            if position in upserted:
+                results[index] = (added[upserted[position]], True)
+                continue
+            if position not in conflicts:
+                # The upsert matched a histogram that is already in flight.
+                inFlight = self.findOne(reservations[position][1])
+            results[index] = (inFlight, False) if inFlight else \
+                self._reserveHistogram(
+                    item, files[item['_id']], user=user, notify=notify,
+                    bins=bins, label=label, bitmask=bitmask, cache=False,
+                    fileFormat=fileFormat, batchJob=batchJob)
+        return results
+
+    def _removeAbandoned(self, histogram):
+        """
+        Remove an in-flight histogram with the same parameters as another if
+        its job was started longer ago than IN_FLIGHT_TIMEOUT.
+
+        :param histogram: a histogram document with the parameters.
+        """
+        query = {key: histogram.get(key) for key in IN_FLIGHT_KEY}
+        query.update({
+            'expected': True,
+            'created': {'$lte': histogram['created'] - IN_FLIGHT_TIMEOUT},
+        })
+        for abandoned in self.find(query):
+            self.updateBatchJobs(abandoned, success=False)
+            self.remove(abandoned)
+
+    def ensureInFlightIndex(self):
+        """
+        Add the unique index that keeps more than one histogram with the same
+        parameters from being in flight for a file.  Duplicates that were
+        added before the index existed are removed, keeping the oldest.
+        """
+        duplicates = self.collection.aggregate([
+            {'$match': {'expected': True}},
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': {key: {'$ifNull': ['$' + key, None]}
+                        for key in IN_FLIGHT_KEY},
+                'ids': {'$push': '$_id'},
+            }},
+            {'$match': {'ids.1': {'$exists': True}}},
+        ])
+        for group in duplicates:
+            for histogram in self.find({'_id': {'$in': group['ids'][1:]}}):
+                self.updateBatchJobs(histogram, success=False)
+                self.remove(histogram)
+        self.collection.create_index(
+            [(key, 1) for key in IN_FLIGHT_KEY], name='inFlight',
+            unique=True, partialFilterExpression={'expected': True})
+
+    def _sourceFileInput(self, file_):
+        """
+        Get the task input for a source file.  Workers that allow direct paths
+        (GW_DIRECT_PATHS is set) read files in a filesystem assetstore in
+        place.  Otherwise, workers download files into a cache that is shared
+        by their tasks.
+        """
+        try:
+            localPath = File().getLocalFilePath(file_)
+        except FilePathException:
+            localPath = None
+        return GirderFileIdCached(
+            str(file_['_id']), file_['name'], localPath,
+            modified=str(file_.get('updated') or file_.get('created')))
+
+    def approximateHistogram(self, histogram, file_):
+        """
+        Store an approximate histogram, computed from a low resolution level
+        of the source image, in a histogram that is still being computed.  It
+        is replaced when the full resolution histogram file is uploaded.
+
+        :param histogram: an expected histogram document.
+        :param file_: the source file.  It must be in a filesystem
+            assetstore and readable by large_image.
+        :returns: the histogram document.
+        """
+        try:
+            source = large_image.getTileSource(File().getLocalFilePath(file_))
+            # Without resampling, this is the smallest pyramid level that is
+            # at least APPROXIMATE_SIZE in either direction.
+            array, _ = source.getRegion(
+                output={'maxWidth': APPROXIMATE_SIZE,
+                        'maxHeight': APPROXIMATE_SIZE},
+                format=large_image.tilesource.TILE_FORMAT_NUMPY,
+                resample=False)
+        except Exception:
+            logger.info('Cannot compute an approximate histogram of file %s' %
+                        file_['_id'])
+            return histogram
+        # Use the first band of grayscale (with or without alpha) images
+        if array.ndim == 3 and array.shape[2] < 3:
+            array = array[:, :, 0]
+        scale = float(source.sizeX) / array.shape[1]
+        level = max(0, source.levels - 1 - int(round(math.log(scale, 2))))
+        label, bins, bitmask = (
+            histogram['label'], histogram['bins'], histogram['bitmask'])
+        try:
+            computed = computeArrayHistogram(array, label, bins, bitmask)
+        except ValueError:
+            # The job will report why the image can't be counted
+            return histogram
+        data = Binary(formats.dumps(histogramResult(
+            computed, label, bins, bitmask), 'binary'))
+        approximate = {'level': level, 'scale': scale}
+        # Only store the approximation if the full histogram hasn't arrived.
+        updated = self.collection.find_one_and_update(
+            {'_id': histogram['_id'], 'expected': True},
+            {'$set': {'data': data, 'approximate': approximate}},
+            return_document=ReturnDocument.AFTER)
+        return updated or self.load(histogram['_id'], force=True)
+
+    def createHistogramJob(self, item, file_, user=None, token=None,
+                           notify=False, bins=None, label=False, bitmask=False,
+                           cache=True, fileFormat=None, approximate=False,
+                           frames=False, floatMethod=None, tiles=False):
+        """
+        Start a job to compute a histogram of a file.
+
+        :param approximate: if True, also store an approximate histogram
+            in the document until the job finishes.
+        :param frames: if True, also store the histogram of each frame of
+            multi-frame images.
+        :param floatMethod: one of FLOAT_METHODS to count float and wide
+            integer images in a single pass, or None to count them exactly.
+        :param tiles: if True, also store the counts of a grid of tiles over
+            single channel images, so that the histograms of regions can be
+            found with getRegion.
+        """
+        histogram, isNew = self._reserveHistogram(
+            item, file_, user=user, bins=bins, label=label, bitmask=bitmask,
+            cache=cache, fileFormat=fileFormat, frames=frames,
+            floatMethod=floatMethod, tiles=tiles)
+        if not isNew:
+            if (approximate and histogram.get('expected') and
+                    histogram.get('data') is None):
+                histogram = self.approximateHistogram(histogram, file_)
+            return histogram
+        self._startHistogramJob(item, file_, histogram)
+        if approximate:
+            histogram = self.approximateHistogram(histogram, file_)
+        return histogram
+
+    def _startHistogramJob(self, item, file_, histogram):
+        """
+        Start a job to compute a histogram document added by
+        _reserveHistogram.  The document is removed if the job cannot be
+        started.
+        """
+        fakeId = histogram['fakeId']
+        label, bins, bitmask = (
+            histogram['label'], histogram['bins'], histogram['bitmask'])
+        fileFormat = histogram['format']
+
         girder_job_title = 'Histogram computation for item %s' % item['_id']
         girder_job_type = 'histogram'
-        fakeId = uuid.uuid4().hex
         other_fields = {
             'meta' : {
                 'creator': 'histogram',
@@ -80,23 +1037,29 @@ class Histogram(AccessControlledModel):
             }
         }
         reference = json.dumps({'isHistogram': True, 'fakeId': fakeId})
-        result = histogramExecutor.delay(GirderFileId(str(file_['_id'])), label, bins, bitmask,
-                                         girder_job_title=girder_job_title, girder_job_type=girder_job_type,
-                                         girder_job_other_fields=other_fields,
-                                         girder_result_hooks=[GirderUploadToItem(str(item['_id']), delete_file=True,
-                                         upload_kwargs={'reference': reference})])
-        histogram = {
-            'expected': True,
-            'notify': True,
-            'itemId': item['_id'],
-            'bins': bins,
-            'label': label,
-            'bitmask': bitmask,
-            # 'jobId': result.job['_id'],
-            'fakeId': fakeId
-        }
-        self.save(histogram)
-        return histogram
+        hooks = [GirderUploadToItem(str(item['_id']), delete_file=True,
+                                    upload_kwargs={'reference': reference})]
+        if histogram.get('tiles'):
+            # The task returns the tile counts file before the histogram file.
+            hooks.insert(0, GirderUploadToItem(
+                str(item['_id']), delete_file=True, upload_kwargs={
+                    'reference': json.dumps({
+                        'isHistogram': True, 'fakeId': fakeId,
+                        'tiles': True})}))
+        workers = Setting().get(PluginSettings.WORKERS)
+        try:
+            result = histogramExecutor.delay(self._sourceFileInput(file_), label, bins, bitmask,
+                                             workers=workers, fileFormat=fileFormat,
+                                             frames=histogram.get('frames', False),
+                                             floatMethod=histogram.get('floatMethod'),
+                                             tiles=histogram.get('tiles', False),
+                                             girder_job_title=girder_job_title, girder_job_type=girder_job_type,
+                                             girder_job_other_fields=other_fields,
+                                             girder_result_hooks=hooks)
+        except Exception:
+            self.remove(histogram)
+            raise
+        self._recordJob([histogram], result)
         # path = os.path.join(os.path.dirname(__file__), '../../histogramScript/',
         #                     'create_histogram.py')
         # with open(path, 'r') as f:
@@ -198,5 +1161,238 @@ class Histogram(AccessControlledModel):
 
         # return job
 
+    def createUploadHistogram(self, item, file_, user=None, token=None,
+                              notify=False, bins=None, label=False,
+                              bitmask=False, cache=True, fileFormat=None):
+        """
+        Create a histogram of a file that was just uploaded.  If the
+        histogram.upload_threads setting is not 0, uncompressed images in a
+        filesystem assetstore are counted from a memory map of the assetstore
+        file by a bounded pool of server threads, so that the histogram is
+        complete when this returns.  Other files are left to a worker job, as
+        with createHistogramJob.
+
+        :returns: the histogram document.
+        """
+        threads = Setting().get(PluginSettings.UPLOAD_THREADS)
+        path = None
+        if threads:
+            try:
+                path = File().getLocalFilePath(file_)
+            except FilePathException:
+                pass
+        if path is None:
+            return self.createHistogramJob(
+                item, file_, user=user, token=token, notify=notify, bins=bins,
+                label=label, bitmask=bitmask, cache=cache,
+                fileFormat=fileFormat)
+        histogram, isNew = self._reserveHistogram(
+            item, file_, user=user, notify=notify, bins=bins, label=label,
+            bitmask=bitmask, cache=cache, fileFormat=fileFormat)
+        if not isNew:
+            return histogram
+        try:
+            data = _getUploadPool(threads).submit(
+                computeMappedHistogram, path, histogram['label'],
+                histogram['bins'], histogram['bitmask']).result()
+        except Exception:
+            # The job reports why the image can't be counted
+            logger.exception('Cannot compute a histogram of file %s on '
+                             'upload' % file_['_id'])
+            data = None
+        if data is None:
+            self._startHistogramJob(item, file_, histogram)
+            return histogram
+        del histogram['expected']
+        # The histogram is done before the upload request returns.
+        histogram.pop('notify', None)
+        return self._storeHistogram(histogram, item, data, user=user)
+
+    def createHistogramJobs(self, items, user=None, token=None, notify=False,
+                            bins=None, label=False, bitmask=False, cache=True,
+                            fileFormat=None, chunkSize=0):
+        """
+        Compute histograms for many items.  The work is submitted as one
+        worker job per chunk of files, and a single batch job reports the
+        progress of the whole request.
+
+        :param items: a list of item documents.  Items without an image file
+            are skipped.
+        :param chunkSize: the maximum number of files per worker job, or 0 to
+            use a single worker job.
+        :returns: the batch job and a list of histogram documents.
+        """
+        if bins is None:
+            bins = Setting().get(PluginSettings.DEFAULT_BINS)
+        if fileFormat is None:
+            fileFormat = Setting().get(PluginSettings.FORMAT)
+        files = self.findSourceFiles(items)
+        items = [item for item in items if item['_id'] in files]
+        batchJob = Job().createJob(
+            title='Histogram computation for %d items' % len(items),
+            type='histogram_batch', user=user, otherFields={'meta': {
+                'creator': 'histogram',
+                'task': 'histogramBatch',
+                'completed': 0,
+                'failed': 0,
+            }})
+        batchJob = Job().updateJob(
+            batchJob, status=JobStatus.RUNNING, progressTotal=len(items),
+            progressCurrent=0)
+        histograms = []
+        pending = []
+        reserved = self._reserveHistograms(
+            items, files, user=user, notify=notify, bins=bins, label=label,
+            bitmask=bitmask, cache=cache, fileFormat=fileFormat,
+            batchJob=batchJob)
+        for item, (histogram, isNew) in zip(items, reserved):
+            histograms.append(histogram)
+            if isNew:
+                pending.append((item, files[item['_id']], histogram))
+            elif not histogram.get('expected'):
+                self.updateBatchJobs(histogram, batchJobs=[batchJob])
+        if not items:
+            Job().updateJob(batchJob, status=JobStatus.SUCCESS)
+
+        workers = Setting().get(PluginSettings.WORKERS)
+        chunkSize = chunkSize or len(pending)
+        for start in range(0, len(pending), chunkSize or 1):
+            chunk = pending[start:start + chunkSize]
+            fakeIds = [histogram['fakeId'] for _, _, histogram in chunk]
+            other_fields = {
+                'meta': {
+                    'creator': 'histogram',
+                    'task': 'createHistogramBatch',
+                    'fakeIds': fakeIds,
+                    'batchJobId': batchJob['_id'],
+                }
+            }
+            try:
+                result = histogramBatchExecutor.delay(
+                    [self._sourceFileInput(file_) for _, file_, _ in chunk],
+                    label, bins, bitmask, workers=workers, fileFormat=fileFormat,
+                    girder_job_title='Histogram computation for %d items' % len(chunk),
+                    girder_job_type='histogram',
+                    girder_job_other_fields=other_fields,
+                    girder_result_hooks=[
+                        GirderUploadToItem(str(item['_id']), delete_file=True, upload_kwargs={
+                            'reference': json.dumps({'isHistogram': True, 'fakeId': histogram['fakeId']})})
+                        for item, _, histogram in chunk])
+            except Exception:
+                for _, _, histogram in chunk:
+                    self.updateBatchJobs(histogram, success=False)
+                    self.remove(histogram)
+                raise
+            self._recordJob([histogram for _, _, histogram in chunk], result)
+        return Job().load(batchJob['_id'], force=True), histograms
+
+    def createHistogramVariantsJob(self, item, file_, variants, user=None,
+                                   token=None, notify=False, cache=True,
+                                   fileFormat=None):
+        """
+        Start a single job to compute several histograms of a file, so that
+        the image is only read once.  Each histogram is uploaded as its own
+        file.
+
+        :param variants: a list of dictionaries with bins, label, and bitmask
+            values.  Missing values default as for createHistogramJob.
+        :returns: a list of histogram documents in the same order as
+            variants.
+        """
+        if fileFormat is None:
+            fileFormat = Setting().get(PluginSettings.FORMAT)
+        histograms = []
+        pending = []
+        for variant in variants:
+            histogram, isNew = self._reserveHistogram(
+                item, file_, user=user, notify=notify,
+                bins=variant.get('bins'), label=variant.get('label', False),
+                bitmask=variant.get('bitmask', False), cache=cache,
+                fileFormat=fileFormat)
+            histograms.append(histogram)
+            if isNew:
+                pending.append(histogram)
+        if not pending:
+            return histograms
+
+        other_fields = {
+            'meta': {
+                'creator': 'histogram',
+                'task': 'createHistogramVariants',
+                'fakeIds': [histogram['fakeId'] for histogram in pending],
+            }
+        }
+        workers = Setting().get(PluginSettings.WORKERS)
+        try:
+            result = histogramExecutor.delay(
+                self._sourceFileInput(file_), None, None, None,
+                workers=workers, fileFormat=fileFormat,
+                variants=[{
+                    'bins': histogram['bins'],
+                    'label': histogram['label'],
+                    'bitmask': histogram['bitmask'],
+                } for histogram in pending],
+                girder_job_title='Histogram computation for item %s' % item['_id'],
+                girder_job_type='histogram',
+                girder_job_other_fields=other_fields,
+                girder_result_hooks=[
+                    GirderUploadToItem(str(item['_id']), delete_file=True, upload_kwargs={
+                        'reference': json.dumps({'isHistogram': True, 'fakeId': histogram['fakeId']})})
+                    for histogram in pending])
+        except Exception:
+            for histogram in pending:
+                self.remove(histogram)
+            raise
+        self._recordJob(pending, result)
+        return histograms
+
+    def _recordJob(self, histograms, result):
+        """
+        Record the job computing histograms, so that they can be found by
+        jobId.
+
+        :param histograms: the histogram documents.  They are updated in
+            place.
+        :param result: the result of starting the task.
+        """
+        job = getattr(result, 'job', None)
+        if not job:
+            return
+        self.collection.update_many(
+            {'_id': {'$in': [histogram['_id'] for histogram in histograms]}},
+            {'$set': {'jobId': job['_id']}})
+        for histogram in histograms:
+            histogram['jobId'] = job['_id']
+
+    def updateBatchJobs(self, histogram, success=True, batchJobs=None):
+        """
+        Record that a histogram in one or more batch requests has been
+        computed or has failed, and update the progress of the batch jobs.
+
+        :param histogram: the histogram document.
+        :param success: whether the histogram was computed.
+        :param batchJobs: the batch jobs to update.  Defaults to the batch
+            jobs listed on the histogram.
+        """
+        if batchJobs is None:
+            batchJobs = [{'_id': batchJobId}
+                         for batchJobId in histogram.get('batchJobIds', [])]
+        for batchJob in batchJobs:
+            batchJob = Job().collection.find_one_and_update(
+                {'_id': batchJob['_id']},
+                {'$inc': {'meta.completed': 1, 'meta.failed': 0 if success else 1}},
+                return_document=ReturnDocument.AFTER)
+            if not batchJob or batchJob['status'] != JobStatus.RUNNING:
+                continue
+            meta = batchJob['meta']
+            status = None
+            if meta['completed'] >= batchJob['progress']['total']:
+                status = JobStatus.ERROR if meta['failed'] else JobStatus.SUCCESS
+            Job().updateJob(
+                batchJob, status=status, progressCurrent=meta['completed'],
+                progressMessage='%d of %d histograms computed, %d failed' % (
+                    meta['completed'] - meta['failed'],
+                    batchJob['progress']['total'], meta['failed']))
+
     def validate(self, histogram):
         return histogram
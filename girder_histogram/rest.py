@@ -25,16 +25,21 @@ from bson.objectid import ObjectId
 
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import filtermodel, Resource
-from girder.constants import AccessType, TokenScope
+from girder.api.rest import filtermodel, Resource, setRawResponse, \
+    setResponseHeader
+from girder.constants import AccessType, SortDir, TokenScope
 from girder.exceptions import RestException
 from girder.models.file import File
+from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.setting import Setting
-# from girder_jobs.models.job import Job
+from girder_jobs.models.job import Job
 
 from .constants import PluginSettings
+from .models.aggregate import HistogramAggregate
 from .models.histogram import Histogram
+from histogram import formats, operations
+from histogram.histogram import FLOAT_METHODS
 
 
 class HistogramResource(Resource):
@@ -45,11 +50,21 @@ class HistogramResource(Resource):
 
         self.route('GET', (), self.find)
         self.route('POST', (), self.createHistogram)
+        self.route('POST', ('batch',), self.createHistograms)
+        self.route('POST', ('variants',), self.createHistogramVariants)
         self.route('DELETE', (':id',), self.deleteHistogram)
         self.route('GET', (':id',), self.getHistogram)
+        self.route('GET', (':id', 'download'), self.downloadHistogram)
+        self.route('GET', (':id', 'data'), self.getHistogramData)
+        self.route('GET', (':id', 'quantiles'), self.getHistogramQuantiles)
+        self.route('GET', (':id', 'rebin'), self.rebinHistogram)
+        self.route('GET', (':id', 'region'), self.getHistogramRegion)
         self.route('GET', (':id', 'access'), self.getHistogramAccess)
         self.route('PUT', (':id', 'access'), self.updateHistogramAccess)
         self.route('GET', ('settings',), self.getSettings)
+        self.route('GET', ('aggregate',), self.getAggregate)
+        self.route('GET', ('metrics',), self.getMetrics)
+        self.route('DELETE', ('cache',), self.evictCache)
 
         self.histogram = Histogram()
 
@@ -89,12 +104,9 @@ class HistogramResource(Resource):
             query['jobId'] = ObjectId(jobId)
         if fileId is not None:
             query['fileId'] = ObjectId(fileId)
-        return list(self.histogram.filterResultsByPermission(
-            cursor=self.histogram.find(query, sort=sort),
-            user=user,
-            level=AccessType.READ,
-            limit=limit, offset=offset
-        ))
+        return list(self.histogram.findWithPermissions(
+            query, sort=sort, user=user, level=AccessType.READ,
+            limit=limit, offset=offset))
 
     @access.user(scope=TokenScope.DATA_WRITE)
     # @filtermodel(model='job', plugin='jobs')
@@ -114,24 +126,42 @@ class HistogramResource(Resource):
                required=False, dataType='boolean', default=False)
         .param('bitmask', 'Image label values are bitmasks',
                required=False, dataType='boolean', default=False)
+        .param('cache', 'Reuse an existing histogram of a file with the same '
+               'contents and parameters instead of computing a new one',
+               required=False, dataType='boolean', default=True)
+        .param('format', 'File format of the histogram.  Defaults to the '
+               'histogram.format setting.', required=False,
+               enum=formats.FORMATS)
+        .param('approximate', 'While the histogram is computed, store an '
+               'approximate histogram computed from a low resolution level '
+               'of the image.  It is available from the data endpoint and '
+               'is replaced when the full resolution histogram is done.',
+               required=False, dataType='boolean', default=False)
+        .param('frames', 'Also store the histogram of each frame of '
+               'multi-frame images (e.g., z-stacks and time series).  The '
+               'histogram itself always counts every frame.',
+               required=False, dataType='boolean', default=False)
+        .param('floatMethod', 'Count float and wide integer images in a '
+               'single pass.  "range" finds the range of the values from '
+               'the file\'s metadata or a low resolution level, widening the '
+               'first or last bin for values outside of it.  "sketch" '
+               'counts approximately without knowing the range.  By '
+               'default, these images are read twice and counted exactly.',
+               required=False, enum=FLOAT_METHODS)
+        .param('tiles', 'Also store the histograms of a coarse grid of tiles '
+               'over single channel images, so that the histograms of '
+               'regions can be found quickly.', required=False,
+               dataType='boolean', default=False)
     )
-    def createHistogram(self, item, fileId, notify, bins, label, bitmask):
+    def createHistogram(self, item, fileId, notify, bins, label, bitmask,
+                        cache, format, approximate, frames, floatMethod,
+                        tiles):
         user = self.getCurrentUser()
         token = self.getCurrentToken()
         if fileId is None:
-            # files = list(Item().childFiles(item=item, limit=2))
-            query = {
-                'itemId': item['_id'],
-                # 'mimeType': {'$regex': '^image/tiff'}
-                # query should find the same file(tiff) used for creating histogram
-                # but this will always find most recent json histogram
-                '$or': [{'mimeType': {'$regex': '^image/'}},
-                        {'mimeType': 'application/octet-stream'},
-                        {'exts': ['tif']}],
-            }
-            files = list(File().find(query, limit=2))
-            if len(files) >= 1:
-                fileId = str(files[0]['_id'])
+            file_ = self.histogram.findSourceFiles([item]).get(item['_id'])
+            if file_:
+                fileId = str(file_['_id'])
         if not fileId:
             raise RestException('Missing "fileId" parameter.')
 
@@ -139,7 +169,182 @@ class HistogramResource(Resource):
         return self.histogram.createHistogramJob(item, file_, user=user,
                                                  token=token, notify=notify,
                                                  bins=bins, label=label,
-                                                 bitmask=bitmask)
+                                                 bitmask=bitmask, cache=cache,
+                                                 fileFormat=format,
+                                                 approximate=approximate,
+                                                 frames=frames,
+                                                 floatMethod=floatMethod,
+                                                 tiles=tiles)
+
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Create histograms for the items in a folder or a list of '
+                    'items.')
+        .notes('The source image of each item is found as for a single '
+               'histogram.  Items without an image are skipped.  The '
+               'returned batch job reports the progress of all of the '
+               'histograms.')
+        .modelParam('folderId', 'The folder containing the source items.',
+                    paramType='formData', model=Folder, level=AccessType.WRITE,
+                    required=False)
+        .jsonParam('itemIds', 'A JSON list of source item IDs.',
+                   paramType='formData', requireArray=True, required=False)
+        .param('notify', 'Trigger a notification when each histogram is '
+               'completed', required=False, dataType='boolean', default=False)
+        .param('bins', 'Number of bins in the histogram', required=False,
+               dataType='integer')
+        .param('label', 'Image is a label (ignore zero values)',
+               required=False, dataType='boolean', default=False)
+        .param('bitmask', 'Image label values are bitmasks',
+               required=False, dataType='boolean', default=False)
+        .param('cache', 'Reuse existing histograms of files with the same '
+               'contents and parameters', required=False, dataType='boolean',
+               default=True)
+        .param('format', 'File format of the histograms.  Defaults to the '
+               'histogram.format setting.', required=False,
+               enum=formats.FORMATS)
+        .param('chunkSize', 'Maximum number of images per worker job.  0 '
+               'submits all of them as one job.', required=False,
+               dataType='integer', default=0)
+        .errorResponse('Write access was denied for the folder or an item.', 403)
+    )
+    def createHistograms(self, folder, itemIds, notify, bins, label, bitmask,
+                         cache, format, chunkSize):
+        user = self.getCurrentUser()
+        if (folder is None) == (itemIds is None):
+            raise RestException('Exactly one of "folderId" and "itemIds" must '
+                                'be specified.')
+        if folder is not None:
+            items = list(Item().find({'folderId': folder['_id']},
+                                     sort=[('_id', SortDir.ASCENDING)]))
+        else:
+            try:
+                ids = [ObjectId(itemId) for itemId in itemIds]
+            except Exception:
+                raise RestException('Invalid item ID in "itemIds".')
+            items = list(Item().filterResultsByPermission(
+                Item().find({'_id': {'$in': ids}}), user, AccessType.WRITE))
+            if len(items) != len(set(ids)):
+                raise RestException('Items were not found or write access '
+                                    'was denied.', code=403)
+        job, histograms = self.histogram.createHistogramJobs(
+            items, user=user, token=self.getCurrentToken(), notify=notify,
+            bins=bins, label=label, bitmask=bitmask, cache=cache,
+            fileFormat=format, chunkSize=max(chunkSize, 0))
+        return {
+            'job': Job().filter(job, user),
+            'histograms': [self.histogram.filter(histogram, user)
+                           for histogram in histograms],
+        }
+
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @filtermodel(Histogram)
+    @autoDescribeRoute(
+        Description('Create several histograms of an item with different '
+                    'parameters.')
+        .notes('The histograms are computed by one job that reads the image '
+               'once.  Histograms that are cached or already being computed '
+               'are reused.')
+        .modelParam('itemId', 'The ID of the source item.',
+                    paramType='formData', model=Item, level=AccessType.WRITE)
+        .param('fileId', 'The ID of the source file.', required=False)
+        .jsonParam('variants', 'A JSON list of objects with "bins", "label", '
+                   'and "bitmask" values, e.g. [{"bins": 256}, '
+                   '{"label": true}, {"bitmask": true}].',
+                   paramType='formData', requireArray=True)
+        .param('notify', 'Trigger a notification when each histogram is '
+               'completed', required=False, dataType='boolean', default=False)
+        .param('cache', 'Reuse existing histograms of files with the same '
+               'contents and parameters', required=False, dataType='boolean',
+               default=True)
+        .param('format', 'File format of the histograms.  Defaults to the '
+               'histogram.format setting.', required=False,
+               enum=formats.FORMATS)
+    )
+    def createHistogramVariants(self, item, fileId, variants, notify, cache,
+                                format):
+        user = self.getCurrentUser()
+        if not variants:
+            raise RestException('"variants" must not be empty.')
+        for variant in variants:
+            if (not isinstance(variant, dict) or
+                    set(variant) - {'bins', 'label', 'bitmask'}):
+                raise RestException('Each variant must be an object with '
+                                    '"bins", "label", and "bitmask" values.')
+            bins = variant.get('bins')
+            if bins is not None and (not isinstance(bins, int) or
+                                     isinstance(bins, bool) or bins < 1):
+                raise RestException('"bins" must be a positive integer.')
+            if not all(isinstance(variant.get(key, False), bool)
+                       for key in ('label', 'bitmask')):
+                raise RestException('"label" and "bitmask" must be booleans.')
+        if fileId is None:
+            file_ = self.histogram.findSourceFiles([item]).get(item['_id'])
+            if file_:
+                fileId = str(file_['_id'])
+        if not fileId:
+            raise RestException('Missing "fileId" parameter.')
+
+        file_ = File().load(fileId, user=user, level=AccessType.READ, exc=True)
+        return self.histogram.createHistogramVariantsJob(
+            item, file_, variants, user=user, token=self.getCurrentToken(),
+            notify=notify, cache=cache, fileFormat=format)
+
+    @access.user(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the combined histogram of the items in a folder.')
+        .notes('The most recent completed histogram of each item with the '
+               'given parameters is included.  Histograms with different bin '
+               'edges are re-binned.  The result is cached until the '
+               'histograms in the folder change.')
+        .modelParam('folderId', 'The folder containing the items.',
+                    model=Folder, level=AccessType.READ, paramType='query')
+        .param('bins', 'Number of bins in the histograms', required=False,
+               dataType='integer')
+        .param('label', 'Combine histograms of label images',
+               required=False, dataType='boolean', default=False)
+        .param('bitmask', 'Combine histograms of bitmask values',
+               required=False, dataType='boolean', default=False)
+        .param('floatMethod', 'Combine histograms counted in a single pass '
+               'with this method.  By default, only exact histograms are '
+               'combined.', required=False, enum=FLOAT_METHODS)
+        .errorResponse('Read access was denied for the folder.', 403)
+    )
+    def getAggregate(self, folder, bins, label, bitmask, floatMethod):
+        aggregate = HistogramAggregate().aggregateFolder(
+            folder, bins=bins, label=label, bitmask=bitmask,
+            floatMethod=floatMethod)
+        data = HistogramAggregate().getData(aggregate)
+        if data is None:
+            raise RestException('No items in the folder have a matching '
+                                'histogram.', code=404)
+        return formats.toJSON(data)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Stop reusing existing histograms for new requests.')
+        .notes('Histograms are kept, but new requests for the same file '
+               'contents and parameters will compute a new histogram.')
+        .modelParam('fileId', 'Only evict histograms of files with the same '
+                    'contents as this file.', model=File, level=AccessType.READ,
+                    paramType='query', required=False)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def evictCache(self, file):
+        return {'evicted': self.histogram.evictCached(file)}
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Summarize the timings of recent histogram jobs.')
+        .notes('Phases are in seconds.  Each phase and counter has its '
+               'count, total, mean, maximum, and 50th, 90th, and 99th '
+               'percentiles over the histograms.')
+        .param('limit', 'The number of most recent histograms to summarize.',
+               required=False, dataType='integer', default=1000)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getMetrics(self, limit):
+        return self.histogram.getMetrics(limit)
 
     @access.user(scope=TokenScope.DATA_OWN)
     @filtermodel(Histogram)
@@ -164,6 +369,145 @@ class HistogramResource(Resource):
     def getHistogram(self, histogram):
         return histogram
 
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Download the file containing a histogram.')
+        .notes('The file is served as stored, in the format given by the '
+               'histogram\'s format field.')
+        .modelParam('id', model=Histogram, level=AccessType.READ)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the histogram.', 403)
+        .errorResponse('The histogram has not been computed yet.', 404)
+    )
+    def downloadHistogram(self, histogram):
+        if not histogram.get('fileId'):
+            raise RestException('The histogram has not been computed yet.',
+                                code=404)
+        file_ = File().load(histogram['fileId'], force=True, exc=True)
+        return File().download(file_)
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Get the contents of a histogram.')
+        .notes('Small histograms are stored in the histogram document, so '
+               'this does not need to read the histogram file.')
+        .modelParam('id', model=Histogram, level=AccessType.READ)
+        .param('format', 'Return JSON or the packed binary format.',
+               required=False, default='json', enum=formats.FORMATS)
+        .param('frame', 'Get the histogram of one frame of a histogram '
+               'computed with frames.', required=False, dataType='integer')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the histogram.', 403)
+        .errorResponse('The histogram has not been computed yet.', 404)
+    )
+    def getHistogramData(self, histogram, format, frame):
+        try:
+            data = self.histogram.getData(histogram, frame)
+        except ValueError as exc:
+            raise RestException(str(exc))
+        if data is None:
+            raise RestException('The histogram has not been computed yet.',
+                                code=404)
+        if format == 'json':
+            return formats.toJSON(data)
+        setResponseHeader('Content-Type', formats.MIME_TYPES[format])
+        setRawResponse()
+        return formats.dumps(data, format)
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Get the values below which fractions of the pixels of a '
+                    'histogram fall, e.g., for auto-contrast limits.')
+        .notes('Values are interpolated within bins.  Multi-channel '
+               'histograms return values for each channel.')
+        .modelParam('id', model=Histogram, level=AccessType.READ)
+        .param('q', 'A comma-separated list of fractions between 0 and 1.',
+               default='0.02,0.98', required=False)
+        .param('frame', 'Use the histogram of one frame of a histogram '
+               'computed with frames.', required=False, dataType='integer')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the histogram.', 403)
+        .errorResponse('The histogram has not been computed yet.', 404)
+    )
+    def getHistogramQuantiles(self, histogram, q, frame):
+        try:
+            q = [float(value) for value in q.split(',')]
+        except ValueError:
+            raise RestException('"q" must be a comma-separated list of '
+                                'numbers.')
+        if not all(0 <= value <= 1 for value in q):
+            raise RestException('"q" values must be between 0 and 1.')
+        try:
+            quantiles = self.histogram.getQuantiles(histogram, q, frame)
+        except ValueError as exc:
+            raise RestException(str(exc))
+        if quantiles is None:
+            raise RestException('The histogram has not been computed yet.',
+                                code=404)
+        return quantiles
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Get the histogram of a region of the source image.')
+        .notes('The histogram must have been computed with tiles.  The '
+               'counts of the tiles inside the region are summed, and only '
+               'the pixels at its edges are read, so the source file must be '
+               'in a filesystem assetstore.  The region is clipped to the '
+               'image.')
+        .modelParam('id', model=Histogram, level=AccessType.READ)
+        .param('left', 'The left edge of the region in pixels.',
+               dataType='integer')
+        .param('top', 'The top edge of the region in pixels.',
+               dataType='integer')
+        .param('right', 'The right edge of the region in pixels (exclusive).',
+               dataType='integer')
+        .param('bottom', 'The bottom edge of the region in pixels '
+               '(exclusive).', dataType='integer')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the histogram.', 403)
+        .errorResponse('The histogram has not been computed yet.', 404)
+    )
+    def getHistogramRegion(self, histogram, left, top, right, bottom):
+        try:
+            data = self.histogram.getRegion(
+                histogram, left, top, right, bottom)
+        except ValueError as exc:
+            raise RestException(str(exc))
+        if data is None:
+            raise RestException('The histogram has not been computed yet.',
+                                code=404)
+        return formats.toJSON(data)
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Get a histogram with different bins, computed from the '
+                    'stored histogram.')
+        .notes('Histograms of integer images with one value per bin are '
+               're-binned exactly.  Otherwise, pixels are assumed to be '
+               'spread evenly within each bin.')
+        .modelParam('id', model=Histogram, level=AccessType.READ)
+        .param('bins', 'Number of bins', dataType='integer')
+        .param('min', 'The lower edge of the bins.  Defaults to the lowest '
+               'value in the histogram.', required=False, dataType='number')
+        .param('max', 'The upper edge of the bins.  Defaults to the highest '
+               'value in the histogram.', required=False, dataType='number')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the histogram.', 403)
+        .errorResponse('The histogram has not been computed yet.', 404)
+    )
+    def rebinHistogram(self, histogram, bins, min, max):
+        if bins < 1:
+            raise RestException('"bins" must be positive.')
+        data = self.histogram.getData(histogram)
+        if data is None:
+            raise RestException('The histogram has not been computed yet.',
+                                code=404)
+        try:
+            return formats.toJSON(
+                operations.rebinHistogram(data, bins, min, max))
+        except ValueError as exc:
+            raise RestException(str(exc))
+
     @access.user(scope=TokenScope.DATA_OWN)
     @filtermodel(Histogram)
     @autoDescribeRoute(
@@ -179,6 +523,8 @@ class HistogramResource(Resource):
     @filtermodel(Histogram)
     @autoDescribeRoute(
         Description('Update the access control list for a histogram.')
+        .notes('The histogram keeps this access instead of following the '
+               'access of its item\'s folder.')
         .responseClass(Histogram)
         .modelParam('id', model=Histogram, level=AccessType.ADMIN)
         .jsonParam('access', 'The JSON-encoded access control list.')
@@ -188,9 +534,8 @@ class HistogramResource(Resource):
         .errorResponse('Admin access was denied for the histogram.', 403)
     )
     def updateHistogramAccess(self, histogram, access, public):
-        self.histogram.setPublic(histogram, public)
-        return self.histogram.setAccessList(histogram, access, save=True,
-                                            user=self.getCurrentUser())
+        return self.histogram.setExplicitAccess(
+            histogram, access, public, user=self.getCurrentUser())
 
     @access.public
     @autoDescribeRoute(
@@ -201,4 +546,12 @@ class HistogramResource(Resource):
         return {
             PluginSettings.DEFAULT_BINS:
                 settings.get(PluginSettings.DEFAULT_BINS),
+            PluginSettings.WORKERS:
+                settings.get(PluginSettings.WORKERS),
+            PluginSettings.FORMAT:
+                settings.get(PluginSettings.FORMAT),
+            PluginSettings.INLINE_SIZE:
+                settings.get(PluginSettings.INLINE_SIZE),
+            PluginSettings.UPLOAD_THREADS:
+                settings.get(PluginSettings.UPLOAD_THREADS),
         }
@@ -1,4 +1,58 @@
+import $ from 'jquery';
+import _ from 'underscore';
+
 import Model from '@girder/core/models/Model';
+import { getCurrentToken } from '@girder/core/auth';
+import { getApiRoot, restRequest } from '@girder/core/rest';
+
+/**
+ * Typed arrays for the numpy dtypes of arrays in binary histograms.  64-bit
+ * integers are converted to numbers when they are read.
+ */
+var ARRAY_TYPES = {
+    '<f8': Float64Array,
+    '<f4': Float32Array,
+    '<i8': BigInt64Array,
+    '<u8': BigUint64Array,
+    '<i4': Int32Array,
+    '<u4': Uint32Array,
+    '<i2': Int16Array,
+    '<u2': Uint16Array,
+    '|i1': Int8Array,
+    '|u1': Uint8Array,
+    '|b1': Uint8Array
+};
+
+/**
+ * Decode a histogram file in the binary format: the bytes 'HIST', a
+ * little-endian uint32 header length, a JSON header, and little-endian
+ * arrays referenced from the header as {$array: {offset, shape, dtype}}.
+ */
+function parseBinaryHistogram(buffer) {
+    var headerLength = new DataView(buffer).getUint32(4, true);
+    var header = JSON.parse(new TextDecoder().decode(
+        new Uint8Array(buffer, 8, headerLength)));
+    var dataStart = 8 + headerLength;
+    var restore = function (value) {
+        if (_.isArray(value)) {
+            return _.map(value, restore);
+        }
+        if (_.isObject(value)) {
+            if (_.keys(value).length === 1 && value.$array) {
+                var length = _.reduce(value.$array.shape, (a, b) => a * b, 1);
+                var ArrayType = ARRAY_TYPES[value.$array.dtype];
+                if (!ArrayType) {
+                    throw new Error('Unknown array dtype: ' + value.$array.dtype);
+                }
+                return Array.from(new ArrayType(
+                    buffer, dataStart + value.$array.offset, length), Number);
+            }
+            return _.mapObject(value, restore);
+        }
+        return value;
+    };
+    return restore(header);
+}
 
 var HistogramModel = Model.extend({
     resourceName: 'histogram',
@@ -8,7 +62,59 @@ var HistogramModel = Model.extend({
         bins: null,
         label: null,
         loading: false,
-        bitmask: false
+        bitmask: false,
+        format: 'json'
+    },
+
+    /**
+     * Get the histogram contents in a single request.  Histograms stored in
+     * the binary format are also transferred in that format.
+     *
+     * @returns {Promise} resolved with the histogram contents.
+     */
+    fetchData: function () {
+        var url = `histogram/${this.id}/data`;
+        if (this.get('format') === 'binary') {
+            var deferred = $.Deferred();
+            var xhr = new XMLHttpRequest();
+            xhr.open('GET', `${getApiRoot()}/${url}?format=binary`);
+            xhr.responseType = 'arraybuffer';
+            if (getCurrentToken()) {
+                xhr.setRequestHeader('Girder-Token', getCurrentToken());
+            }
+            xhr.onload = () => {
+                if (xhr.status === 200) {
+                    deferred.resolve(parseBinaryHistogram(xhr.response));
+                } else {
+                    deferred.reject(xhr);
+                }
+            };
+            xhr.onerror = () => deferred.reject(xhr);
+            xhr.send();
+            return deferred.promise();
+        }
+        return restRequest({
+            url: url,
+            method: 'GET',
+            error: null
+        });
+    },
+
+    /**
+     * Get the values below which fractions of the pixels fall, e.g., [0.02,
+     * 0.98] for auto-contrast limits, without fetching the histogram.
+     *
+     * @param {number[]} q fractions between 0 and 1.
+     * @returns {Promise} resolved with {q, values} or, for multi-channel
+     *      histograms, {q, channels}.
+     */
+    fetchQuantiles: function (q) {
+        return restRequest({
+            url: `histogram/${this.id}/quantiles`,
+            method: 'GET',
+            data: {q: q.join(',')},
+            error: null
+        });
     }
 });
 
@@ -16,6 +16,18 @@ var ConfigView = View.extend({
             this._saveSettings([{
                 key: 'histogram.default_bins',
                 value: this.$('#g-histogram-settings-default-bins').val()
+            }, {
+                key: 'histogram.workers',
+                value: this.$('#g-histogram-settings-workers').val()
+            }, {
+                key: 'histogram.format',
+                value: this.$('#g-histogram-settings-format').val()
+            }, {
+                key: 'histogram.inline_size',
+                value: this.$('#g-histogram-settings-inline-size').val()
+            }, {
+                key: 'histogram.upload_threads',
+                value: this.$('#g-histogram-settings-upload-threads').val()
             }]);
         }
     },
@@ -3,7 +3,6 @@ import _ from 'underscore';
 import eventStream from '@girder/core/utilities/EventStream';
 import View from '@girder/core/views/View';
 import events from '@girder/core/events';
-import { restRequest } from '@girder/core/rest';
 
 import histogramWidget from '../../templates/widgets/histogramWidget.pug';
 import '../../stylesheets/widgets/histogramWidget.styl';
@@ -12,7 +11,8 @@ import RangeSliderWidget from './rangeSliderWidget';
 
 var HistogramWidget = View.extend({
     events: {
-        'click .g-histogram-bar': '_onHistogramBar'
+        'click .g-histogram-bar': '_onHistogramBar',
+        'change .g-histogram-channel': '_onChannel'
     },
 
     initialize: function (settings) {
@@ -23,6 +23,15 @@ var HistogramWidget = View.extend({
 
         this.threshold = settings.threshold;
 
+        // Fractions of the pixels, e.g., [0.02, 0.98], to set the initial
+        // range from when no threshold is given.  The quantiles are computed
+        // on the server.
+        this.autoRange = settings.autoRange;
+
+        // The channel of multi-channel (e.g., RGB) histograms to show.
+        // Defaults to the first channel.
+        this.channel = settings.channel;
+
         this.listenTo(this.model, 'change:fileId', this._getHistogramFile);
         // TODO: filter on event data
         this.listenTo(
@@ -70,22 +79,17 @@ var HistogramWidget = View.extend({
     },
 
     /**
-     * Get the histogram file, load JSON contents, and render
+     * Get the histogram file, decode its contents, and render
      */
     _getHistogramFile: function (model, fileId) {
         if (fileId) {
-            return restRequest({
-                url: `file/${fileId}/download`,
-                method: 'GET',
-                error: null
-            }).done((resp) => {
-                // dev server resp as string for some reason
-                if (typeof(resp) === 'string') {
-                    resp = JSON.parse(resp);
-                }
+            return this.model.fetchData().done((resp) => {
                 this.histogram = resp;
                 this.status = null;
                 this.render();
+                if (this.autoRange && !this.threshold) {
+                    this._setAutoRange();
+                }
             }).fail(this._error);
         } else {
             this.histogram = undefined;
@@ -94,6 +98,65 @@ var HistogramWidget = View.extend({
         }
     },
 
+    /**
+     * Get the names of the channels of a multi-channel histogram, or an empty
+     * list for single channel histograms.
+     */
+    _channels: function () {
+        return this.histogram && this.histogram.channels ?
+            _.keys(this.histogram.channels) : [];
+    },
+
+    /**
+     * Get the hist and binEdges of the histogram, or of the selected channel
+     * of a multi-channel histogram.
+     */
+    _entry: function () {
+        var channels = this._channels();
+        if (!channels.length) {
+            return this.histogram;
+        }
+        if (!_.contains(channels, this.channel)) {
+            this.channel = channels[0];
+        }
+        return this.histogram.channels[this.channel];
+    },
+
+    _onChannel: function (evt) {
+        this.channel = $(evt.target).val();
+        this.render();
+        this.trigger('h:channel', {channel: this.channel});
+    },
+
+    /**
+     * Set the range to the bins containing the autoRange quantiles of the
+     * histogram, as found by the server.  Multi-channel histograms use the
+     * quantiles of the selected channel.
+     */
+    _setAutoRange: function () {
+        return this.model.fetchQuantiles(this.autoRange).done((resp) => {
+            var entry = this._entry();
+            var values = resp.values || (resp.channels || {})[this.channel];
+            if (!values || !entry || this.threshold) {
+                return;
+            }
+            var binEdges = entry.binEdges;
+            var last = entry.hist.length - 1;
+            var min = _.sortedIndex(binEdges, values[0]);
+            if (min >= binEdges.length || binEdges[min] > values[0]) {
+                min -= 1;
+            }
+            var max = Math.min(_.sortedIndex(binEdges, values[1]), last);
+            min = Math.max(0, Math.min(min, max));
+            this.threshold = {min: binEdges[min], max: binEdges[max]};
+            this.render();
+            this.trigger('h:range', {
+                range: this.threshold,
+                bins: {min: min, max: max}
+            });
+        });
+    },
+
     /**
      * Fetch the histogram model, and if not found save the model to create a
      * histogram job. fileId will be updated with the histogram file containing
@@ -157,9 +220,10 @@ var HistogramWidget = View.extend({
         var height = this.$el.height() || 0;
         // debugger
         var hist = [], binEdges;
-        if (this.histogram) {
-            hist = this.histogram.hist;
-            binEdges = this.histogram.binEdges;
+        var entry = this.histogram ? this._entry() : undefined;
+        if (entry) {
+            hist = entry.hist;
+            binEdges = entry.binEdges;
         }
 
         this.$('[data-toggle="tooltip"]').tooltip('destroy');
@@ -172,7 +236,9 @@ var HistogramWidget = View.extend({
             height: height,
             excludedBins: this.excludedBins,
             colormap: this.colormap,
-            label: this.model.get('label')
+            label: this.model.get('label'),
+            channels: this._channels(),
+            channel: this.channel
         }));
         if (this._rangeSliderView) {
             this.stopListening(this._rangeSliderView);
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Worker-local caches, so that repeated tasks on the same image skip both
+downloading and decoding it.
+
+Source files are cached on disk and shared by the worker processes on a
+machine.  Decoded pixels are cached in memory by each worker process, which
+handles many tasks.  The sizes are set with environment variables, in bytes;
+0 disables a cache.  HISTOGRAM_DECODED_CACHE_SIZE is a limit for each worker
+process, so a machine running several worker processes can use that much
+memory in each of them.  By default, it is small enough that one worker
+process per CPU uses at most a quarter of the machine's memory.
+"""
+
+import collections
+import os
+import re
+import tempfile
+import threading
+import time
+
+from girder_worker_utils.transforms.contrib.girder_io import \
+    GirderFileIdAllowDirect
+
+
+SOURCE_CACHE_SIZE = int(os.environ.get(
+    'HISTOGRAM_SOURCE_CACHE_SIZE', 10 * 1024 ** 3))
+
+# The largest default size of the decoded pixel cache of a worker process.
+DECODED_CACHE_DEFAULT = 512 * 1024 ** 2
+
+# By default, the decoded pixel caches of one worker process per CPU use at
+# most this fraction of the machine's memory.
+DECODED_CACHE_MEMORY_FRACTION = 0.25
+
+
+def _defaultDecodedCacheSize():
+    """
+    Get the default size of the decoded pixel cache of a worker process.
+
+    :returns: a size in bytes.
+    """
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return DECODED_CACHE_DEFAULT
+    return min(DECODED_CACHE_DEFAULT, int(
+        memory * DECODED_CACHE_MEMORY_FRACTION / (os.cpu_count() or 1)))
+
+
+# Per worker process, not per machine.
+DECODED_CACHE_SIZE = int(os.environ.get(
+    'HISTOGRAM_DECODED_CACHE_SIZE', _defaultDecodedCacheSize()))
+
+CACHE_DIR = os.environ.get('HISTOGRAM_CACHE_DIR') or os.path.join(
+    tempfile.gettempdir(), 'histogram_cache')
+
+# Cached files used more recently than this many seconds ago are not evicted,
+# since another task may be about to open them.
+EVICTION_GRACE = 60
+
+# How long it took to provide each source file path, in seconds, until the
+# task using it takes the time with popFetchTime.
+_fetchTimes = {}
+
+
+class SourceCache(object):
+    """
+    A size-bounded, least recently used cache of downloaded files in a
+    directory.  The access time of each file records when it was last used.
+    """
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+
+    def _path(self, fileId, modified, ext):
+        modified = re.sub('[^0-9]', '', str(modified or ''))
+        return os.path.join(self.directory, '%s-%s%s' % (
+            fileId, modified, ext))
+
+    def fetch(self, fileId, modified, ext, download):
+        """
+        Get the path of a cached file, downloading it if it isn't cached.
+
+        :param fileId: the Girder file ID.
+        :param modified: when the file was last changed.  Files with the same
+            ID and a different modification time are downloaded again.
+        :param ext: the extension to give the cached file.
+        :param download: a function taking the file ID and a path to download
+            the file to.
+        :returns: the path of the cached file.
+        """
+        path = self._path(fileId, modified, ext)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            pass
+        else:
+            # Keep the modification time so that decoded pixels stay cached
+            os.utime(path, (time.time(), stat.st_mtime))
+            return path
+        os.makedirs(self.directory, exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=self.directory, suffix='.partial')
+        os.close(fd)
+        try:
+            download(fileId, partial)
+            os.replace(partial, path)
+        except Exception:
+            try:
+                os.unlink(partial)
+            except OSError:
+                pass
+            raise
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits its size.
+
+        :param keep: a path not to remove.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.partial'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        now = time.time()
+        for atime, size, path in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if path == keep or now - atime < EVICTION_GRACE:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class DecodedCache(object):
+    """
+    A size-bounded, least recently used cache of the decoded pixels of
+    images, as lists of numpy arrays.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def key(self, path, *args):
+        """
+        Get the key for a file that changes when the file does.
+
+        :param args: other values that affect how the file is decoded.
+        """
+        stat = os.stat(path)
+        return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size) + args
+
+    def get(self, key):
+        """
+        Get a chunks function for cached pixels.
+
+        :returns: a function like histogram._imageChunks returns, or None.
+        """
+        with self._lock:
+            arrays = self._entries.get(key)
+            if arrays is None:
+                return None
+            self._entries.move_to_end(key)
+
+        def chunks(part=0, parts=1):
+            if len(arrays) == 1:
+                array = arrays[0]
+                return iter([array[len(array) * part // parts:
+                                   len(array) * (part + 1) // parts]])
+            return iter(arrays[len(arrays) * part // parts:
+                               len(arrays) * (part + 1) // parts])
+        return chunks
+
+    def _add(self, key, arrays):
+        size = sum(array.nbytes for array in arrays)
+        with self._lock:
+            if key in self._entries or size > self.maxSize:
+                return
+            self._entries[key] = arrays
+            self._size += size
+            while self._size > self.maxSize:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= sum(array.nbytes for array in evicted)
+
+    def record(self, key, chunks):
+        """
+        Wrap a chunks function so that the pixels it reads are cached once
+        every part of the image has been read, if they fit in the cache.
+
+        :param key: the key from the key method.
+        :param chunks: a function like histogram._imageChunks returns.
+        :returns: a function like chunks.
+        """
+        if self.maxSize <= 0:
+            return chunks
+        completedParts = {}
+        lock = threading.Lock()
+
+        def recordedChunks(part=0, parts=1):
+            arrays = []
+            size = 0
+            for array in chunks(part, parts):
+                if arrays is not None:
+                    size += array.nbytes
+                    if size <= self.maxSize:
+                        array.flags.writeable = False
+                        arrays.append(array)
+                    else:
+                        arrays = None
+                yield array
+            if arrays is None:
+                return
+            with lock:
+                completed = completedParts.setdefault(parts, {})
+                completed[part] = arrays
+                if len(completed) < parts:
+                    return
+            self._add(key, [array for index in range(parts)
+                            for array in completed[index]])
+        return recordedChunks
+
+
+sourceFiles = SourceCache(CACHE_DIR, SOURCE_CACHE_SIZE)
+
+decodedChunks = DecodedCache(DECODED_CACHE_SIZE)
+
+
+class GirderFileIdCached(GirderFileIdAllowDirect):
+    """
+    A transform like GirderFileIdAllowDirect that downloads files the worker
+    can't read directly into the worker's source file cache, rather than into
+    a temporary directory.
+
+    :param _id: the ID of the file to download.
+    :param name: the name of the file.  Its extension is preserved.
+    :param local_path: the path of the file in a filesystem assetstore.
+    :param modified: when the file was last changed.
+    """
+    def __init__(self, _id, name='', local_path=None, modified=None,
+                 **kwargs):
+        super(GirderFileIdCached, self).__init__(
+            _id, name, local_path, **kwargs)
+        self.modified = modified
+
+    def transform(self):
+        start = time.perf_counter()
+        if ((self.local_file_path and self._allowDirectPath() and
+                os.path.isfile(self.local_file_path)) or
+                sourceFiles.maxSize <= 0):
+            path = super(GirderFileIdCached, self).transform()
+        else:
+            self.temp_dir_path = None
+            path = self.file_path = sourceFiles.fetch(
+                self.file_id, self.modified,
+                os.path.splitext(self.file_name)[1], self.gc.downloadFile)
+        _fetchTimes[path] = time.perf_counter() - start
+        return path
+
+
+def popFetchTime(path):
+    """
+    Get how long a GirderFileIdCached transform took to download (or find) a
+    source file.
+
+    :param path: the path the transform returned.
+    :returns: the time in seconds, or None if the path didn't come from a
+        transform in this process.
+    """
+    return _fetchTimes.pop(path, None)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Histogram file formats.
+
+A histogram is a dictionary of metadata and numpy arrays, e.g. ``label``,
+``bitmask``, ``bins``, ``hist`` and ``binEdges``.  Histograms of
+multi-channel images have ``channels`` instead of ``hist`` and ``binEdges``,
+with ``hist`` and ``binEdges`` keyed by channel name.  Histograms of stacks
+may also have ``frames``, a list with the same entries for each frame.  The
+tile counts of an image are stored in the same formats, with ``size``,
+``shape``, and a ``hist`` of the counts of each cell of a grid over the
+image.  It can be stored as:
+
+json
+    A JSON object with arrays written as lists.
+
+binary
+    A compact little-endian layout that can be read without parsing the
+    counts::
+
+        bytes 0-3   b'HIST'
+        bytes 4-7   uint32 length of the header
+        header      JSON object, padded with spaces to a multiple of 8 bytes
+        data        arrays in little-endian order, each starting at a
+                    multiple of 8 bytes
+
+    In the header, each array is replaced by
+    ``{"$array": {"offset": <bytes from the start of data>, "shape": [...],
+    "dtype": "<i8"}}``.  Arrays keep their own dtype, so that counts stay
+    exact integers.
+"""
+
+import json
+import struct
+
+import numpy
+
+
+FORMATS = ('json', 'binary')
+
+MIME_TYPES = {
+    'json': 'application/json',
+    'binary': 'application/x-histogram',
+}
+
+EXTENSIONS = {
+    'json': '.json',
+    'binary': '.hist',
+}
+
+MAGIC = b'HIST'
+
+# The dtype of arrays that aren't booleans or numbers.
+ARRAY_DTYPE = '<f8'
+
+
+def _arrayDtype(dtype):
+    """
+    Get the little-endian dtype that an array is stored as.
+    """
+    if dtype.kind in 'biuf':
+        return dtype.newbyteorder('<')
+    return numpy.dtype(ARRAY_DTYPE)
+
+
+def toJSON(value):
+    """
+    Convert the numpy arrays and scalars in a histogram to python types.
+
+    :param value: a histogram or part of one.
+    :returns: a JSON-serializable copy of value.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {key: toJSON(entry) for key, entry in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [toJSON(entry) for entry in value]
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def _extractArrays(value, arrays, offset):
+    if isinstance(value, numpy.ndarray):
+        array = numpy.ascontiguousarray(
+            value, dtype=_arrayDtype(value.dtype))
+        padding = -offset[0] % 8
+        if padding:
+            arrays.append(numpy.zeros(padding, dtype=numpy.uint8))
+            offset[0] += padding
+        arrays.append(array)
+        placeholder = {'$array': {
+            'offset': offset[0],
+            'shape': list(array.shape),
+            'dtype': array.dtype.str,
+        }}
+        offset[0] += array.nbytes
+        return placeholder
+    if isinstance(value, dict):
+        return {key: _extractArrays(entry, arrays, offset)
+                for key, entry in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_extractArrays(entry, arrays, offset) for entry in value]
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def _restoreArrays(value, data):
+    if isinstance(value, dict):
+        if set(value) == {'$array'}:
+            spec = value['$array']
+            dtype = numpy.dtype(spec['dtype'])
+            count = int(numpy.prod(spec['shape']))
+            return numpy.frombuffer(
+                data, dtype=dtype, count=count, offset=spec['offset'],
+            ).reshape(spec['shape'])
+        return {key: _restoreArrays(entry, data)
+                for key, entry in value.items()}
+    if isinstance(value, list):
+        return [_restoreArrays(entry, data) for entry in value]
+    return value
+
+
+def dumps(histogram, fileFormat='json', metadata=None):
+    """
+    Encode a histogram.
+
+    :param histogram: a dictionary which may contain numpy arrays.
+    :param fileFormat: one of FORMATS.
+    :param metadata: a function returning a dictionary of entries without
+        arrays to add to the histogram.  It is called once the arrays have
+        been encoded, so that the entries can describe the encoding, e.g.,
+        how long it took.
+    :returns: the encoded histogram as bytes.
+    """
+    if fileFormat == 'json':
+        encoded = json.dumps(toJSON(histogram))
+        extra = json.dumps(toJSON(metadata())) if metadata else '{}'
+        if extra != '{}':
+            # Both are JSON objects, so the entries can be appended.
+            encoded = encoded[:-1] + (', ' if histogram else '') + extra[1:]
+        return encoded.encode('utf8')
+    if fileFormat != 'binary':
+        raise ValueError('Unknown histogram format: %s' % fileFormat)
+    arrays = []
+    header = _extractArrays(histogram, arrays, [0])
+    data = [array.tobytes() for array in arrays]
+    if metadata:
+        header.update(toJSON(metadata()))
+    header = json.dumps(header).encode('utf8')
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + data)
+
+
+def loads(data):
+    """
+    Decode a histogram in any of the supported formats.
+
+    :param data: the encoded histogram as bytes.
+    :returns: a dictionary.  Arrays are returned as numpy arrays.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        histogram = json.loads(data.decode('utf8'))
+        for frame in [histogram] + histogram.get('frames', []):
+            for entry in [frame] + list(frame.get('channels', {}).values()):
+                for key in ('hist', 'binEdges', 'cumulative'):
+                    if isinstance(entry.get(key), list):
+                        entry[key] = numpy.array(entry[key])
+        return histogram
+    headerLength = struct.unpack('<I', data[len(MAGIC):len(MAGIC) + 4])[0]
+    start = len(MAGIC) + 4
+    header = json.loads(data[start:start + headerLength].decode('utf8'))
+    return _restoreArrays(header, memoryview(data)[start + headerLength:])
+
+
+def write(path, histogram, fileFormat='json', metadata=None):
+    """
+    Write a histogram to a file.
+
+    :param path: the path of the file to write.
+    :param histogram: a dictionary which may contain numpy arrays.
+    :param fileFormat: one of FORMATS.
+    :param metadata: as for dumps.
+    """
+    with open(path, 'wb') as outfile:
+        outfile.write(dumps(histogram, fileFormat, metadata))
+
+
+def readHeader(fileobj):
+    """
+    Read the entries of an encoded histogram other than its arrays.  Only
+    the header of binary histograms is read.
+
+    :param fileobj: a file-like object positioned at the start of the
+        histogram.
+    :returns: a dictionary.  Arrays in binary histograms are omitted.
+    """
+    start = fileobj.read(len(MAGIC) + 4)
+    if start[:len(MAGIC)] != MAGIC:
+        return loads(start + fileobj.read())
+    headerLength = struct.unpack('<I', start[len(MAGIC):])[0]
+    header = json.loads(fileobj.read(headerLength).decode('utf8'))
+    return {key: value for key, value in header.items()
+            if not (isinstance(value, dict) and '$array' in value)}
+
+
+def read(path):
+    """
+    Read a histogram from a file in any of the supported formats.
+
+    :param path: the path of the file to read.
+    :returns: a dictionary.
+    """
+    with open(path, 'rb') as infile:
+        return loads(infile.read())
@@ -4,86 +4,1209 @@ from girder_worker.app import app
 from girder_worker.utils import girder_job
 
 @app.task(bind=True)
-def histogram(self, in_path, label, bins, bitmask, **kwargs):
+def histogram(self, in_path, label, bins, bitmask, streaming=None, workers=1,
+              fileFormat='json', variants=None, frames=False,
+              floatMethod=None, tiles=False, **kwargs):
+    if variants:
+        # label, bins, and bitmask are taken from each variant instead.  Each
+        # output is uploaded by the result hook with the same index.
+        return tuple(start_processing_variants(
+            in_path, variants, streaming, workers, fileFormat))
 
-    outputPath = start_processing(in_path, label, bins, bitmask)
+    outputPath = start_processing(in_path, label, bins, bitmask, streaming,
+                                  workers, fileFormat, frames, floatMethod,
+                                  tiles)
     print(outputPath)
+    if tiles:
+        # Each file is uploaded by the result hook with the same index.  The
+        # tile counts go first, so that they are there by the time the
+        # histogram is complete.
+        histogramPath, tilesPath = outputPath
+        return tilesPath, histogramPath
     return outputPath
 
 
-import json
+@app.task(bind=True)
+def histogramBatch(self, in_paths, label, bins, bitmask, streaming=None,
+                   workers=1, fileFormat='json', **kwargs):
+    # Each output is uploaded by the result hook with the same index.  Files
+    # that can't be histogrammed get an error file instead, so that the other
+    # histograms are still uploaded.
+    outputPaths = []
+    for index, in_path in enumerate(in_paths):
+        try:
+            outputPaths.append(start_processing(
+                in_path, label, bins, bitmask, streaming, workers,
+                fileFormat))
+        except Exception as exc:
+            outputPaths.append(writeError(in_path, exc))
+        job_manager = getattr(self, 'job_manager', None)
+        if job_manager is not None:
+            job_manager.updateProgress(
+                total=len(in_paths), current=index + 1,
+                message='Computed %d of %d histograms' % (
+                    index + 1, len(in_paths)))
+    return tuple(outputPaths)
+
+
+import concurrent.futures
+import functools
 import numpy
+import os
+import sys
+import threading
+import time
 from tempfile import NamedTemporaryFile
 
+from . import cache, formats, metrics, operations, readers, sketch
 
-def computeHistogram(in_path, label, bins, bitmask):
-    try:
-        import PIL.Image
-        PIL.Image.MAX_IMAGE_PIXELS = 10000000000
-        image = PIL.Image.open(in_path)
-        print('use pil')
-    except (ImportError, IOError, OSError):
-        import pytiff
-        image = pytiff.Tiff(in_path)
-        print('use pytiff')
-    else:
-        if image.mode not in ('1', 'L', 'P', 'I', 'F'):
-            raise ValueError('invalid image type for histogram: %s' % image.mode)
-    array = numpy.array(image)
+
+# Images with more pixels than this are streamed chunk by chunk rather than
+# being read into a single array.
+STREAMING_PIXELS = 256 * 1024 * 1024
+
+# Integer images with at most this many bytes per pixel are counted exactly
+# with one table entry per possible value.  Wider integer images use a table
+# covering their actual range if it has fewer than INTEGER_TABLE_SIZE values.
+INTEGER_TABLE_ITEMSIZE = 2
+INTEGER_TABLE_SIZE = 1 << 24
+
+# Number of bins of variants that don't give one, as for the server's
+# histogram.default_bins setting.
+DEFAULT_BINS = 256
+
+# Names of the channels of multi-channel images, in order.
+CHANNELS = ('red', 'green', 'blue', 'alpha')
+
+# Single-pass ways to count images whose range isn't known in advance (float
+# and wide integer images):
+#   range   find the range from the file's metadata or a low resolution
+#           level, then count in one pass.  Values outside that range are
+#           counted in the first or last bin, which is widened to hold them.
+#   sketch  count into a mergeable sketch with logarithmically spaced
+#           buckets, then divide it into bins.  Counts are approximate.
+# By default, these images are read twice: once to find their range and
+# once to count them.
+FLOAT_METHODS = ('range', 'sketch')
+
+# Tile histograms are counted for square cells of at least TILE_SIZE pixels,
+# doubled until there are at most TILE_GRID cells across the image.
+TILE_SIZE = 256
+TILE_GRID = 32
+
+# Number of pixels passed to numpy.bincount at once.
+BINCOUNT_BLOCK = 16 * 1024 * 1024
+
+# The bits set in each byte value, least significant bit first.
+_BYTE_BITS = numpy.unpackbits(
+    numpy.arange(256, dtype=numpy.uint8)[:, None], axis=1, bitorder='little')
+
+
+def _frameChunks(image, streaming, mapped, lazy=False):
+    if mapped and image.mapped:
+        return image.mappedChunks
+    if streaming and image.tiled:
+        return image.tileChunks
+    if lazy:
+        return lambda part=0, parts=1: iter([readers.partition(
+            image.read(), part, parts)])
+    return _arrayChunks(image.read())
+
+
+def _openImage(in_path, streaming=None, mapped=True):
+    """
+    Open an image with the reader best suited to how it will be read.
+
+    :returns: the image, whether to stream it, and whether to read a memory
+        map of it.
+    """
+    image = readers.openImage(in_path, ('mapped',) if mapped else ())
+    mapped = mapped and image.mapped
+    if streaming is None:
+        streaming = image.pixels > STREAMING_PIXELS
+    if not mapped and streaming and not image.tiled:
+        image = readers.openImage(in_path, ('tiled',))
+    return image, streaming, mapped
+
+
+def _openFrameChunks(in_path, streaming=None, mapped=True):
+    """
+    Open an image with the reader best suited to how it will be read.
+
+    :returns: a list of chunks functions, as from _imageChunks, with one for
+        each frame of the image, and whether they all read a memory map of
+        the file.
+    """
+    image, streaming, mapped = _openImage(in_path, streaming, mapped)
+    frames = [image.frame(index) for index in range(image.frames)]
+    # The frames of stacks that aren't streamed are only read when they
+    # are counted, so that only one is in memory at a time.
+    chunks = [_frameChunks(frame, streaming, mapped, len(frames) > 1)
+              for frame in frames]
+    return chunks, all(frame.mapped for frame in frames) and mapped
+
+
+def _iterStackChunks(frameChunks, part=0, parts=1):
+    # Stacks with enough frames are divided by frame, so that each frame is
+    # only opened by one part.
+    if len(frameChunks) >= parts:
+        for chunks in readers.partition(frameChunks, part, parts):
+            for chunk in chunks():
+                yield chunk
+        return
+    for chunks in frameChunks:
+        for chunk in chunks(part, parts):
+            yield chunk
+
+
+def _stackChunks(frameChunks):
+    if len(frameChunks) == 1:
+        return frameChunks[0]
+    return functools.partial(_iterStackChunks, frameChunks)
+
+
+def _openChunks(in_path, streaming=None, mapped=True):
+    """
+    Open an image with the reader best suited to how it will be read.
+
+    :returns: a chunks function, as from _imageChunks, and whether it reads a
+        memory map of the file.
+    """
+    frameChunks, mapped = _openFrameChunks(in_path, streaming, mapped)
+    return _stackChunks(frameChunks), mapped
+
+
+def _imageChunks(in_path, streaming=None, mapped=True):
+    """
+    Open an image and get a function that iterates over its pixels.
+
+    :param in_path: path to the image.
+    :param streaming: if True, read the image one strip or tile at a time so
+        that memory use depends on the tile size rather than the image size.
+        If False, read the whole image into memory.  If None, stream images
+        with more than STREAMING_PIXELS pixels.
+    :param mapped: if True, images that a reader can memory map, such as
+        uncompressed TIFF images, are read from a memory map of the file
+        regardless of streaming.
+    :returns: a function that returns an iterator of numpy arrays which
+        together cover every pixel of every frame of the image.  The function
+        may be called more than once.  It takes optional part and parts
+        arguments; when these are given, only the part-th of parts contiguous
+        ranges of the image is returned.  Different parts may be read
+        concurrently.
+    """
+    return _openChunks(in_path, streaming, mapped)[0]
+
+
+def _sourceChunks(in_path, streaming=None):
+    """
+    Get a function that iterates over the pixels of an image, like
+    _imageChunks, reusing pixels decoded by earlier tasks in this process.
+    """
+    key = cache.decodedChunks.key(in_path, streaming)
+    chunks = cache.decodedChunks.get(key)
+    if chunks is not None:
+        return chunks
+    chunks, mapped = _openChunks(in_path, streaming)
+    # Mapped pixels are cached by the operating system instead.
+    if mapped:
+        return chunks
+    return cache.decodedChunks.record(key, chunks)
+
+
+def _arrayChunks(array):
+    return lambda part=0, parts=1: iter([readers.partition(
+        array, part, parts)])
+
+
+def _mapChunks(chunks, func, workers=1):
+    """
+    Call a function on separate parts of an image in parallel.
+
+    :param chunks: a function returning an iterator of numpy arrays, as from
+        _imageChunks.
+    :param func: a function that takes a chunks function and returns a
+        partial result.
+    :param workers: the number of threads to use.  0 uses one per CPU.
+    :returns: a list of the partial results.
+    """
+    chunks = metrics.timedChunks(chunks)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return [func(chunks)]
+    # Threads rather than processes are used since decoding and most numpy
+    # counting release the GIL, and celery worker processes cannot start
+    # child processes.
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(
+            lambda part: func(functools.partial(chunks, part, workers)),
+            range(workers)))
+
+
+def _isSmallInteger(dtype):
+    return (numpy.issubdtype(dtype, numpy.integer) and
+            dtype.itemsize <= INTEGER_TABLE_ITEMSIZE)
+
+
+def _countIntegers(chunks, label, offset, size):
+    """
+    Count how many times each value occurs in an integer image.
+
+    :param chunks: a function returning an iterator of numpy arrays.
+    :param label: if True, zero values are not counted.
+    :param offset: the smallest value that can occur, other than zero if
+        label is True.
+    :param size: the number of distinct values that can occur.
+    :returns: an array where element i is the number of pixels with the value
+        i + offset.
+    """
+    counts = numpy.zeros(size, dtype=numpy.int64)
+    hasZero = offset <= 0 < offset + size
+    for array in chunks():
+        array = array.ravel()
+        # numpy.bincount converts its input to intp, so count in blocks to
+        # limit the size of the temporary copy.
+        for start in range(0, array.size, BINCOUNT_BLOCK):
+            values = array[start:start + BINCOUNT_BLOCK]
+            if label and not hasZero:
+                values = values[values != 0]
+            if offset:
+                values = values.astype(numpy.int64) - offset
+            counts += numpy.bincount(values, minlength=size)
+    if label and hasZero:
+        counts[-offset] = 0
+    return counts
+
+
+def _rebinIntegerCounts(counts, offset, dtype, bins):
+    """
+    Convert exact integer counts to a histogram with the requested number of
+    bins.  The result is the same as calling numpy.histogram on the pixels.
+
+    :param counts: an array of counts per value, as from _countIntegers.
+    :param offset: the value corresponding to the first element of counts.
+    :param dtype: the data type of the image.
+    :param bins: the number of bins.  Ignored for uint8 images, which have one
+        bin per value between the minimum and maximum.
+    :returns: hist, binEdges
+    """
+    present = numpy.nonzero(counts)[0]
+    if not len(present):
+        return numpy.histogram(numpy.zeros(0, dtype=dtype), bins=bins)
+    first, last = present[0], present[-1]
+    counts = counts[first:last + 1]
+    low, high = int(first) + offset, int(last) + offset
+    if dtype == numpy.uint8:
+        return counts, numpy.arange(low, high + 2)
+    hist, binEdges = numpy.histogram(
+        numpy.arange(low, high + 1), bins=bins, range=(low, high),
+        weights=counts)
+    return hist.astype(numpy.int64), binEdges
+
+
+def _byteLanes(itemsize):
+    """
+    Get the position of each byte within a native integer, least significant
+    byte first.
+    """
+    lanes = list(range(itemsize))
+    return lanes if sys.byteorder == 'little' else lanes[::-1]
+
+
+def _countBits(chunks):
+    """
+    Count the zero pixels and the pixels with each bit set in an integer image
+    in a single pass.  The values (or, for wide integers, each byte of the
+    values) are counted with numpy.bincount, and the bit counts are found from
+    the counts of each byte value.
+
+    :param chunks: a function returning an iterator of numpy arrays.
+    :returns: zeros, bitCounts where bitCounts[i] is the number of pixels with
+        bit i set.
+    """
+    zeros = 0
+    bitCounts = None
+    for array in chunks():
+        if array.dtype != bool and not numpy.issubdtype(
+                array.dtype, numpy.integer):
+            raise ValueError(
+                'bitmask histograms require an integer image, not %s' %
+                array.dtype)
+        if not array.dtype.isnative:
+            array = array.astype(array.dtype.newbyteorder('='))
+        itemsize = array.dtype.itemsize
+        if bitCounts is None:
+            bitCounts = numpy.zeros(itemsize * 8, dtype=numpy.int64)
+        array = numpy.ascontiguousarray(array).ravel()
+        for start in range(0, array.size, BINCOUNT_BLOCK):
+            block = array[start:start + BINCOUNT_BLOCK]
+            if itemsize <= INTEGER_TABLE_ITEMSIZE:
+                # Count every value, then split the table into its bytes.
+                unsigned = block.view('u%d' % itemsize)
+                counts = numpy.bincount(unsigned, minlength=256 ** itemsize)
+                zeros += counts[0]
+                if itemsize == 1:
+                    byteCounts = [counts]
+                else:
+                    counts = counts.reshape(256, 256)
+                    byteCounts = [counts.sum(axis=0), counts.sum(axis=1)]
+            else:
+                zeros += block.size - numpy.count_nonzero(block)
+                lanes = block.view(numpy.uint8).reshape(-1, itemsize)
+                byteCounts = [
+                    numpy.bincount(lanes[:, lane], minlength=256)
+                    for lane in _byteLanes(itemsize)]
+            for byte, counts in enumerate(byteCounts):
+                bitCounts[byte * 8:byte * 8 + 8] += counts.dot(_BYTE_BITS)
+    return zeros, bitCounts
+
+
+def _bitmaskHistogram(chunks, label, workers=1):
+    """
+    Compute a histogram of the bits set in a label image.
+
+    :param chunks: a function returning an iterator of numpy arrays.
+    :param label: if True, zero values are not counted.
+    :param workers: the number of threads to use.
+    :returns: hist, binEdges.  Bin 0 is the number of zero pixels (omitted if
+        label is True), and bin i is the number of pixels with bit i - 1 set.
+    """
+    results = _mapChunks(chunks, _countBits, workers)
+    zeros = sum(result[0] for result in results)
+    bitCounts = sum(result[1] for result in results if result[1] is not None)
+    return _bitmaskResult(zeros, bitCounts, label)
+
+
+def _bitmaskResult(zeros, bitCounts, label):
+    hist = numpy.zeros(bitCounts.shape[0] + 1 - label)
+    if not label:
+        hist[0] = zeros
+    hist[1 - label:] = bitCounts
+    binEdges = numpy.arange(label, hist.shape[0] + label)
+    return hist, binEdges
+
+
+def _valueBitCounts(counts, offset, dtype):
+    """
+    Find the zero pixels and the pixels with each bit set from the count of
+    each value, as _countBits does from the pixels.
+
+    :param counts: an array of counts per value, as from _countIntegers.
+    :param offset: the value corresponding to the first element of counts.
+    :param dtype: the data type of the image.
+    :returns: zeros, bitCounts.
+    """
+    dtype = numpy.dtype(dtype).newbyteorder('=')
+    values = numpy.arange(offset, offset + len(counts)).astype(dtype).view(
+        'u%d' % dtype.itemsize)
+    bits = (values[:, None] >> numpy.arange(
+        dtype.itemsize * 8, dtype=values.dtype)) & 1
+    zeros = counts[-offset] if offset <= 0 < offset + len(counts) else 0
+    return zeros, counts.dot(bits.astype(numpy.int64))
+
+
+def _dataRange(chunks, label):
+    """
+    Find the minimum and maximum values of an image.  NaN and infinite
+    values are ignored, as they are when counting.
+
+    :param chunks: a function returning an iterator of numpy arrays.
+    :param label: if True, zero values are ignored.
+    :returns: (low, high), or None if there are no values.
+    """
+    low = high = None
+    for array in chunks():
+        array = _finiteValues(array, label)
+        if array.size:
+            low = array.min() if low is None else min(low, array.min())
+            high = array.max() if high is None else max(high, array.max())
+    return None if low is None else (low, high)
+
+
+def _countHistogram(chunks, label, bins, _range):
+    hist = numpy.zeros(bins, dtype=numpy.int64)
+    for array in chunks():
+        hist += numpy.histogram(
+            _finiteValues(array, label), bins=bins, range=_range)[0]
+    return hist
+
+
+def _finiteValues(array, label):
+    array = array.ravel()
     if label:
         array = array[numpy.nonzero(array)]
+    if numpy.issubdtype(array.dtype, numpy.floating):
+        array = array[numpy.isfinite(array)]
+    return array
+
+
+def _countClippedHistogram(chunks, label, bins, _range):
+    """
+    Count an image into bins covering an expected range, counting values
+    outside of it in the first or last bin.
+
+    :returns: hist and the (low, high) range of the values, or None.
+    """
+    hist = numpy.zeros(bins, dtype=numpy.int64)
+    dataRange = None
+    for array in chunks():
+        for start in range(0, array.size, BINCOUNT_BLOCK):
+            values = _finiteValues(
+                array.reshape(-1)[start:start + BINCOUNT_BLOCK], label)
+            if not values.size:
+                continue
+            low, high = values.min(), values.max()
+            if dataRange is not None:
+                low = min(low, dataRange[0])
+                high = max(high, dataRange[1])
+            dataRange = (low, high)
+            hist += numpy.histogram(
+                numpy.clip(values, *_range), bins=bins, range=_range)[0]
+    return hist, dataRange
+
+
+def _rangeHistogram(chunks, label, bins, dtype, _range, workers=1):
+    """
+    Compute a histogram in one pass over an image, given the expected range
+    of its values.  If the image has values outside of the range, the first
+    or last bin is widened to hold them, so the counts are exact.
+
+    :param _range: the expected (low, high) range of the values.
+    :returns: hist, binEdges.
+    """
+    results = _mapChunks(chunks, functools.partial(
+        _countClippedHistogram, label=label, bins=bins, _range=_range),
+        workers)
+    hist = sum(result[0] for result in results)
+    binEdges = numpy.histogram(
+        numpy.zeros(0, dtype=dtype), bins=bins, range=_range)[1]
+    ranges = [result[1] for result in results if result[1] is not None]
+    if ranges:
+        binEdges[0] = min(binEdges[0], min(low for low, _ in ranges))
+        binEdges[-1] = max(binEdges[-1], max(high for _, high in ranges))
+    return hist, binEdges
+
+
+def _sketchChunks(chunks, label):
+    counted = sketch.QuantileSketch()
+    for array in chunks():
+        for start in range(0, array.size, BINCOUNT_BLOCK):
+            counted.add(_finiteValues(
+                array.reshape(-1)[start:start + BINCOUNT_BLOCK], label))
+    return counted
+
+
+def _sketchHistogram(chunks, label, bins, dtype, workers=1):
+    """
+    Compute an approximate histogram in one pass over an image by merging
+    sketches of its parts.  If the bins are too narrow for the sketch to
+    tell values apart, the image is counted again with the range method,
+    using the range the sketch found, so that the counts are exact.
+
+    :returns: hist, binEdges.
+    """
+    counted = functools.reduce(
+        lambda first, second: first.merge(second),
+        _mapChunks(chunks, functools.partial(_sketchChunks, label=label),
+                   workers))
+    hist, binEdges = counted.histogram(bins)
+    if counted.count and not counted.resolves(binEdges):
+        return _rangeHistogram(chunks, label, bins, dtype,
+                               (counted.low, counted.high), workers)
+    return hist, binEdges
+
+
+def discoverRange(in_path, label=False):
+    """
+    Find the range of the values of an image without reading its full
+    resolution pixels, from the range recorded in the file or from a low
+    resolution level of each frame.
+
+    :param in_path: path to the image.
+    :param label: if True, zero values are ignored in low resolution levels.
+    :returns: (low, high), or None if the range cannot be found this way.
+    """
+    image = readers.openImage(in_path)
+    ranges = []
+    for index in range(image.frames):
+        frame = image.frame(index)
+        if frame.sampleRange is not None:
+            ranges.append(frame.sampleRange)
+        elif frame.overview is not None:
+            values = _finiteValues(numpy.asarray(frame.overview()), label)
+            if values.size:
+                ranges.append((values.min().item(), values.max().item()))
+        else:
+            return None
+    if not ranges:
+        return None
+    return (min(low for low, _ in ranges), max(high for _, high in ranges))
+
+
+def computeHistogram(in_path, label, bins, bitmask, streaming=None,
+                     workers=1, floatMethod=None):
+    """
+    Compute the histogram of an image file.
+
+    :param floatMethod: one of FLOAT_METHODS to count float and wide integer
+        images in a single pass, or None to count them exactly in two.
+    :returns: hist, binEdges, or for RGB(A) images a dictionary of
+        (hist, binEdges) keyed by channel name.
+    """
+    return _chunksHistogram(
+        _sourceChunks(in_path, streaming), label, bins, bitmask, workers,
+        floatMethod, _expectedRange(in_path, label, bitmask, floatMethod))
 
-    # TODO: integer histogram optimizations
-    '''
-    if array.dtype == numpy.uint8 and bins == 256:
-        _bins = range(bins + 1)
+
+def _expectedRange(in_path, label, bitmask, floatMethod):
+    """
+    Get the expected range of an image's values for the range method.
+
+    :returns: (low, high), or None if the range isn't needed or cannot be
+        found without reading the image.
+    """
+    if floatMethod not in (None,) + FLOAT_METHODS:
+        raise ValueError('Unknown float histogram method: %s' % floatMethod)
+    if floatMethod != 'range' or bitmask:
+        return None
+    return discoverRange(in_path, label)
+
+
+def computeHistograms(in_path, variants, streaming=None, workers=1):
+    """
+    Compute several histograms of an image file.  Integer images with at most
+    INTEGER_TABLE_ITEMSIZE bytes per pixel are read once, and every histogram
+    is found from the count of each value.  Other images are read once per
+    histogram, but are only decoded once if they fit in the decoded pixel
+    cache.
+
+    :param variants: a list of dictionaries with label, bins, and bitmask
+        values.  Missing values default to False, DEFAULT_BINS, and False.
+    :returns: a list with a result like computeHistogram's for each variant.
+    """
+    return _chunksHistograms(
+        _sourceChunks(in_path, streaming), variants, workers)
+
+
+def _variantArgs(variant):
+    """
+    Get the label, bins, and bitmask values of a histogram variant, with
+    defaults for missing values.
+
+    :param variant: a dictionary with optional label, bins, and bitmask
+        values.
+    :returns: a tuple of label, bins, and bitmask.
+    """
+    bins = variant.get('bins')
+    if bins is None:
+        bins = DEFAULT_BINS
+    if (not isinstance(bins, (int, numpy.integer)) or isinstance(bins, bool) or
+            bins < 1):
+        raise ValueError('Variant bins must be a positive integer, not %r.' %
+                         (bins, ))
+    return (bool(variant.get('label', False)), bins,
+            bool(variant.get('bitmask', False)))
+
+
+def _chunksHistograms(chunks, variants, workers=1):
+    variants = [_variantArgs(variant) for variant in variants]
+    first = next(chunks())
+    dtype = first.dtype
+    channels = first.shape[2] if first.ndim == 3 else 0
+    if not _isSmallInteger(dtype) or (channels and any(
+            bitmask for _, _, bitmask in variants)):
+        return [_chunksHistogram(chunks, label, bins, bitmask, workers)
+                for label, bins, bitmask in variants]
+
+    info = numpy.iinfo(dtype)
+    offset = int(info.min)
+    size = int(info.max) - offset + 1
+    if channels:
+        counts = sum(_mapChunks(chunks, functools.partial(
+            _countChannelIntegers, label=False, offset=offset, size=size,
+            channels=channels), workers))
     else:
-        _bins = bins
-    '''
-    if array.dtype == numpy.uint8:
-        _bins = numpy.arange(numpy.min(array), numpy.max(array) + 2)
+        counts = sum(_mapChunks(chunks, functools.partial(
+            _countIntegers, label=False, offset=offset, size=size), workers))
+    results = []
+    for label, bins, bitmask in variants:
+        if bitmask:
+            results.append(_bitmaskResult(
+                *_valueBitCounts(counts, offset, dtype), label=label))
+            continue
+        variantCounts = counts
+        if label and offset <= 0:
+            variantCounts = counts.copy()
+            variantCounts[..., -offset] = 0
+        if channels:
+            results.append({
+                name: _rebinIntegerCounts(channelCounts, offset, dtype, bins)
+                for name, channelCounts in zip(
+                    _channelNames(channels), variantCounts)})
+        else:
+            results.append(
+                _rebinIntegerCounts(variantCounts, offset, dtype, bins))
+    return results
 
+
+def computeMappedHistogram(in_path, label, bins, bitmask, workers=1):
+    """
+    Compute a histogram of an image whose pixels can be read from a memory
+    map of the file without decoding it, e.g., an uncompressed TIFF.  This is
+    cheap enough to do without a worker.
+
+    :param in_path: path to the image.
+    :returns: the histogram file contents, as from histogramResult, or None
+        if the image must be decoded.
+    """
+    image = readers.openImage(in_path, ('mapped',))
+    if not image.mapped:
+        return None
+    frames = [image.frame(index) for index in range(image.frames)]
+    if not all(frame.mapped for frame in frames):
+        return None
+    chunks = _stackChunks([frame.mappedChunks for frame in frames])
+    computed = _chunksHistogram(chunks, label, bins, bitmask, workers)
+    return histogramResult(computed, label, bins, bitmask,
+                           next(chunks()).dtype)
+
+
+def _mapFrames(frameChunks, func, workers=1):
+    """
+    Call a function on each frame of a stack, counting frames in parallel.
+
+    :returns: an iterator of the results in frame order.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(frameChunks) == 1:
+        return (func(chunks) for chunks in frameChunks)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return iter(list(executor.map(func, frameChunks)))
+
+
+def _framesHistograms(frameChunks, label, bins, bitmask, workers=1,
+                      floatMethod=None, _range=None):
+    """
+    Compute the histogram of a stack and of each of its frames.  When the
+    per-frame counts determine the histogram of the stack exactly (bitmask
+    and small integer images), it is found from them without reading the
+    stack again.
+
+    :param frameChunks: a list of chunks functions, one for each frame.
+    :param floatMethod: as for _chunksHistogram.
+    :param _range: as for _chunksHistogram.  Each frame is counted into the
+        same expected range.
+    :returns: the histogram of the stack and a list of the histograms of its
+        frames, each like the result of _chunksHistogram.
+    """
+    first = next(frameChunks[0]())
+    dtype = first.dtype
+    if bitmask and first.ndim == 3:
+        raise ValueError('bitmask histograms require a single channel image')
     if bitmask:
-        hist = numpy.zeros(array.dtype.itemsize*8 + 1 - label)
-        if not label:
-            hist[0] = (array == 0).sum()
-        binEdges = numpy.arange(label, hist.shape[0] + label)
-        for i in range(1, hist.shape[0] + label):
-            hist[i - label] = (array & 1 << i - 1 > 0).sum()
-    else:
-        hist, binEdges = numpy.histogram(array, bins=_bins)
+        counted = [
+            (zeros, numpy.zeros(dtype.itemsize * 8, dtype=numpy.int64)
+             if bitCounts is None else bitCounts)
+            for zeros, bitCounts in _mapFrames(
+                frameChunks, _countBits, workers)]
+        frames = [_bitmaskResult(zeros, bitCounts, label)
+                  for zeros, bitCounts in counted]
+        return _bitmaskResult(
+            sum(zeros for zeros, _ in counted),
+            sum(bitCounts for _, bitCounts in counted), label), frames
+    if _isSmallInteger(dtype) and first.ndim == 2:
+        info = numpy.iinfo(dtype)
+        offset = int(info.min)
+        size = int(info.max) - offset + 1
+        total = numpy.zeros(size, dtype=numpy.int64)
+        lock = threading.Lock()
+
+        def countFrame(chunks):
+            counts = _countIntegers(chunks, label, offset, size)
+            # Only the rebinned counts of each frame are kept.
+            with lock:
+                total[:] += counts
+            return _rebinIntegerCounts(counts, offset, dtype, bins)
+
+        frames = list(_mapFrames(frameChunks, countFrame, workers))
+        return _rebinIntegerCounts(total, offset, dtype, bins), frames
+    frames = list(_mapFrames(frameChunks, functools.partial(
+        _chunksHistogram, label=label, bins=bins, bitmask=bitmask,
+        floatMethod=floatMethod, _range=_range), workers))
+    return _chunksHistogram(
+        _stackChunks(frameChunks), label, bins, bitmask, workers,
+        floatMethod, _range), frames
+
+
+def computeFrameHistograms(in_path, label, bins, bitmask, streaming=None,
+                           workers=1, floatMethod=None):
+    """
+    Compute the histogram of each frame of an image, e.g., the pages of a
+    multi-page TIFF or the slices of a volume, and of the whole image.
+    Frames are counted in parallel.
+
+    :returns: the histogram of the whole image and a list of the histograms
+        of its frames, each like computeHistogram's result, and the data type
+        of the image.
+    """
+    _range = _expectedRange(in_path, label, bitmask, floatMethod)
+    frameChunks, _ = _openFrameChunks(in_path, streaming)
+    computed, frames = _framesHistograms(
+        frameChunks, label, bins, bitmask, workers, floatMethod, _range)
+    return computed, frames, next(frameChunks[0]()).dtype
+
+
+def _tileSize(shape):
+    size = TILE_SIZE
+    while max(shape) > size * TILE_GRID:
+        size *= 2
+    return size
+
+
+def _tileCountDtype(size):
+    """
+    Get an integer dtype that can hold the number of pixels in a cell.
+    """
+    return numpy.min_scalar_type(size * size)
+
+
+def _countTiles(regions, shape, size, binEdges, bins, label, bitmask):
+    """
+    Count the pixels of each cell of a grid over an image.
+
+    :param regions: a function returning an iterator of (top, left, array)
+        tuples.
+    :param shape: the (height, width) of the image.
+    :param size: the width and height of each cell.
+    :returns: an array of shape (rows, columns, bins).
+    """
+    hist = numpy.zeros((-(-shape[0] // size), -(-shape[1] // size), bins),
+                       dtype=_tileCountDtype(size))
+    for top, left, array in regions():
+        # Edge tiles may extend past the image.
+        array = array[:shape[0] - top, :shape[1] - left]
+        for cellTop in range(top - top % size, top + array.shape[0], size):
+            for cellLeft in range(left - left % size, left + array.shape[1],
+                                  size):
+                hist[cellTop // size, cellLeft // size] += \
+                    operations.countValues(array[
+                        max(cellTop - top, 0):cellTop + size - top,
+                        max(cellLeft - left, 0):cellLeft + size - left,
+                    ], binEdges, label, bitmask).astype(hist.dtype)
+    return hist
+
+
+def _frameRegions(image, streaming, mapped):
+    if mapped and image.mapped:
+        return functools.partial(image.mappedChunks, positions=True)
+    if streaming and image.tiled:
+        return functools.partial(image.tileChunks, positions=True)
+    array = image.read()
+
+    def regions(part=0, parts=1):
+        rows = readers.partition(range(array.shape[0]), part, parts)
+        return iter([(rows.start, 0, array[rows.start:rows.stop])])
+    return regions
+
+
+def computeTileHistograms(in_path, computed, label, bitmask, streaming=None,
+                          workers=1):
+    """
+    Count the pixels of each cell of a coarse grid over an image into the
+    bins of its histogram, so that the histogram of any region can be found
+    by summing the cells inside it.
+
+    :param computed: the hist, binEdges histogram of the image.
+    :returns: a dictionary with the size of the cells, the (height, width)
+        shape of the image, and a hist array of shape (rows, columns, bins)
+        in the smallest unsigned integer dtype that holds the counts, or None
+        for multi-channel and multi-frame images.
+    """
+    if isinstance(computed, dict):
+        return None
+    image, streaming, mapped = _openImage(in_path, streaming)
+    if image.frames > 1 or image.multichannel:
+        return None
+    hist, binEdges = computed
+    size = _tileSize(image.shape)
+    countTiles = functools.partial(
+        _countTiles, shape=image.shape, size=size, binEdges=binEdges,
+        bins=len(hist), label=label, bitmask=bitmask)
+    tiles = sum(_mapChunks(
+        _frameRegions(image, streaming, mapped), countTiles, workers))
+    tiles = tiles.astype(numpy.min_scalar_type(int(tiles.max(initial=0))))
+    return {'size': size, 'shape': list(image.shape), 'hist': tiles}
+
+
+def computeArrayHistogram(array, label, bins, bitmask):
+    """
+    Compute a histogram of pixels that are already in memory, counting them
+    the same way as an image file.
+
+    :param array: a numpy array of pixel values, with channels as the third
+        axis for multi-channel images.
+    :returns: as for computeHistogram.
+    """
+    return _chunksHistogram(_arrayChunks(array), label, bins, bitmask)
+
 
+def _countChannelIntegers(chunks, label, offset, size, channels):
+    """
+    Count how many times each value occurs in each channel of an integer
+    image.  All of the channels of a block of pixels are counted with a single
+    numpy.bincount call by offsetting each channel's values into its own range
+    of the table.
+
+    :param chunks: a function returning an iterator of numpy arrays with
+        channels as the last axis.
+    :param label: if True, zero values are not counted.
+    :param offset: the smallest value that can occur.
+    :param size: the number of distinct values that can occur.
+    :param channels: the number of channels.
+    :returns: an array of shape (channels, size) where element [c, i] is the
+        number of pixels with the value i + offset in channel c.
+    """
+    counts = numpy.zeros(channels * size, dtype=numpy.int64)
+    channelOffsets = numpy.arange(channels, dtype=numpy.intp) * size - offset
+    block = max(1, BINCOUNT_BLOCK // channels)
+    for array in chunks():
+        array = array.reshape(-1, channels)
+        for start in range(0, array.shape[0], block):
+            values = array[start:start + block].astype(numpy.intp)
+            values += channelOffsets
+            counts += numpy.bincount(values.ravel(), minlength=channels * size)
+    counts = counts.reshape(channels, size)
+    if label and offset <= 0 < offset + size:
+        counts[:, -offset] = 0
+    return counts
+
+
+def _channelRanges(chunks, label, channels):
+    """
+    Find the minimum and maximum values of each channel of an image.
+
+    :returns: a list with (low, high) or None for each channel.
+    """
+    ranges = [None] * channels
+    for array in chunks():
+        array = array.reshape(-1, channels)
+        for channel in range(channels):
+            values = _finiteValues(array[:, channel], label)
+            if values.size:
+                low, high = values.min(), values.max()
+                if ranges[channel] is not None:
+                    low = min(low, ranges[channel][0])
+                    high = max(high, ranges[channel][1])
+                ranges[channel] = (low, high)
+    return ranges
+
+
+def _countChannelBins(chunks, label, binEdges):
+    """
+    Count the pixels of each channel of an image into bins.  Each pixel is
+    assigned to the same bin as numpy.histogram would, and all of the channels
+    of a block of pixels are counted with a single numpy.bincount call.
+
+    :param chunks: a function returning an iterator of numpy arrays with
+        channels as the last axis.
+    :param label: if True, zero values are not counted.
+    :param binEdges: a list with the bin edges of each channel.  Every channel
+        must have the same number of bins.
+    :returns: an array of shape (channels, bins).
+    """
+    channels = len(binEdges)
+    bins = len(binEdges[0]) - 1
+    hist = numpy.zeros(channels * bins, dtype=numpy.int64)
+    block = max(1, BINCOUNT_BLOCK // channels)
+    for array in chunks():
+        array = array.reshape(-1, channels)
+        for start in range(0, array.shape[0], block):
+            values = array[start:start + block]
+            indices = numpy.empty(values.shape, dtype=numpy.intp)
+            for channel, edges in enumerate(binEdges):
+                channelValues = values[:, channel]
+                index = numpy.searchsorted(
+                    edges, channelValues, side='right') - 1
+                # The last bin includes its upper edge.
+                index[channelValues == edges[-1]] = bins - 1
+                valid = (index >= 0) & (index < bins)
+                if label:
+                    valid &= channelValues != 0
+                indices[:, channel] = numpy.where(
+                    valid, index + channel * bins, -1)
+            indices = indices[indices >= 0]
+            hist += numpy.bincount(indices, minlength=channels * bins)
+    return hist.reshape(channels, bins)
+
+
+def _channelNames(channels):
+    if channels <= len(CHANNELS):
+        return CHANNELS[:channels]
+    return ['channel%d' % channel for channel in range(channels)]
+
+
+def _channelHistograms(chunks, label, bins, dtype, channels, workers=1):
+    """
+    Compute a histogram of each channel of a multi-channel image, reading the
+    image once.
+
+    :returns: a dictionary of (hist, binEdges) keyed by channel name.
+    """
+    names = _channelNames(channels)
+    if _isSmallInteger(dtype):
+        info = numpy.iinfo(dtype)
+        offset = int(info.min)
+        counts = sum(_mapChunks(chunks, functools.partial(
+            _countChannelIntegers, label=label, offset=offset,
+            size=int(info.max) - offset + 1, channels=channels), workers))
+        return {name: _rebinIntegerCounts(channelCounts, offset, dtype, bins)
+                for name, channelCounts in zip(names, counts)}
+
+    binEdges = []
+    results = _mapChunks(chunks, functools.partial(
+        _channelRanges, label=label, channels=channels), workers)
+    for channel in range(channels):
+        ranges = [result[channel] for result in results
+                  if result[channel] is not None]
+        _range = None
+        if ranges:
+            _range = (min(dataRange[0] for dataRange in ranges),
+                      max(dataRange[1] for dataRange in ranges))
+        binEdges.append(numpy.histogram(
+            numpy.zeros(0, dtype=dtype), bins=bins, range=_range)[1])
+    hist = sum(_mapChunks(chunks, functools.partial(
+        _countChannelBins, label=label, binEdges=binEdges), workers))
+    return {name: (channelHist, edges)
+            for name, channelHist, edges in zip(names, hist, binEdges)}
+
+
+def _chunksHistogram(chunks, label, bins, bitmask, workers=1,
+                     floatMethod=None, _range=None):
+    """
+    Compute the histogram of the pixels of an image.
+
+    :param floatMethod: one of FLOAT_METHODS to count single channel images
+        that aren't counted exactly with a table of values in one pass, or
+        None to read them twice.
+    :param _range: for the range method, the expected (low, high) range of
+        the values, as from discoverRange.  If None, the range is found by
+        reading the image.
+    :returns: as for computeHistogram.
+    """
+    first = next(chunks())
+    dtype = first.dtype
+    if first.ndim == 3:
+        if bitmask:
+            raise ValueError('bitmask histograms require a single channel '
+                             'image')
+        return _channelHistograms(
+            chunks, label, bins, dtype, first.shape[2], workers)
+
+    if bitmask:
+        return _bitmaskHistogram(chunks, label, workers)
+
+    if _isSmallInteger(dtype):
+        info = numpy.iinfo(dtype)
+        offset = int(info.min)
+        counts = sum(_mapChunks(chunks, functools.partial(
+            _countIntegers, label=label, offset=offset,
+            size=int(info.max) - offset + 1), workers))
+        return _rebinIntegerCounts(counts, offset, dtype, bins)
+
+    if floatMethod == 'sketch':
+        return _sketchHistogram(chunks, label, bins, dtype, workers)
+    if floatMethod == 'range' and _range is not None:
+        return _rangeHistogram(chunks, label, bins, dtype, _range, workers)
+
+    # Find the range of the data first so that every chunk is counted into
+    # the same bins.
+    ranges = [dataRange for dataRange in _mapChunks(
+        chunks, functools.partial(_dataRange, label=label), workers)
+        if dataRange is not None]
+    _range = None
+    if ranges:
+        low = min(dataRange[0] for dataRange in ranges)
+        high = max(dataRange[1] for dataRange in ranges)
+        _range = (low, high)
+
+        if (numpy.issubdtype(dtype, numpy.integer) and
+                int(high) - int(low) < INTEGER_TABLE_SIZE):
+            counts = sum(_mapChunks(chunks, functools.partial(
+                _countIntegers, label=label, offset=int(low),
+                size=int(high) - int(low) + 1), workers))
+            return _rebinIntegerCounts(counts, int(low), dtype, bins)
+
+    hist = sum(_mapChunks(chunks, functools.partial(
+        _countHistogram, label=label, bins=bins, _range=_range), workers))
+    binEdges = numpy.histogram(
+        numpy.zeros(0, dtype=dtype), bins=bins, range=_range)[1]
     return hist, binEdges
 
 
-def start_processing(in_path, label, bins, bitmask):
+def start_processing(in_path, label, bins, bitmask, streaming=None,
+                     workers=1, fileFormat='json', frames=False,
+                     floatMethod=None, tiles=False):
     # Define Girder Worker globals for the style checker
     in_path = in_path   # noqa
     label = label   # noqa
     bins = bins   # noqa
     bitmask = bitmask   # noqa
 
-    hist, binEdges = computeHistogram(in_path, label, bins, bitmask)
+    taskMetrics = _startMetrics(in_path)
+    frameResults = tileResults = None
+    with metrics.collecting(taskMetrics):
+        with taskMetrics.phase('histogram'):
+            if frames:
+                computed, frameResults, dtype = computeFrameHistograms(
+                    in_path, label, bins, bitmask, streaming, workers,
+                    floatMethod)
+            else:
+                _range = _expectedRange(in_path, label, bitmask, floatMethod)
+                chunks = _sourceChunks(in_path, streaming)
+                computed = _chunksHistogram(
+                    chunks, label, bins, bitmask, workers, floatMethod,
+                    _range)
+        if tiles:
+            with taskMetrics.phase('tiles'):
+                tileResults = computeTileHistograms(
+                    in_path, computed, label, bitmask, streaming, workers)
+    if not frames:
+        dtype = next(chunks()).dtype
+    outputPath = _writeHistogram(computed, label, bins, bitmask, dtype,
+                                 fileFormat, frameResults, taskMetrics)
+    if not tiles:
+        return outputPath
+    return outputPath, _writeTiles(tileResults)
+
+
+def start_processing_variants(in_path, variants, streaming=None, workers=1,
+                              fileFormat='json'):
+    """
+    Compute several histograms of an image, reading it once if possible.
+
+    :param variants: a list of dictionaries with label, bins, and bitmask
+        values.  Missing values default to False, DEFAULT_BINS, and False.
+    :returns: a list of the paths of the histogram files, in the same order
+        as variants.
+    """
+    taskMetrics = _startMetrics(in_path)
+    chunks = _sourceChunks(in_path, streaming)
+    with metrics.collecting(taskMetrics), taskMetrics.phase('histogram'):
+        results = _chunksHistograms(chunks, variants, workers)
+    dtype = next(chunks()).dtype
+    # The variants share the reading and counting, so each file records the
+    # same metrics.
+    return [_writeHistogram(
+        computed, *_variantArgs(variant), dtype=dtype, fileFormat=fileFormat,
+        taskMetrics=taskMetrics)
+        for variant, computed in zip(variants, results)]
+
+
+def _startMetrics(in_path):
+    """
+    Start the metrics of a task with the time taken to download its source
+    file and the size of the file.
+
+    :returns: a metrics.TaskMetrics instance.
+    """
+    taskMetrics = metrics.TaskMetrics()
+    download = cache.popFetchTime(in_path)
+    if download is not None:
+        taskMetrics.add('download', download)
+    taskMetrics.count('sourceBytes', os.path.getsize(in_path))
+    return taskMetrics
+
+
+def writeError(in_path, exc):
+    """
+    Write a file recording that an image could not be histogrammed, to be
+    uploaded in place of its histogram.
+
+    :param in_path: the path of the image.
+    :param exc: the exception raised while computing the histogram.
+    :returns: the path of the file, which holds a JSON object with an error
+        entry.
+    """
+    print('Failed to compute the histogram of %s: %s' % (in_path, exc),
+          file=sys.stderr)
+    path = NamedTemporaryFile(delete=False).name + formats.EXTENSIONS['json']
+    formats.write(path, {'error': '%s: %s' % (type(exc).__name__, exc)},
+                  'json')
+    return path
 
-    histogram = NamedTemporaryFile(delete=False).name+'.json'
 
-    with open(histogram, 'w') as outfile:
-        json.dump({
-            'label': label,
-            'bitmask': bitmask,
-            'bins': bins,
-            'hist': hist.tolist(),
-            'binEdges': binEdges.tolist()
-        }, outfile)
+def _writeTiles(tiles):
+    """
+    Write the tile counts of an image to their own file, so that they are
+    only read when the histogram of a region is needed.  They are always
+    written in the binary format, since they can be large.
+
+    :param tiles: the result of computeTileHistograms.  If None, the file is
+        written without tile counts.
+    :returns: the path of the file.
+    """
+    path = NamedTemporaryFile(delete=False).name + \
+        formats.EXTENSIONS['binary']
+    formats.write(path, tiles or {}, 'binary')
+    return path
+
+
+def _writeHistogram(computed, label, bins, bitmask, dtype, fileFormat,
+                    frames=None, taskMetrics=None):
+    histogram = NamedTemporaryFile(delete=False).name + \
+        formats.EXTENSIONS[fileFormat]
+
+    start = time.perf_counter()
+
+    def metadata():
+        # Called once the arrays are encoded, so that serializing is timed.
+        taskMetrics.add('serialize', time.perf_counter() - start)
+        return {'metrics': taskMetrics.result()}
+
+    formats.write(histogram, histogramResult(
+        computed, label, bins, bitmask, dtype, frames), fileFormat,
+        metadata if taskMetrics is not None else None)
     return histogram
 
-# TODO: implement RGB(A)
-'''
-result = {}
-for i, channel in enumerate(('red', 'green', 'blue')):
-    hist, binEdges = numpy.histogram(array[:, :, i], **histogram_kwargs)
-    result[channel] = {
-       'values': list(hist),
-        'bins': list(binEdges),
+
+def histogramResult(computed, label, bins, bitmask, dtype=None, frames=None):
+    """
+    Get the contents of a histogram file.
+
+    :param computed: the result of computeHistogram.
+    :param dtype: the numpy data type of the image.  It is recorded so that
+        the histogram can later be re-binned exactly when possible.
+    :param frames: a list of results like computed for each frame of a
+        stack.  If given, they are stored in a frames list, each with either
+        hist, binEdges, and cumulative or channels.
+    :returns: a dictionary with label, bitmask, bins, and either hist,
+        binEdges, and cumulative or, for multi-channel images, channels,
+        which has hist, binEdges, and cumulative keyed by channel name.
+        cumulative is the running total of hist, so that quantiles can be
+        found without summing the counts.  It is omitted from bitmask
+        histograms.
+    """
+    def entry(hist, binEdges):
+        result = {'hist': hist, 'binEdges': binEdges}
+        if not bitmask:
+            result['cumulative'] = numpy.cumsum(hist)
+        return result
+
+    def entries(computed):
+        if isinstance(computed, dict):
+            return {'channels': {
+                name: entry(hist, binEdges)
+                for name, (hist, binEdges) in computed.items()}}
+        return entry(*computed)
+
+    result = {
+        'label': label,
+        'bitmask': bitmask,
+        'bins': bins,
     }
-'''
+    if dtype is not None:
+        result['dtype'] = numpy.dtype(dtype).name
+    result.update(entries(computed))
+    if frames is not None:
+        result['frames'] = [entries(frame) for frame in frames]
+    return result
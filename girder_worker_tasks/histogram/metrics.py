@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+Timings and counters of histogram tasks, so that slow tasks can be traced to
+downloading, decoding, counting, or writing the histogram.
+
+A task collects its metrics with collecting; the chunks read while it is
+active are timed.  Worker processes run one task at a time, so the metrics
+being collected are kept in a module global that the counting threads of the
+task share.
+"""
+
+import contextlib
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+_current = None
+_currentLock = threading.Lock()
+
+
+def _processPeakRss():
+    """
+    :returns: the peak resident memory of the process in bytes over its whole
+        lifetime, or None if it is not known.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TaskMetrics(object):
+    """
+    Durations of the phases of a task, in seconds, and counters.  Phases that
+    run in several threads (read and count) are summed over the threads.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._startRss = _processPeakRss()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def count(self, counter, value):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a block of code as a phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timedChunks(self, chunks):
+        """
+        Wrap a chunks function so that the time spent reading each chunk
+        (read) and using it (count) is recorded, along with the number of
+        pixels and bytes read.
+
+        :param chunks: a function like histogram._imageChunks returns.  Its
+            iterators may return (top, left, array) tuples instead of arrays.
+        :returns: a function like chunks.
+        """
+        def timed(*args, **kwargs):
+            read = used = 0
+            pixels = nbytes = 0
+            iterator = iter(chunks(*args, **kwargs))
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        chunk = next(iterator)
+                    except StopIteration:
+                        read += time.perf_counter() - start
+                        break
+                    read += time.perf_counter() - start
+                    array = chunk[-1] if isinstance(chunk, tuple) else chunk
+                    pixels += array.shape[0] * (
+                        array.shape[1] if array.ndim > 1 else 1)
+                    nbytes += array.nbytes
+                    start = time.perf_counter()
+                    yield chunk
+                    used += time.perf_counter() - start
+            finally:
+                self.add('read', read)
+                self.add('count', used)
+                self.count('pixelsRead', pixels)
+                self.count('bytesDecoded', nbytes)
+        return timed
+
+    def result(self):
+        """
+        :returns: a dictionary with phases and counters.  When it is known,
+            the counters include processPeakRss, the peak resident memory in
+            bytes of the worker process over its whole lifetime, which may
+            have been reached by an earlier task, and peakRssIncrease, how
+            far this task raised that peak.
+        """
+        with self._lock:
+            result = {'phases': dict(self.phases),
+                      'counters': dict(self.counters)}
+        peakRss = _processPeakRss()
+        if peakRss is not None:
+            result['counters']['processPeakRss'] = peakRss
+            result['counters']['peakRssIncrease'] = max(
+                0, peakRss - self._startRss)
+        return result
+
+
+@contextlib.contextmanager
+def collecting(metrics):
+    """
+    Collect the metrics of the chunks read in a block of code.
+
+    :param metrics: a TaskMetrics instance.
+    """
+    global _current
+
+    with _currentLock:
+        previous, _current = _current, metrics
+    try:
+        yield metrics
+    finally:
+        with _currentLock:
+            _current = previous
+
+
+def timedChunks(chunks):
+    """
+    Time a chunks function if metrics are being collected.
+
+    :returns: a function like chunks.
+    """
+    metrics = _current
+    if metrics is None:
+        return chunks
+    return metrics.timedChunks(chunks)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+Operations on computed histograms.
+
+Histograms are dictionaries with label, bitmask, bins, hist, and binEdges
+entries, as written by the histogram task and read by formats.loads.
+Histograms of multi-channel images have a hist and binEdges for each channel
+in their channels entry.  Histograms of stacks may have a frames entry with
+the hist and binEdges or channels of each frame.  Histograms record the
+dtype of their image when it is known.  The counts of each cell of a grid
+over an image are stored apart from its histogram, as tiles with size, shape,
+and hist entries, so that the histograms of regions can be found quickly.
+"""
+
+import numpy
+
+
+# Keys of a histogram that hold counts rather than metadata.
+ENTRY_KEYS = ('hist', 'binEdges', 'cumulative', 'channels', 'frames')
+
+# Keys of a histogram that describe the job that computed it, which don't
+# apply to histograms derived from it.
+JOB_KEYS = ('metrics', 'jobId')
+
+
+def _isUnitBins(binEdges):
+    """
+    Check if the bins of a histogram each hold one integer value.
+    """
+    return (len(binEdges) > 1 and float(binEdges[0]).is_integer() and
+            bool(numpy.all(numpy.diff(binEdges) == 1)))
+
+
+def rebin(hist, binEdges, newEdges):
+    """
+    Redistribute the counts of a histogram into different bins.  Counts are
+    assumed to be spread evenly within each of the original bins, so the
+    result is exact when every new edge is also an original edge.
+
+    :param hist: the counts of the histogram.
+    :param binEdges: the edges of the histogram's bins.
+    :param newEdges: the edges of the bins to count into.
+    :returns: a float array of counts with one fewer entry than newEdges.
+    """
+    cumulative = numpy.concatenate(([0], numpy.cumsum(hist, dtype=float)))
+    return numpy.diff(numpy.interp(newEdges, binEdges, cumulative))
+
+
+def merge(histograms, bins=None):
+    """
+    Combine histograms of several images into the histogram of all of their
+    pixels.  Histograms with the same bin edges are summed.  Otherwise, they
+    are re-binned into bins covering the range of all of them: one bin per
+    value if every histogram has one bin per integer value (e.g., uint8 and
+    bitmask histograms), or else evenly spaced bins.
+
+    :param histograms: a list of histograms with the same label and bitmask
+        values.
+    :param bins: the number of evenly spaced bins to re-bin into.  Defaults
+        to the largest number of bins in any of the histograms.
+    :returns: the combined histogram, or None if histograms is empty.
+    """
+    if not histograms:
+        return None
+    first = histograms[0]
+    if 'channels' in first or any('channels' in histogram
+                                  for histogram in histograms):
+        names = list(first.get('channels', {}))
+        if any(list(histogram.get('channels', {})) != names
+               for histogram in histograms):
+            raise ValueError('Histograms with different channels cannot be '
+                             'merged.')
+        channels = {}
+        for name in names:
+            merged = merge([{
+                'label': histogram['label'],
+                'bitmask': histogram['bitmask'],
+                'bins': histogram['bins'],
+                'hist': histogram['channels'][name]['hist'],
+                'binEdges': histogram['channels'][name]['binEdges'],
+            } for histogram in histograms], bins)
+            channels[name] = {'hist': merged['hist'],
+                              'binEdges': merged['binEdges']}
+        return {
+            'label': first['label'],
+            'bitmask': first['bitmask'],
+            'bins': first['bins'] if bins is None else bins,
+            'channels': channels,
+        }
+    binEdges = numpy.asarray(first['binEdges'])
+    if all(numpy.array_equal(histogram['binEdges'], binEdges)
+           for histogram in histograms):
+        hist = sum(numpy.asarray(histogram['hist'])
+                   for histogram in histograms)
+    else:
+        low = min(histogram['binEdges'][0] for histogram in histograms)
+        high = max(histogram['binEdges'][-1] for histogram in histograms)
+        if all(_isUnitBins(histogram['binEdges'])
+               for histogram in histograms):
+            binEdges = numpy.arange(low, high + 1)
+        else:
+            bins = bins or max(len(histogram['hist'])
+                               for histogram in histograms)
+            binEdges = numpy.linspace(low, high, bins + 1)
+        hist = sum(rebin(histogram['hist'], histogram['binEdges'], binEdges)
+                   for histogram in histograms)
+    return {
+        'label': first['label'],
+        'bitmask': first['bitmask'],
+        'bins': first['bins'] if bins is None else bins,
+        'hist': hist,
+        'binEdges': binEdges,
+    }
+
+
+def quantiles(hist, binEdges, q, cumulative=None):
+    """
+    Find the values below which given fractions of the pixels of a histogram
+    fall.  Pixels are assumed to be spread evenly within each bin.
+
+    :param hist: the counts of the histogram.
+    :param binEdges: the edges of the histogram's bins.
+    :param q: a list of fractions between 0 and 1.
+    :param cumulative: the running total of hist, if it is stored.
+    :returns: a list of values, or Nones if the histogram has no pixels.
+    """
+    if cumulative is None:
+        cumulative = numpy.cumsum(hist)
+    cumulative = numpy.asarray(cumulative, dtype=float)
+    total = cumulative[-1] if len(cumulative) else 0
+    if not total:
+        return [None] * len(q)
+    targets = numpy.asarray(q, dtype=float) * total
+    # The first bin whose running total reaches each target, skipping empty
+    # bins at the start
+    index = numpy.maximum(
+        numpy.searchsorted(cumulative, targets, side='left'),
+        numpy.searchsorted(cumulative, 0, side='right'))
+    index = numpy.minimum(index, len(cumulative) - 1)
+    before = numpy.where(index > 0, cumulative[index - 1], 0)
+    counts = cumulative[index] - before
+    fraction = numpy.where(
+        counts > 0, (targets - before) / numpy.where(counts > 0, counts, 1), 0)
+    low = numpy.asarray(binEdges, dtype=float)[index]
+    high = numpy.asarray(binEdges, dtype=float)[index + 1]
+    return (low + fraction * (high - low)).tolist()
+
+
+def frameHistogram(histogram, frame):
+    """
+    Get the histogram of one frame of a histogram of a stack.
+
+    :param histogram: a histogram with a frames entry.
+    :param frame: the index of the frame.
+    :returns: a histogram with the metadata of histogram, the counts of the
+        frame, and a frame entry with its index.
+    """
+    frames = histogram.get('frames')
+    if not frames:
+        raise ValueError('The histogram does not have per-frame counts.')
+    if not 0 <= frame < len(frames):
+        raise ValueError('Frame must be between 0 and %d.' % (
+            len(frames) - 1))
+    result = {key: value for key, value in histogram.items()
+              if key not in ENTRY_KEYS}
+    result.update(frames[frame])
+    result['frame'] = frame
+    return result
+
+
+def countValues(values, binEdges, label=False, bitmask=False):
+    """
+    Count pixel values into the bins of a histogram, assigning each value to
+    the same bin as the histogram task does.
+
+    :param values: a numpy array of pixel values.
+    :param binEdges: the edges of the histogram's bins.
+    :param label: if True, zero values are not counted.
+    :param bitmask: if True, count the pixels with each bit set, as in bitmask
+        histograms, whose binEdges are the bit numbers.
+    :returns: an array of counts like the histogram's hist.
+    """
+    values = numpy.asarray(values).ravel()
+    if label:
+        values = values[values != 0]
+    if bitmask:
+        bits = values.astype(numpy.uint64)
+        counts = [numpy.count_nonzero((bits >> numpy.uint64(bit)) & 1)
+                  for bit in range(int(binEdges[-1]))]
+        if not label:
+            counts.insert(0, values.size - numpy.count_nonzero(values))
+        return numpy.array(counts, dtype=numpy.int64)
+    bins = len(binEdges) - 1
+    index = numpy.searchsorted(binEdges, values, side='right') - 1
+    # The last bin includes its upper edge.
+    index[values == binEdges[-1]] = bins - 1
+    index = index[(index >= 0) & (index < bins)]
+    return numpy.bincount(index, minlength=bins).astype(numpy.int64)
+
+
+def regionHistogram(histogram, tiles, left, top, right, bottom, readRegion):
+    """
+    Get the histogram of a rectangular region of an image from its tile
+    counts.  The counts of the cells inside the region are summed, so only
+    the pixels at the edges of the region that partly cover cells are read.
+
+    :param histogram: a single channel histogram.
+    :param tiles: the tile counts of the image, with size, shape, and hist
+        entries, as written by the histogram task.
+    :param left: the left edge of the region in pixels.
+    :param top: the top edge of the region.
+    :param right: the right edge of the region, exclusive.
+    :param bottom: the bottom edge of the region, exclusive.
+    :param readRegion: a function taking left, top, right, and bottom and
+        returning the pixels of that part of the image as a numpy array.
+    :returns: a histogram with the metadata and bins of histogram, the counts
+        of the region, and a region entry with its clipped bounds.
+    """
+    if not tiles:
+        raise ValueError('The histogram does not have tile counts.')
+    height, width = tiles['shape']
+    size = tiles['size']
+    left, top = max(left, 0), max(top, 0)
+    right, bottom = min(right, width), min(bottom, height)
+    if left >= right or top >= bottom:
+        raise ValueError('The region does not overlap the image.')
+    label, bitmask = histogram['label'], histogram['bitmask']
+    cells = numpy.asarray(tiles['hist'])
+    # The cells entirely inside the region.  Cells at the right and bottom
+    # of the image may be smaller than the others.
+    firstRow, firstColumn = -(-top // size), -(-left // size)
+    lastRow = cells.shape[0] if bottom == height else bottom // size
+    lastColumn = cells.shape[1] if right == width else right // size
+    hist = numpy.zeros(cells.shape[2], dtype=numpy.int64)
+    strips = [(left, top, right, bottom)]
+    if firstRow < lastRow and firstColumn < lastColumn:
+        hist += cells[firstRow:lastRow, firstColumn:lastColumn].sum(
+            axis=(0, 1)).astype(numpy.int64)
+        innerTop, innerLeft = firstRow * size, firstColumn * size
+        innerBottom = min(lastRow * size, height)
+        innerRight = min(lastColumn * size, width)
+        strips = [(left, top, right, innerTop),
+                  (left, innerBottom, right, bottom),
+                  (left, innerTop, innerLeft, innerBottom),
+                  (innerRight, innerTop, right, innerBottom)]
+    for stripLeft, stripTop, stripRight, stripBottom in strips:
+        if stripLeft < stripRight and stripTop < stripBottom:
+            hist += countValues(
+                readRegion(stripLeft, stripTop, stripRight, stripBottom),
+                histogram['binEdges'], label, bitmask)
+    result = {key: value for key, value in histogram.items()
+              if key not in ENTRY_KEYS}
+    result.update({
+        'hist': hist,
+        'binEdges': histogram['binEdges'],
+        'region': {'left': left, 'top': top,
+                   'right': right, 'bottom': bottom},
+    })
+    if not bitmask:
+        result['cumulative'] = numpy.cumsum(hist)
+    return result
+
+
+def _isInteger(histogram):
+    dtype = histogram.get('dtype')
+    return dtype is not None and (numpy.issubdtype(dtype, numpy.integer) or
+                                  dtype == 'bool')
+
+
+def _integerValues(hist, binEdges, closed=True):
+    """
+    Get the value of each bin of a histogram of an integer image, if every
+    bin with pixels contains exactly one integer, so that the count of each
+    value is known.
+
+    :param closed: whether the last bin includes its upper edge.  uint8
+        histograms have one bin per value with an extra upper edge.
+    :returns: values, counts for the bins with pixels, or None.
+    """
+    hist = numpy.asarray(hist)
+    binEdges = numpy.asarray(binEdges, dtype=float)
+    first = numpy.ceil(binEdges[:-1])
+    # Bins include their lower edge, and the last bin its upper edge.
+    last = numpy.ceil(binEdges[1:]) - 1
+    if closed:
+        last[-1] = numpy.floor(binEdges[-1])
+    present = hist != 0
+    if not numpy.all(first[present] == last[present]):
+        return None
+    return first[present].astype(numpy.int64), hist[present]
+
+
+def _entries(histogram):
+    if 'channels' in histogram:
+        return histogram['channels']
+    return {None: histogram}
+
+
+def _withEntries(histogram, bins, entries):
+    result = {key: value for key, value in histogram.items()
+              if key not in ENTRY_KEYS}
+    result['bins'] = bins
+    for entry in entries.values():
+        entry['cumulative'] = numpy.cumsum(entry['hist'])
+    if None in entries:
+        result.update(entries[None])
+    else:
+        result['channels'] = entries
+    return result
+
+
+def rebinHistogram(histogram, bins, low=None, high=None):
+    """
+    Re-bin a histogram into evenly spaced bins.  Histograms of integer images
+    whose bins each hold a single value are re-binned exactly; otherwise,
+    pixels are assumed to be spread evenly within each bin and the new counts
+    may be fractional.
+
+    :param histogram: the histogram to re-bin.  Bitmask histograms cannot be
+        re-binned.
+    :param bins: the number of new bins.
+    :param low: the lower edge of the new bins.  Defaults to the lowest value
+        in the histogram.
+    :param high: the upper edge of the new bins.  Defaults to the highest
+        value in the histogram.
+    :returns: the re-binned histogram.
+    """
+    if histogram.get('bitmask'):
+        raise ValueError('Bitmask histograms cannot be re-binned.')
+    if low is not None and high is not None and low >= high:
+        raise ValueError('The minimum must be less than the maximum.')
+    entries = {}
+    for name, entry in _entries(histogram).items():
+        values = None
+        if _isInteger(histogram):
+            values = _integerValues(entry['hist'], entry['binEdges'],
+                                    histogram['dtype'] != 'uint8')
+        if values is not None and len(values[0]):
+            values, counts = values
+            _range = (values[0] if low is None else low,
+                      values[-1] if high is None else high)
+            hist, binEdges = numpy.histogram(
+                values, bins=bins, range=_range, weights=counts)
+        else:
+            binEdges = numpy.linspace(
+                entry['binEdges'][0] if low is None else low,
+                entry['binEdges'][-1] if high is None else high, bins + 1)
+            hist = rebin(entry['hist'], entry['binEdges'], binEdges)
+        entries[name] = {'hist': hist, 'binEdges': binEdges}
+    return _withEntries(histogram, bins, entries)
+
+
+def derive(histogram, bins):
+    """
+    Get the histogram that computing with a different number of bins would
+    produce, if the stored counts determine it exactly: for bitmask and uint8
+    histograms, which don't depend on the number of bins, and for integer
+    images with the count of each value.
+
+    :param histogram: a computed histogram.
+    :param bins: the number of bins of the histogram to derive.
+    :returns: the derived histogram, without the metrics of the job that
+        computed histogram, or None if it cannot be derived.
+    """
+    histogram = {key: value for key, value in histogram.items()
+                 if key not in JOB_KEYS}
+    if histogram.get('bitmask') or histogram.get('dtype') == 'uint8':
+        return dict(histogram, bins=bins)
+    if not _isInteger(histogram):
+        return None
+    entries = {}
+    for name, entry in _entries(histogram).items():
+        values = _integerValues(entry['hist'], entry['binEdges'])
+        if values is None or not len(values[0]):
+            return None
+        values, counts = values
+        # The same binning as the worker uses for exact integer counts
+        hist, binEdges = numpy.histogram(
+            values, bins=bins, range=(int(values[0]), int(values[-1])),
+            weights=counts)
+        entries[name] = {'hist': hist.astype(numpy.int64),
+                         'binEdges': binEdges}
+    return _withEntries(histogram, bins, entries)
@@ -0,0 +1,837 @@
+#!/usr/bin/env python
+
+"""
+Image readers.
+
+Readers are kept in a registry ordered by priority.  An image is opened with
+the first reader that can read it, preferring readers with the capabilities
+the histogram engine wants.  An opened image reports its capabilities:
+
+mapped
+    The pixels can be read from a memory map of the file without decoding
+    them, so reading costs no more than counting.
+
+tiled
+    The pixels can be decoded one tile, strip, or slice at a time, so memory
+    use depends on the tile size rather than the image size.
+
+multichannel
+    Each pixel has several channels, which are counted separately.
+
+Images may be stacks of frames, such as the pages of a multi-page TIFF, the
+slices of a volume, or the time points of a series.  Each frame is an image
+with its own capabilities.
+
+Readers that need an optional package (tifffile, large_image, pytiff,
+nibabel, pydicom) are skipped when it isn't installed.
+"""
+
+import contextlib
+import functools
+import os
+import threading
+
+import numpy
+
+
+# Number of rows read at a time from untiled images when streaming.
+STREAMING_ROWS = 256
+
+# Numpy types of uncompressed TIFF pixel data that can be counted directly
+# from a memory map of the file, keyed by PIL raw mode.  These are the same
+# types PIL decodes the data to.
+MAPPED_RAWMODES = {
+    'L': 'u1',
+    'P': 'u1',
+    'RGB': ('u1', (3,)),
+    'RGBA': ('u1', (4,)),
+    'I;16': '<u2',
+    'I;16B': '>u2',
+    'I;32S': '<i4',
+    'I;32BS': '>i4',
+    'F;32F': '<f4',
+    'F;32BF': '>f4',
+}
+
+# The largest width or height of the low resolution levels read as
+# overviews.
+OVERVIEW_SIZE = 1024
+
+# PIL image modes that can be counted.
+PIL_MODES = ('1', 'L', 'P', 'I', 'F', 'I;16', 'I;16B', 'RGB', 'RGBA')
+
+NUMPY_MAGIC = b'\x93NUMPY'
+
+
+def partition(items, part, parts):
+    """
+    Get one of several contiguous ranges of a sequence.
+
+    :param items: the sequence to divide.
+    :param part: the index of the range to get.
+    :param parts: the number of ranges.
+    :returns: the part-th range of items.
+    """
+    return items[len(items) * part // parts:len(items) * (part + 1) // parts]
+
+
+def _overlaps(region, top, left, height, width):
+    """
+    Check if a chunk of an image overlaps a region.
+
+    :param region: None for the whole image, or (left, top, right, bottom).
+    :returns: True if the chunk should be read.
+    """
+    if region is None:
+        return True
+    return (left < region[2] and left + width > region[0] and
+            top < region[3] and top + height > region[1])
+
+
+class Image(object):
+    """
+    An image opened by a reader.
+
+    :param reader: the reader that opened the image.
+    :param shape: the (height, width) of the image in pixels.
+    :param read: a function returning every pixel as one numpy array.
+    :param tileChunks: if the image is tiled, a function like
+        histogram._imageChunks returns that decodes one tile at a time.
+    :param mappedChunks: if the image is mapped, a function like
+        histogram._imageChunks returns that reads a memory map of the file.
+        Both functions also take a positions argument; if it is True, they
+        return (top, left, array) tuples with the location of each array in
+        the image.  They also take a region argument, (left, top, right,
+        bottom); if it is given, chunks that don't overlap it are skipped
+        without being decoded.
+    :param channels: the number of channels of each pixel.
+    :param frames: the number of frames in the stack.  This image is the
+        first frame.
+    :param frame: a function taking a frame index and returning an Image of
+        that frame.  Frames are requested in order.
+    :param sampleRange: the (low, high) range of the values of the image, if
+        the file records it, e.g., in TIFF SMinSampleValue and
+        SMaxSampleValue tags.
+    :param overview: a function returning the pixels of a low resolution
+        level of the image as a numpy array, if the file has one.
+    """
+    def __init__(self, reader, shape, read, tileChunks=None,
+                 mappedChunks=None, channels=1, frames=1, frame=None,
+                 sampleRange=None, overview=None):
+        self.reader = reader
+        self.shape = tuple(shape)
+        self.read = read
+        self.tileChunks = tileChunks
+        self.mappedChunks = mappedChunks
+        self.channels = channels
+        self.frames = frames
+        self._frame = frame
+        self.sampleRange = sampleRange
+        self.overview = overview
+
+    def frame(self, index):
+        """
+        Get one frame of a stack.
+
+        :param index: the index of the frame.
+        :returns: an Image.
+        """
+        if not 0 <= index < self.frames:
+            raise IndexError('Frame %d is out of range.' % index)
+        if index == 0 or self._frame is None:
+            return self
+        return self._frame(index)
+
+    def readRegion(self, left, top, right, bottom):
+        """
+        Read a rectangle of the image.  Only the chunks that overlap it are
+        decoded, so images that are neither mapped nor tiled are read whole.
+
+        :param left: the left edge of the rectangle in pixels.
+        :param top: the top edge of the rectangle.
+        :param right: the right edge of the rectangle, exclusive.
+        :param bottom: the bottom edge of the rectangle, exclusive.
+        :returns: a numpy array of the pixels of the rectangle.
+        """
+        chunks = self.mappedChunks or self.tileChunks
+        if chunks is None:
+            return self.read()[top:bottom, left:right]
+        result = None
+        for chunkTop, chunkLeft, chunk in chunks(
+                positions=True, region=(left, top, right, bottom)):
+            # Chunks at the edges of the image may extend past it.
+            chunk = chunk[:self.shape[0] - chunkTop,
+                          :self.shape[1] - chunkLeft]
+            if not _overlaps((left, top, right, bottom), chunkTop,
+                             chunkLeft, *chunk.shape[:2]):
+                continue
+            if result is None:
+                result = numpy.zeros(
+                    (bottom - top, right - left) + chunk.shape[2:],
+                    chunk.dtype)
+            result[max(chunkTop - top, 0):chunkTop + chunk.shape[0] - top,
+                   max(chunkLeft - left, 0):
+                   chunkLeft + chunk.shape[1] - left] = chunk[
+                max(top - chunkTop, 0):bottom - chunkTop,
+                max(left - chunkLeft, 0):right - chunkLeft]
+        if result is None:
+            return self.read()[top:bottom, left:right]
+        return result
+
+    @property
+    def pixels(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def mapped(self):
+        return self.mappedChunks is not None
+
+    @property
+    def tiled(self):
+        return self.tileChunks is not None
+
+    @property
+    def multichannel(self):
+        return self.channels > 1
+
+
+class Reader(object):
+    """
+    Base class for image readers.
+
+    Subclasses set name and capabilities and implement open.  capabilities
+    lists what images opened by the reader may be able to do, so that
+    readers that never have a preferred capability can be skipped.
+    """
+    name = None
+    capabilities = frozenset()
+
+    def open(self, in_path):
+        """
+        Open an image.
+
+        :param in_path: path to the image.
+        :returns: an Image, or None if the reader doesn't support the file.
+        :raises ImportError: if the reader's package isn't installed.
+        """
+        raise NotImplementedError
+
+
+def _rowChunks(array, part=0, parts=1, positions=False, region=None):
+    rows = partition(range(array.shape[0]), part, parts)
+    for top in range(rows.start, rows.stop, STREAMING_ROWS):
+        if not _overlaps(region, top, 0, min(STREAMING_ROWS, rows.stop - top),
+                         array.shape[1]):
+            continue
+        chunk = array[top:min(top + STREAMING_ROWS, rows.stop)]
+        if not chunk.dtype.isnative:
+            chunk = chunk.astype(chunk.dtype.newbyteorder('='))
+        yield (top, 0, chunk) if positions else chunk
+
+
+class NumpyReader(Reader):
+    """
+    Read NumPy .npy files, which are always mapped.  Arrays with more than
+    two dimensions are stacks of frames of their last two dimensions, except
+    that a last dimension of up to four entries holds channels.
+    """
+    name = 'numpy'
+    capabilities = frozenset(('mapped', 'tiled', 'multichannel'))
+
+    def open(self, in_path):
+        with open(in_path, 'rb') as fp:
+            if fp.read(len(NUMPY_MAGIC)) != NUMPY_MAGIC:
+                return None
+        array = numpy.load(in_path, mmap_mode='r')
+        channels = 1
+        if array.ndim > 3 and array.shape[-1] <= 4:
+            channels = array.shape[-1]
+            frameShape = array.shape[-3:]
+        elif array.ndim == 3 and array.shape[-1] <= 4:
+            channels = array.shape[-1]
+            frameShape = array.shape
+        else:
+            frameShape = ((1,) + array.shape)[-2:]
+        stack = array.reshape((-1,) + frameShape)
+
+        def frameImage(index):
+            chunks = functools.partial(_rowChunks, stack[index])
+            return Image(self, frameShape[:2],
+                         lambda: numpy.concatenate(list(chunks())),
+                         tileChunks=chunks, mappedChunks=chunks,
+                         channels=channels, frames=len(stack),
+                         frame=frameImage)
+
+        return frameImage(0)
+
+
+_pilOpenLock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _pilPixelLimit():
+    """
+    Lift PIL's decompression bomb check while an image is opened.  Opening
+    only reads the header; the histogram engine streams large images rather
+    than decoding them at once.
+    """
+    import PIL.Image
+
+    with _pilOpenLock:
+        limit = PIL.Image.MAX_IMAGE_PIXELS
+        PIL.Image.MAX_IMAGE_PIXELS = None
+        try:
+            yield
+        finally:
+            PIL.Image.MAX_IMAGE_PIXELS = limit
+
+
+def _pilTiles(image):
+    """
+    Get the strips or tiles of a PIL TIFF image that can be decoded one at a
+    time, along with their byte counts.
+
+    :param image: a PIL image.
+    :returns: a list of (tile, byteCount) tuples, or None if the image cannot
+        be read piecewise.
+    """
+    tags = getattr(image, 'tag_v2', None)
+    if image.format != 'TIFF' or tags is None or len(image.tile) < 2:
+        return None
+    counts = tags.get(325) or tags.get(279)  # TileByteCounts, StripByteCounts
+    if not counts or len(counts) != len(image.tile):
+        return None
+    if any(tile[0] != 'raw' for tile in image.tile):
+        return None
+    return list(zip(image.tile, counts))
+
+
+def _mappedTiles(in_path, image):
+    """
+    Find the uncompressed strips or tiles of a PIL TIFF image so that they
+    can be read from a memory map of the file instead of being decoded.
+
+    :param in_path: path to the image.
+    :param image: a PIL image.
+    :returns: a numpy dtype, which has a subarray of channels for
+        multi-channel images, and a list of (offset, (height, width),
+        rowStride, (top, left)) tuples, or None if the pixel data is
+        compressed or cannot be mapped.
+    """
+    if image.format != 'TIFF' or not image.tile:
+        return None
+    fileSize = os.path.getsize(in_path)
+    dtype = None
+    tiles = []
+    for tile in image.tile:
+        decoder, extents, offset, args = tile[:4]
+        # args are (rawmode, rowStride, orientation)
+        if (decoder != 'raw' or args[0] not in MAPPED_RAWMODES or
+                (len(args) > 2 and args[2] != 1)):
+            return None
+        tileDtype = numpy.dtype(MAPPED_RAWMODES[args[0]])
+        if dtype not in (None, tileDtype):
+            return None
+        dtype = tileDtype
+        width = extents[2] - extents[0]
+        height = extents[3] - extents[1]
+        stride = (len(args) > 1 and args[1]) or width * dtype.itemsize
+        if offset + (height - 1) * stride + width * dtype.itemsize > fileSize:
+            return None
+        tiles.append((offset, (height, width), stride,
+                      (extents[1], extents[0])))
+    return dtype, tiles
+
+
+def _sampleRange(low, high):
+    """
+    Get the range of values recorded in TIFF SMinSampleValue and
+    SMaxSampleValue tags, which have one value per channel or one for all
+    channels.
+
+    :returns: (low, high), or None if either tag is missing.
+    """
+    if low is None or high is None:
+        return None
+    low = numpy.atleast_1d(low)
+    high = numpy.atleast_1d(high)
+    if not low.size or not high.size:
+        return None
+    return low.min().item(), high.max().item()
+
+
+def _iterPILChunks(in_path, mode, tiles, part=0, parts=1, positions=False,
+                   region=None):
+    import PIL.Image
+
+    # Each caller gets its own file handle so that parts can be read in
+    # parallel.
+    with open(in_path, 'rb') as fp:
+        for tile, count in partition(tiles, part, parts):
+            decoder, extents, offset, args = tile[:4]
+            size = (extents[2] - extents[0], extents[3] - extents[1])
+            if not _overlaps(region, extents[1], extents[0], size[1],
+                             size[0]):
+                continue
+            fp.seek(offset)
+            chunk = numpy.array(PIL.Image.frombytes(
+                mode, size, fp.read(count), decoder, *args))
+            yield (extents[1], extents[0], chunk) if positions else chunk
+
+
+def _iterMappedChunks(in_path, dtype, tiles, part=0, parts=1,
+                      positions=False, region=None):
+    # The chunks are views of the mapped file, so pixels are only read when
+    # they are counted, and come from the page cache if it has them.
+    data = numpy.memmap(in_path, mode='r')
+    for offset, (height, width), stride, (tileTop, left) in partition(
+            tiles, part, parts):
+        for top in range(0, height, STREAMING_ROWS):
+            rows = min(STREAMING_ROWS, height - top)
+            if not _overlaps(region, tileTop + top, left, rows, width):
+                continue
+            chunk = numpy.ndarray(
+                (rows, width), dtype, data, offset + top * stride,
+                (stride, dtype.itemsize))
+            if not dtype.isnative:
+                chunk = chunk.astype(dtype.newbyteorder('='))
+            yield (tileTop + top, left, chunk) if positions else chunk
+
+
+def _readPILFrame(in_path, index):
+    import PIL.Image
+
+    with _pilPixelLimit():
+        image = PIL.Image.open(in_path)
+    image.seek(index)
+    return numpy.array(image)
+
+
+class PILReader(Reader):
+    """
+    Read images with PIL.  Uncompressed TIFF images are mapped, and TIFF
+    images whose strips or tiles PIL can decode separately are tiled.  The
+    pages of multi-page images are frames.
+    """
+    name = 'pil'
+    capabilities = frozenset(('mapped', 'tiled', 'multichannel'))
+
+    def open(self, in_path):
+        import PIL.Image
+
+        try:
+            with _pilPixelLimit():
+                image = PIL.Image.open(in_path)
+        except (IOError, OSError):
+            return None
+        frames = getattr(image, 'n_frames', 1)
+
+        def frameImage(index):
+            # Seeking forward from the previous frame only reads the
+            # headers between them.
+            if image.tell() != index:
+                image.seek(index)
+            if image.mode not in PIL_MODES:
+                raise ValueError('invalid image type for histogram: %s' %
+                                 image.mode)
+            mappedChunks = tileChunks = None
+            mappedTiles = _mappedTiles(in_path, image)
+            if mappedTiles is not None:
+                mappedChunks = functools.partial(
+                    _iterMappedChunks, in_path, *mappedTiles)
+            tiles = _pilTiles(image)
+            if tiles is not None:
+                tileChunks = functools.partial(
+                    _iterPILChunks, in_path, image.mode, tiles)
+            tags = getattr(image, 'tag_v2', None) or {}
+            return Image(self, (image.size[1], image.size[0]),
+                         functools.partial(_readPILFrame, in_path, index),
+                         tileChunks=tileChunks, mappedChunks=mappedChunks,
+                         channels=len(image.getbands()), frames=frames,
+                         frame=frameImage,
+                         # SMinSampleValue, SMaxSampleValue
+                         sampleRange=_sampleRange(
+                             tags.get(340), tags.get(341)))
+
+        return frameImage(0)
+
+
+def _tifffileSegmentBox(page, segment):
+    """
+    Find where a strip or tile of a single plane TIFF page is without
+    decoding it.
+
+    :returns: the (top, left, height, width) of the segment.
+    """
+    if page.is_tiled:
+        across = -(-page.imagewidth // page.tilewidth)
+        return ((segment // across) * page.tilelength,
+                (segment % across) * page.tilewidth,
+                page.tilelength, page.tilewidth)
+    return (segment * page.rowsperstrip, 0, page.rowsperstrip,
+            page.imagewidth)
+
+
+def _iterTifffileChunks(in_path, index, part=0, parts=1, positions=False,
+                        region=None):
+    import tifffile
+
+    # Each caller gets its own file handle so that parts can be read in
+    # parallel.
+    with tifffile.TiffFile(in_path) as tiff:
+        page = tiff.pages[index]
+        fh = tiff.filehandle
+        segments = list(zip(page.dataoffsets, page.databytecounts))
+        for segment in partition(range(len(segments)), part, parts):
+            if not _overlaps(region, *_tifffileSegmentBox(page, segment)):
+                continue
+            offset, count = segments[segment]
+            fh.seek(offset)
+            # indices are the segment's position in the (separate sample,
+            # depth, length, width, contig sample) shape of the page.
+            data, indices, shape = page.decode(
+                fh.read(count), segment, jpegtables=page.jpegtables)
+            # Edge tiles are cropped to the image, and missing tiles are
+            # filled with zeros.
+            if data is None:
+                data = numpy.zeros(shape, page.dtype)
+            data = data.reshape(shape[-3], shape[-2], shape[-1])
+            if shape[-1] == 1:
+                data = data[:, :, 0]
+            yield (indices[-3], indices[-2], data) if positions else data
+
+
+class TifffileReader(Reader):
+    """
+    Read TIFF images with tifffile, which decodes the strips or tiles of
+    compressed images that PIL can't read piecewise (e.g., deflate, LZW,
+    JPEG, or zstd compressed tiles) one at a time.  Each page is a frame.
+    """
+    name = 'tifffile'
+    capabilities = frozenset(('tiled', 'multichannel'))
+
+    def open(self, in_path):
+        import tifffile
+
+        try:
+            tiff = tifffile.TiffFile(in_path)
+        except tifffile.TiffFileError:
+            return None
+        with tiff:
+            pages = []
+            for page in tiff.pages:
+                channels = page.samplesperpixel
+                # Planar images store each channel in separate segments
+                tiled = (page.planarconfig == 1 or channels == 1) and (
+                    getattr(page, 'imagedepth', 1) == 1)
+                sampleRange = _sampleRange(*(
+                    page.tags[name].value if name in page.tags else None
+                    for name in ('SMinSampleValue', 'SMaxSampleValue')))
+                pages.append((
+                    (page.imagelength, page.imagewidth), channels, tiled,
+                    sampleRange))
+
+        def read(index):
+            with tifffile.TiffFile(in_path) as tiff:
+                return tiff.pages[index].asarray()
+
+        def frameImage(index):
+            shape, channels, tiled, sampleRange = pages[index]
+            return Image(
+                self, shape, functools.partial(read, index),
+                channels=channels, frames=len(pages), frame=frameImage,
+                tileChunks=functools.partial(
+                    _iterTifffileChunks, in_path, index) if tiled else None,
+                sampleRange=sampleRange)
+
+        return frameImage(0)
+
+
+def _iterLargeImageChunks(source, frame, part=0, parts=1, positions=False,
+                          region=None):
+    import large_image
+
+    kwargs = {}
+    if region is not None:
+        kwargs['region'] = {
+            'left': region[0], 'top': region[1], 'right': region[2],
+            'bottom': region[3], 'units': 'base_pixels'}
+    tiles = source.tileIterator(
+        format=large_image.tilesource.TILE_FORMAT_NUMPY, frame=frame,
+        **kwargs)
+    for tile in tiles:
+        # Tiles are only loaded when their pixels are used.
+        if (tile['tile_position']['position'] * parts //
+                tile['iterator_range']['position'] != part):
+            continue
+        data = tile['tile']
+        if data.ndim == 3 and data.shape[2] == 1:
+            data = data[:, :, 0]
+        # gx and gy are the position in the full resolution image, also
+        # when the tiles are cropped to a region.
+        position = (tile.get('gy', tile['y']), tile.get('gx', tile['x']))
+        yield position + (data,) if positions else data
+
+
+class LargeImageReader(Reader):
+    """
+    Read images with any large_image tile source, e.g., whole slide formats.
+    The pixels are read one tile of the full resolution level at a time.
+    Multi-frame sources are stacks.  Lower resolution levels are overviews.
+    """
+    name = 'large_image'
+    capabilities = frozenset(('tiled', 'multichannel'))
+
+    def open(self, in_path):
+        import large_image
+
+        try:
+            source = large_image.getTileSource(in_path)
+        except large_image.exceptions.TileSourceError:
+            return None
+        metadata = source.getMetadata()
+        channels = metadata.get('bandCount') or 1
+        frames = len(metadata.get('frames') or []) or 1
+
+        def read(index, **kwargs):
+            array, _ = source.getRegion(
+                format=large_image.tilesource.TILE_FORMAT_NUMPY, frame=index,
+                **kwargs)
+            if array.ndim == 3 and array.shape[2] == 1:
+                array = array[:, :, 0]
+            return array
+
+        def frameImage(index):
+            overview = None
+            if max(source.sizeX, source.sizeY) > OVERVIEW_SIZE:
+                overview = functools.partial(read, index, output={
+                    'maxWidth': OVERVIEW_SIZE, 'maxHeight': OVERVIEW_SIZE})
+            return Image(self, (source.sizeY, source.sizeX),
+                         functools.partial(read, index),
+                         tileChunks=functools.partial(
+                             _iterLargeImageChunks, source, index),
+                         channels=channels, frames=frames, frame=frameImage,
+                         overview=overview)
+
+        return frameImage(0)
+
+
+def _iterPytiffChunks(in_path, page, origins, chunkShape, part=0, parts=1,
+                      positions=False, region=None):
+    import pytiff
+
+    chunkHeight, chunkWidth = chunkShape
+    with pytiff.Tiff(in_path) as image:
+        if page:
+            image.set_page(page)
+        for top, left in partition(origins, part, parts):
+            if not _overlaps(region, top, left, chunkHeight, chunkWidth):
+                continue
+            chunk = numpy.asarray(
+                image[top:top + chunkHeight, left:left + chunkWidth])
+            yield (top, left, chunk) if positions else chunk
+
+
+class PytiffReader(Reader):
+    """
+    Read TIFF images with pytiff, one tile or block of rows at a time.  Each
+    page is a frame.
+    """
+    name = 'pytiff'
+    capabilities = frozenset(('tiled',))
+
+    def open(self, in_path):
+        import pytiff
+
+        try:
+            image = pytiff.Tiff(in_path)
+        except (IOError, OSError):
+            return None
+        frames = getattr(image, 'number_of_pages', 1) or 1
+
+        def read(page):
+            with pytiff.Tiff(in_path) as image:
+                if page:
+                    image.set_page(page)
+                return numpy.asarray(image[:, :])
+
+        def frameImage(index):
+            if index:
+                image.set_page(index)
+            height, width = image.shape[:2]
+            tileShape = None
+            isTiled = getattr(image, 'is_tiled', None)
+            if callable(isTiled) and isTiled():
+                tileShape = image.tile_shape
+            chunkShape = tileShape or (STREAMING_ROWS, width)
+            origins = [(top, left)
+                       for top in range(0, height, chunkShape[0])
+                       for left in range(0, width, chunkShape[1])]
+            return Image(self, (height, width), functools.partial(read, index),
+                         tileChunks=functools.partial(
+                             _iterPytiffChunks, in_path, index, origins,
+                             chunkShape),
+                         frames=frames, frame=frameImage)
+
+        return frameImage(0)
+
+
+def _readNiftiSlice(in_path, index):
+    import nibabel
+
+    dataobj = nibabel.load(in_path).dataobj
+    # Only the slice is read, with the image's scaling applied.
+    return numpy.asarray(dataobj[(slice(None), slice(None)) + tuple(
+        numpy.unravel_index(index, dataobj.shape[2:]))])
+
+
+class NiftiReader(Reader):
+    """
+    Read NIfTI volumes with nibabel.  Each slice (of each time point) is a
+    frame.  Values are scaled as nibabel does.
+    """
+    name = 'nifti'
+    capabilities = frozenset()
+
+    def open(self, in_path):
+        import nibabel
+
+        try:
+            image = nibabel.load(in_path)
+        except nibabel.filebasedimages.ImageFileError:
+            return None
+        if not isinstance(image, (nibabel.Nifti1Image, nibabel.Nifti2Image)):
+            return None
+        shape = image.shape + (1,) * (2 - len(image.shape))
+        frames = int(numpy.prod(shape[2:], dtype=numpy.int64))
+
+        def frameImage(index):
+            return Image(self, shape[:2],
+                         functools.partial(_readNiftiSlice, in_path, index),
+                         frames=frames, frame=frameImage)
+
+        return frameImage(0)
+
+
+class DicomReader(Reader):
+    """
+    Read DICOM images with pydicom, with the modality rescaling applied.
+    Multi-frame images are stacks.  Their pixels are decoded once, when the
+    first frame is read.
+    """
+    name = 'dicom'
+    capabilities = frozenset(('multichannel',))
+
+    def open(self, in_path):
+        import pydicom
+
+        try:
+            dataset = pydicom.dcmread(in_path, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            return None
+        if 'Rows' not in dataset or 'Columns' not in dataset:
+            return None
+        frames = int(dataset.get('NumberOfFrames') or 1)
+        channels = int(dataset.get('SamplesPerPixel') or 1)
+        shape = (dataset.Rows, dataset.Columns)
+        decoded = []
+        lock = threading.Lock()
+
+        def read(index):
+            from pydicom.pixel_data_handlers.util import apply_modality_lut
+
+            with lock:
+                if not decoded:
+                    full = pydicom.dcmread(in_path)
+                    decoded.append(apply_modality_lut(
+                        full.pixel_array, full).reshape(
+                        (frames,) + shape +
+                        ((channels,) if channels > 1 else ())))
+            return decoded[0][index]
+
+        def frameImage(index):
+            return Image(self, shape, functools.partial(read, index),
+                         channels=channels, frames=frames, frame=frameImage)
+
+        return frameImage(0)
+
+
+_registry = []
+_registryLock = threading.Lock()
+
+
+def register(reader, priority=100):
+    """
+    Add a reader to the registry, replacing any reader with the same name.
+
+    :param reader: a Reader instance.
+    :param priority: readers with lower values are tried first.
+    """
+    with _registryLock:
+        entries = [entry for entry in _registry
+                   if entry[2].name != reader.name]
+        entries.append((priority, len(_registry), reader))
+        _registry[:] = sorted(entries, key=lambda entry: entry[:2])
+
+
+def unregister(name):
+    """
+    Remove a reader from the registry.
+
+    :param name: the name of the reader.
+    """
+    with _registryLock:
+        _registry[:] = [entry for entry in _registry
+                        if entry[2].name != name]
+
+
+def registeredReaders():
+    """
+    :returns: the names of the registered readers in the order they are
+        tried.
+    """
+    return [entry[2].name for entry in _registry]
+
+
+def openImage(in_path, prefer=()):
+    """
+    Open an image with the first reader that can read it and has every
+    preferred capability.  If no reader has them, the image is opened with
+    the first reader that can read it.
+
+    :param in_path: path to the image.
+    :param prefer: a list of capabilities: 'mapped', 'tiled', or
+        'multichannel'.
+    :returns: an Image.
+    :raises ValueError: if no reader can read the image.
+    """
+    fallback = None
+    errors = []
+    for _, _, reader in list(_registry):
+        if fallback is not None and not set(prefer) <= reader.capabilities:
+            continue
+        try:
+            image = reader.open(in_path)
+        except ImportError:
+            continue
+        except Exception as exc:
+            errors.append('%s: %s' % (reader.name, exc))
+            continue
+        if image is None:
+            continue
+        if all(getattr(image, capability) for capability in prefer):
+            return image
+        fallback = fallback or image
+    if fallback is None:
+        raise ValueError('Cannot read image %s (%s)' % (
+            os.path.basename(in_path), '; '.join(errors) or 'unknown format'))
+    return fallback
+
+
+register(NumpyReader(), 10)
+register(PILReader(), 20)
+register(TifffileReader(), 30)
+register(PytiffReader(), 40)
+register(NiftiReader(), 50)
+register(DicomReader(), 60)
+register(LargeImageReader(), 70)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+A mergeable sketch of the distribution of the values of an image, so that a
+histogram can be computed in a single pass without knowing the range of the
+values first.
+
+Values are counted into logarithmically spaced buckets, as in DDSketch
+(Masson et al., 2019): every value in a bucket is within RELATIVE_ACCURACY of
+the bucket's boundaries, whatever the range of the image.  Sketches of
+separate parts of an image are merged by adding their bucket counts.
+"""
+
+import numpy
+
+
+# Values in the same bucket differ by at most this fraction of their size.
+# Buckets are about twice this fraction of their values wide, so histograms
+# of values from 0 to x can have up to about 1 / (2 * RELATIVE_ACCURACY)
+# bins.
+RELATIVE_ACCURACY = 0.001
+
+
+class QuantileSketch(object):
+    """
+    A sketch of a distribution of finite values.
+
+    :param relativeAccuracy: the relative width of each bucket.
+    """
+    def __init__(self, relativeAccuracy=RELATIVE_ACCURACY):
+        self.relativeAccuracy = relativeAccuracy
+        self._logGamma = numpy.log(
+            (1 + relativeAccuracy) / (1 - relativeAccuracy))
+        # Bucket i of each sign holds the magnitudes in
+        # (gamma ** (i - 1), gamma ** i], stored as an offset and counts.
+        self._positive = (0, numpy.zeros(0, dtype=numpy.int64))
+        self._negative = (0, numpy.zeros(0, dtype=numpy.int64))
+        self.zeros = 0
+        self.count = 0
+        self.low = self.high = None
+
+    def _addCounts(self, store, offset, counts):
+        storeOffset, storeCounts = store
+        if not len(storeCounts):
+            return offset, counts
+        start = min(storeOffset, offset)
+        end = max(storeOffset + len(storeCounts), offset + len(counts))
+        merged = numpy.zeros(end - start, dtype=numpy.int64)
+        merged[storeOffset - start:storeOffset - start + len(storeCounts)] += \
+            storeCounts
+        merged[offset - start:offset - start + len(counts)] += counts
+        return start, merged
+
+    def _addMagnitudes(self, store, values):
+        if not values.size:
+            return store
+        index = numpy.ceil(numpy.log(values) / self._logGamma).astype(
+            numpy.int64)
+        offset = int(index.min())
+        return self._addCounts(
+            store, offset, numpy.bincount(index - offset).astype(numpy.int64))
+
+    def add(self, values):
+        """
+        Add values to the sketch.  Values that are not finite are ignored.
+
+        :param values: a numpy array.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        values = values[numpy.isfinite(values)]
+        if not values.size:
+            return
+        low, high = values.min(), values.max()
+        self.low = low if self.low is None else min(self.low, low)
+        self.high = high if self.high is None else max(self.high, high)
+        self.count += values.size
+        positive = values[values > 0]
+        negative = -values[values < 0]
+        self.zeros += values.size - positive.size - negative.size
+        self._positive = self._addMagnitudes(self._positive, positive)
+        self._negative = self._addMagnitudes(self._negative, negative)
+
+    def merge(self, other):
+        """
+        Add the values of another sketch with the same accuracy to this one.
+
+        :param other: a QuantileSketch.
+        :returns: this sketch.
+        """
+        if other.relativeAccuracy != self.relativeAccuracy:
+            raise ValueError('Sketches with different accuracies cannot be '
+                             'merged.')
+        if not other.count:
+            return self
+        self._positive = self._addCounts(self._positive, *other._positive)
+        self._negative = self._addCounts(self._negative, *other._negative)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.low = other.low if self.low is None else min(self.low, other.low)
+        self.high = (other.high if self.high is None else
+                     max(self.high, other.high))
+        return self
+
+    def _distribution(self):
+        """
+        Get the boundaries of the buckets in increasing order, with the number
+        of nonzero values below each boundary.  Boundaries are clipped to the
+        range of the values.
+        """
+        gamma = numpy.exp(self._logGamma)
+        points = []
+        totals = []
+        total = 0
+        negativeOffset, negativeCounts = self._negative
+        if len(negativeCounts):
+            exponents = numpy.arange(
+                negativeOffset + len(negativeCounts) - 1,
+                negativeOffset - 2, -1)
+            points.append(-gamma ** exponents.astype(numpy.float64))
+            totals.append(numpy.concatenate((
+                [0], numpy.cumsum(negativeCounts[::-1]))))
+            total = totals[-1][-1]
+        positiveOffset, positiveCounts = self._positive
+        if len(positiveCounts):
+            exponents = numpy.arange(
+                positiveOffset - 1, positiveOffset + len(positiveCounts))
+            points.append(gamma ** exponents.astype(numpy.float64))
+            totals.append(total + numpy.concatenate((
+                [0], numpy.cumsum(positiveCounts))))
+        if not points:
+            return None, None
+        return (numpy.clip(numpy.concatenate(points), self.low, self.high),
+                numpy.concatenate(totals))
+
+    def resolves(self, binEdges):
+        """
+        Check whether the buckets of the sketch are narrow enough for a
+        histogram.  Where a bin is narrower than the buckets at its values,
+        e.g., for values far from zero in a narrow range, the sketch only
+        knows how many values are near the bin, and the histogram would come
+        out flat there.
+
+        :param binEdges: the edges of the bins.
+        :returns: True if no bin is narrower than a bucket at its edges.
+        """
+        binEdges = numpy.asarray(binEdges, dtype=numpy.float64)
+        magnitudes = numpy.maximum(
+            numpy.abs(binEdges[:-1]), numpy.abs(binEdges[1:]))
+        bucketWidths = magnitudes * (1 - numpy.exp(-self._logGamma))
+        return bool(numpy.all(numpy.diff(binEdges) >= bucketWidths))
+
+    def histogram(self, bins, _range=None):
+        """
+        Get a histogram of the sketched values.  Values are assumed to be
+        spread evenly within each bucket, and the counts are rounded so that
+        they still add up to the number of values.
+
+        :param bins: the number of evenly spaced bins.
+        :param _range: the (low, high) range of the bins.  Defaults to the
+            range of the values.
+        :returns: hist, binEdges as from numpy.histogram.
+        """
+        if _range is None and self.count:
+            _range = (self.low, self.high)
+        binEdges = numpy.histogram(
+            numpy.zeros(0), bins=bins, range=_range)[1]
+        if not self.count:
+            return numpy.zeros(bins, dtype=numpy.int64), binEdges
+        points, totals = self._distribution()
+        # The number of values below each edge, as numpy.histogram counts
+        # them: each bin includes its lower edge, and the last bin its upper
+        # edge.
+        below = numpy.zeros(len(binEdges))
+        if points is not None:
+            below += numpy.interp(binEdges, points, totals)
+        below += self.zeros * (binEdges > 0)
+        if binEdges[0] <= self.low:
+            below[0] = 0
+        if binEdges[-1] >= self.high:
+            below[-1] = self.count
+        hist = numpy.diff(numpy.round(below)).astype(numpy.int64)
+        return hist, binEdges
@@ -345,6 +345,56 @@ $(function () {
             });
         });
 
+        describe('RGB histogram test', function () {
+            it('shows one channel at a time', function () {
+                var HistogramWidget = girder.plugins.histogram.views.widgets.HistogramWidget;
+                var binEdges = [0, 64, 128, 192, 256];
+                var model = new girder.plugins.histogram.models.HistogramModel({
+                    _id: 'rgbHistogram', fileId: 'rgbFile', label: false, bitmask: false
+                });
+                model.fetch = function () {
+                    return $.Deferred().resolve().promise();
+                };
+                // RGB histograms have counts for each channel and no
+                // top-level hist or binEdges.
+                model.fetchData = function () {
+                    return $.Deferred().resolve({
+                        label: false,
+                        bitmask: false,
+                        bins: 4,
+                        channels: {
+                            red: {hist: [1, 2, 3, 4], binEdges: binEdges},
+                            green: {hist: [7, 0, 0, 0], binEdges: binEdges},
+                            blue: {hist: [0, 0, 0, 5], binEdges: binEdges}
+                        }
+                    }).promise();
+                };
+                model.fetchQuantiles = function () {
+                    return $.Deferred().resolve({
+                        q: [0.02, 0.98],
+                        channels: {red: [0, 250], green: [0, 10], blue: [200, 250]}
+                    }).promise();
+                };
+                var el = $('<div>').appendTo('body');
+                var widget = new HistogramWidget({
+                    el: el, parentView: null, model: model, autoRange: [0.02, 0.98]
+                });
+                widget._getHistogramFile(model, 'rgbFile');
+                expect(el.find('.g-histogram-channel option').length).toBe(3);
+                expect(el.find('.g-histogram-channel').val()).toBe('red');
+                expect(el.find('.g-histogram-bar').length).toBe(4);
+                expect(el.find('#g-histogram-bar-3').attr('data-original-title')).toMatch(/n: 4/);
+                // The range is set from the quantiles of the shown channel.
+                expect(widget.threshold).toEqual({min: 0, max: 192});
+                el.find('.g-histogram-channel').val('green').trigger('change');
+                expect(widget.channel).toBe('green');
+                expect(el.find('.g-histogram-bar').length).toBe(4);
+                expect(el.find('#g-histogram-bar-0').attr('data-original-title')).toMatch(/n: 7/);
+                widget.destroy();
+                el.remove();
+            });
+        });
+
         it('test histogram settings', function () {
             var done;
             girder.rest.restRequest({
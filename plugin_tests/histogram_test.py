@@ -21,8 +21,11 @@
 #  limitations under the License.
 #############################################################################
 
+import concurrent.futures
 import json
 import os
+import tempfile
+import threading
 import time
 
 from bson.objectid import ObjectId
@@ -30,6 +33,7 @@ from bson.objectid import ObjectId
 from tests import base
 
 from girder import config
+from girder.constants import AccessType
 from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
@@ -95,7 +99,7 @@ class HistogramTest(base.TestCase):
                 }])})
         self.assertStatusOk(resp)
 
-    def _uploadFile(self, path, name=None, private=False):
+    def _uploadFile(self, path, name=None, private=False, reference=None):
         """
         Upload the specified path to the admin user's public or private folder
         and return the resulting item.
@@ -104,6 +108,7 @@ class HistogramTest(base.TestCase):
         :param name: optional name for the file.
         :param private: True to upload to the private folder, False for public.
             'user' for the user's private folder.
+        :param reference: optional reference to pass to the upload.
         :returns: file: the created file.
         """
         if not name:
@@ -116,13 +121,16 @@ class HistogramTest(base.TestCase):
             folderId = self.privateFolder['_id']
         else:
             folderId = self.publicFolder['_id']
+        params = {
+            'parentType': 'folder',
+            'parentId': folderId,
+            'name': name,
+            'size': len(data)
+        }
+        if reference is not None:
+            params['reference'] = reference
         resp = self.request(
-            path='/file', method='POST', user=self.admin, params={
-                'parentType': 'folder',
-                'parentId': folderId,
-                'name': name,
-                'size': len(data)
-            })
+            path='/file', method='POST', user=self.admin, params=params)
         self.assertStatusOk(resp)
         uploadId = resp.json['_id']
 
@@ -224,3 +232,615 @@ class HistogramTest(base.TestCase):
         Item().remove(item)
         assert Histogram().load(histogramId, force=True) is None
         assert File().load(fileId, force=True) is None
+
+    def testHistogramCache(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        path = 'plugins/large_image/plugin_tests/test_files/test_L_8.png'
+        file1, item1 = self._uploadFile(path)
+        file2, item2 = self._uploadFile(path)
+        assert file1['sha512'] == file2['sha512']
+        histogramFile, _ = self._uploadFile(path, name='histogram.json')
+        cached = Histogram().save({
+            'itemId': item1['_id'],
+            'sourceFileId': file1['_id'],
+            'sourceSha512': file1['sha512'],
+            'sourceSize': file1['size'],
+            'bins': 256,
+            'label': False,
+            'bitmask': False,
+            'fakeId': 'cached',
+            'fileId': histogramFile['_id'],
+            'jobId': ObjectId(),
+            'metrics': {'phases': {'read': 1}, 'counters': {}},
+        })
+        token = Token().createToken(self.admin)
+
+        doc = Histogram().createHistogramJob(item1, file1, user=self.admin,
+                                             token=token, bins=256)
+        assert doc['_id'] == cached['_id']
+
+        doc = Histogram().createHistogramJob(item2, file2, user=self.admin,
+                                             token=token, bins=256)
+        assert doc['_id'] != cached['_id']
+        assert doc['itemId'] == item2['_id']
+        assert doc['sourceFileId'] == file2['_id']
+        assert 'expected' not in doc
+        assert doc['copiedFrom'] == cached['_id']
+        assert 'jobId' not in doc
+        assert 'metrics' not in doc
+        copiedFile = File().load(doc['fileId'], force=True)
+        assert copiedFile['itemId'] == item2['_id']
+
+        assert Histogram().evictCached(file2) == 2
+        assert Histogram().findCached(file1, 256, False, False) is None
+
+    def testHistogramInFlight(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        token = Token().createToken(self.admin)
+        first = Histogram().createHistogramJob(item, file, user=self.admin,
+                                               token=token, cache=False)
+        second = Histogram().createHistogramJob(item, file, user=self.admin,
+                                                token=token, cache=False)
+        assert first['expected']
+        assert second['_id'] == first['_id']
+        assert second['fakeId'] == first['fakeId']
+        other = Histogram().createHistogramJob(item, file, user=self.admin,
+                                               token=token, cache=False,
+                                               label=True)
+        assert other['_id'] != first['_id']
+
+    def testHistogramReserveConcurrently(self):
+        from girder.plugins.histogram.models.histogram import (
+            Histogram, IN_FLIGHT_TIMEOUT)
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        barrier = threading.Barrier(8)
+
+        def reserve(_):
+            barrier.wait()
+            return Histogram()._reserveHistogram(
+                item, file, user=self.admin, cache=False, bins=17)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(reserve, range(8)))
+        self.assertEqual(sum(isNew for _, isNew in results), 1)
+        self.assertEqual(len({histogram['_id'] for histogram, _ in results}),
+                         1)
+        self.assertEqual(Histogram().collection.count_documents({
+            'itemId': item['_id'], 'bins': 17, 'expected': True}), 1)
+
+        # A histogram whose job was lost doesn't block new requests
+        Histogram().collection.update_one(
+            {'_id': results[0][0]['_id']}, {'$set': {
+                'created': results[0][0]['created'] - 2 * IN_FLIGHT_TIMEOUT}})
+        histogram, isNew = Histogram()._reserveHistogram(
+            item, file, user=self.admin, cache=False, bins=17)
+        self.assertTrue(isNew)
+        self.assertNotEqual(histogram['_id'], results[0][0]['_id'])
+        self.assertIsNone(Histogram().load(results[0][0]['_id'], force=True))
+
+    def testHistogramBatch(self):
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.jobs.constants import JobStatus
+
+        resp = self.request('/histogram/batch', method='POST',
+                            user=self.admin)
+        self.assertStatus(resp, 400)
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        otherFile, otherItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png',
+            name='other.png')
+        resp = self.request(
+            '/histogram/batch', method='POST', user=self.user, params={
+                'itemIds': json.dumps([str(item['_id'])])})
+        self.assertStatus(resp, 403)
+        resp = self.request(
+            '/histogram/batch', method='POST', user=self.admin, params={
+                'itemIds': json.dumps([str(item['_id']),
+                                       str(otherItem['_id'])]),
+                'cache': False, 'chunkSize': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['histograms']), 2)
+        jobId = resp.json['job']['_id']
+
+        complete = (JobStatus.SUCCESS, JobStatus.ERROR, JobStatus.CANCELED)
+        starttime = time.time()
+        while True:
+            self.assertTrue(time.time() - starttime < 30)
+            job = Job().load(jobId, user=self.admin, exc=True)
+            if job.get('status') in complete:
+                break
+            time.sleep(0.1)
+        assert job.get('status') == JobStatus.SUCCESS
+        self.assertEqual(job['meta']['completed'], 2)
+        for histogram in resp.json['histograms']:
+            resp = self.request('/histogram/%s/data' % histogram['_id'],
+                                user=self.admin)
+            self.assertStatusOk(resp)
+
+    def testHistogramBatchReserve(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.jobs.constants import JobStatus
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        otherFile, otherItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png',
+            name='other.png')
+        files = {item['_id']: file, otherItem['_id']: otherFile}
+        batchJob = Job().createJob(
+            title='batch', type='histogram_batch', user=self.admin,
+            otherFields={'meta': {'completed': 0, 'failed': 0}})
+        batchJob = Job().updateJob(batchJob, status=JobStatus.RUNNING,
+                                   progressTotal=2, progressCurrent=0)
+        reserved = Histogram()._reserveHistograms(
+            [item, otherItem], files, user=self.admin, cache=False, bins=9,
+            batchJob=batchJob)
+        self.assertEqual([isNew for _, isNew in reserved], [True, True])
+        for (histogram, _), reservedItem in zip(reserved, [item, otherItem]):
+            self.assertEqual(histogram['itemId'], reservedItem['_id'])
+            self.assertEqual(histogram['batchJobIds'], [batchJob['_id']])
+            assert histogram['expected']
+        again = Histogram()._reserveHistograms(
+            [item, otherItem], files, user=self.admin, cache=False, bins=9)
+        self.assertEqual([isNew for _, isNew in again], [False, False])
+        self.assertEqual([histogram['_id'] for histogram, _ in again],
+                         [histogram['_id'] for histogram, _ in reserved])
+
+        # An image that failed in a batch job uploads an error file.
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as outfile:
+            json.dump({'error': 'ValueError: Cannot read image'}, outfile)
+        self._uploadFile(outfile.name, name='histogram.json',
+                         reference=json.dumps({
+                             'isHistogram': True,
+                             'fakeId': reserved[0][0]['fakeId']}))
+        os.unlink(outfile.name)
+        self.assertIsNone(Histogram().load(reserved[0][0]['_id'], force=True))
+        batchJob = Job().load(batchJob['_id'], force=True)
+        self.assertEqual(batchJob['meta']['completed'], 1)
+        self.assertEqual(batchJob['meta']['failed'], 1)
+
+    def testHistogramVariants(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        resp = self.request(
+            '/histogram/variants', method='POST', user=self.admin, params={
+                'itemId': str(item['_id']),
+                'variants': json.dumps([{'bins': 256, 'color': True}])})
+        self.assertStatus(resp, 400)
+        variants = [{'bins': 256}, {'bins': 16, 'label': True},
+                    {'bitmask': True}]
+        resp = self.request(
+            '/histogram/variants', method='POST', user=self.admin, params={
+                'itemId': str(item['_id']), 'variants': json.dumps(variants),
+                'cache': False})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 3)
+        histogramIds = [histogram['_id'] for histogram in resp.json]
+        for histogram, variant in zip(resp.json, variants):
+            self.assertEqual(histogram['label'], variant.get('label', False))
+            self.assertEqual(histogram['bitmask'],
+                             variant.get('bitmask', False))
+            starttime = time.time()
+            histogram = Histogram().load(histogram['_id'], force=True)
+            while histogram.get('expected'):
+                self.assertTrue(time.time() - starttime < 30)
+                time.sleep(0.1)
+                histogram = Histogram().load(histogram['_id'], force=True)
+            assert histogram['fileId']
+            data = Histogram().getData(histogram)
+            self.assertEqual(data['label'], variant.get('label', False))
+            self.assertEqual(data['bitmask'], variant.get('bitmask', False))
+        # Variants that were already computed are reused
+        resp = self.request(
+            '/histogram/variants', method='POST', user=self.admin, params={
+                'itemId': str(item['_id']), 'variants': json.dumps(variants)})
+        self.assertStatusOk(resp)
+        self.assertEqual([histogram['_id'] for histogram in resp.json],
+                         histogramIds)
+
+    def testHistogramUpload(self):
+        import numpy
+        import PIL.Image
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        array = numpy.arange(60000, dtype=numpy.uint16).reshape(200, 300)
+        with tempfile.NamedTemporaryFile(suffix='.tiff') as image:
+            PIL.Image.fromarray(array).save(image.name)
+            resp = self.request(
+                '/system/setting', method='PUT', user=self.admin, params={
+                    'key': 'histogram.upload_threads', 'value': 2})
+            self.assertStatusOk(resp)
+            file, item = self._uploadFile(
+                image.name, name='image.tiff', reference=json.dumps({
+                    'histogram': {'bins': 10}}))
+        # The histogram is complete as soon as the upload is
+        histograms = list(Histogram().find({'itemId': item['_id']}))
+        self.assertEqual(len(histograms), 1)
+        histogram = histograms[0]
+        assert histogram['fileId']
+        assert 'expected' not in histogram
+        self.assertEqual(histogram['sourceFileId'], file['_id'])
+        data = Histogram().getData(histogram)
+        self.assertEqual(data['hist'].tolist(), [6000] * 10)
+        self.assertEqual(data['dtype'], 'uint16')
+
+    def testHistogramApproximate(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        token = Token().createToken(self.admin)
+        histogram = Histogram().createHistogramJob(
+            item, file, user=self.admin, token=token, cache=False,
+            approximate=True)
+        # The full histogram may already have replaced the approximation
+        if histogram.get('expected'):
+            self.assertEqual(histogram['approximate']['level'], 0)
+            data = Histogram().getData(histogram)
+            assert data['hist'].sum() > 0
+        starttime = time.time()
+        while histogram.get('expected'):
+            self.assertTrue(time.time() - starttime < 30)
+            time.sleep(0.1)
+            histogram = Histogram().load(histogram['_id'], force=True)
+        assert 'approximate' not in histogram
+        assert histogram['fileId']
+
+    def _saveHistogram(self, item, file, contents):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as outfile:
+            json.dump(contents, outfile)
+        histogramFile, _ = self._uploadFile(outfile.name,
+                                            name='histogram.json')
+        os.unlink(outfile.name)
+        histogram = Histogram().inheritAccess({
+            'itemId': item['_id'],
+            'sourceFileId': file['_id'],
+            'bins': contents['bins'],
+            'label': contents['label'],
+            'bitmask': contents['bitmask'],
+            'fakeId': str(histogramFile['_id']),
+        }, Folder().load(item['folderId'], force=True))
+        histogram = Histogram().save(histogram)
+        return Histogram().attachFile(histogram, histogramFile)
+
+    def testHistogramFindPermissions(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        contents = {'label': False, 'bitmask': False, 'bins': 3,
+                    'hist': [1, 2, 3], 'binEdges': [0, 1, 2, 3]}
+        publicFile, publicItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        privateFile, privateItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png',
+            private=True)
+        publicHistogram = self._saveHistogram(
+            publicItem, publicFile, contents)
+        privateHistogram = self._saveHistogram(
+            privateItem, privateFile, contents)
+
+        def findIds(user, **params):
+            resp = self.request('/histogram', user=user, params=params)
+            self.assertStatusOk(resp)
+            return [histogram['_id'] for histogram in resp.json]
+
+        self.assertEqual(findIds(self.admin), [
+            str(publicHistogram['_id']), str(privateHistogram['_id'])])
+        self.assertEqual(findIds(self.user), [str(publicHistogram['_id'])])
+        self.assertEqual(findIds(None), [str(publicHistogram['_id'])])
+        self.assertEqual(findIds(self.user, itemId=str(privateItem['_id'])),
+                         [])
+
+        # Histograms follow changes to their folder's access
+        Folder().setUserAccess(self.privateFolder, self.user,
+                               AccessType.READ, save=True)
+        self.assertEqual(findIds(self.user, bins=3, label=False), [
+            str(publicHistogram['_id']), str(privateHistogram['_id'])])
+        # and move with their items
+        Item().move(privateItem, self.userPrivateFolder)
+        privateHistogram = Histogram().load(privateHistogram['_id'],
+                                            force=True)
+        self.assertEqual(privateHistogram['folderId'],
+                         self.userPrivateFolder['_id'])
+        self.assertEqual(findIds(self.user, itemId=str(privateItem['_id'])),
+                         [str(privateHistogram['_id'])])
+        self.assertEqual(findIds(None, itemId=str(privateItem['_id'])), [])
+
+        # Access given to a histogram is kept when its folder changes
+        resp = self.request(
+            '/histogram/%s/access' % publicHistogram['_id'], method='PUT',
+            user=self.admin, params={'access': json.dumps(
+                {'users': [], 'groups': []}), 'public': False})
+        self.assertStatusOk(resp)
+        Folder().setPublic(self.publicFolder, True, save=True)
+        self.assertEqual(findIds(None, itemId=str(publicItem['_id'])), [])
+        Item().move(publicItem, self.privateFolder)
+        publicHistogram = Histogram().load(publicHistogram['_id'], force=True)
+        self.assertEqual(publicHistogram['folderId'],
+                         self.privateFolder['_id'])
+        self.assertFalse(publicHistogram['public'])
+
+        # Histograms from before access was inherited are given it once
+        Histogram().collection.update_one(
+            {'_id': privateHistogram['_id']},
+            {'$unset': {'folderId': ''}, '$set': {
+                'access': {'users': [], 'groups': []}, 'public': False}})
+        self.assertEqual(Histogram().inheritMissingAccess(), 1)
+        self.assertEqual(Histogram().inheritMissingAccess(), 0)
+        self.assertEqual(findIds(self.user, itemId=str(privateItem['_id'])),
+                         [str(privateHistogram['_id'])])
+
+    def testHistogramAggregate(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        params = {'folderId': str(self.publicFolder['_id']), 'bins': 3}
+        resp = self.request('/histogram/aggregate', user=self.admin,
+                            params=params)
+        self.assertStatus(resp, 404)
+        first, firstItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        second, secondItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png',
+            name='second.png')
+        self._saveHistogram(firstItem, first, {
+            'label': False, 'bitmask': False, 'bins': 3,
+            'hist': [1, 2, 3], 'binEdges': [0, 1, 2, 3]})
+        secondHistogram = self._saveHistogram(secondItem, second, {
+            'label': False, 'bitmask': False, 'bins': 3,
+            'hist': [4, 5, 6], 'binEdges': [1, 2, 3, 4]})
+        resp = self.request('/histogram/aggregate', user=self.admin,
+                            params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], [1, 6, 8, 6])
+        self.assertEqual(resp.json['binEdges'], [0, 1, 2, 3, 4])
+        self.assertEqual(resp.json['histograms'], 2)
+
+        # Histograms counted in a single pass are combined separately
+        third, thirdItem = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png',
+            name='third.png')
+        sketchHistogram = self._saveHistogram(thirdItem, third, {
+            'label': False, 'bitmask': False, 'bins': 3,
+            'hist': [7, 8, 9], 'binEdges': [0, 1, 2, 3]})
+        Histogram().collection.update_one(
+            {'_id': sketchHistogram['_id']},
+            {'$set': {'floatMethod': 'sketch'}})
+        resp = self.request('/histogram/aggregate', user=self.admin,
+                            params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['histograms'], 2)
+        resp = self.request('/histogram/aggregate', user=self.admin,
+                            params=dict(params, floatMethod='sketch'))
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], [7, 8, 9])
+        self.assertEqual(resp.json['histograms'], 1)
+
+        Histogram().remove(secondHistogram)
+        resp = self.request('/histogram/aggregate', user=self.admin,
+                            params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], [1, 2, 3])
+        self.assertEqual(resp.json['histograms'], 1)
+        resp = self.request('/histogram/aggregate', user=self.user,
+                            params={'folderId': str(self.privateFolder['_id'])})
+        self.assertStatus(resp, 403)
+
+    def testHistogramMetrics(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        resp = self.request('/histogram/metrics', user=self.user)
+        self.assertStatus(resp, 403)
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        for read in (1, 2, 3):
+            saved = self._saveHistogram(item, file, {
+                'label': False, 'bitmask': False, 'bins': 3,
+                'hist': [1, 2, 3], 'binEdges': [0, 1, 2, 3],
+                'metrics': {'phases': {'read': read, 'count': 0.5},
+                            'counters': {'pixelsRead': 6}}})
+        self.assertEqual(saved['metrics']['phases']['read'], 3)
+        resp = self.request('/histogram/metrics', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['histograms'], 3)
+        read = resp.json['phases']['read']
+        self.assertEqual(read['count'], 3)
+        self.assertEqual(read['total'], 6)
+        self.assertEqual(read['p50'], 2)
+        self.assertEqual(read['max'], 3)
+        self.assertEqual(resp.json['counters']['pixelsRead']['mean'], 6)
+        resp = self.request('/histogram/metrics', user=self.admin,
+                            params={'limit': 1})
+        self.assertEqual(resp.json['phases']['read']['total'], 3)
+
+        # Histogram files uploaded by a job are timed by the server.
+        histogram = Histogram().save(Histogram().inheritAccess({
+            'itemId': item['_id'], 'sourceFileId': file['_id'], 'bins': 3,
+            'label': False, 'bitmask': False, 'fakeId': 'timedUpload',
+            'expected': True}, Folder().load(item['folderId'], force=True)))
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as outfile:
+            json.dump({'label': False, 'bitmask': False, 'bins': 3,
+                       'hist': [1, 2, 3], 'binEdges': [0, 1, 2, 3],
+                       'metrics': {'phases': {'read': 1}, 'counters': {}}},
+                      outfile)
+        self._uploadFile(outfile.name, name='histogram.json',
+                         reference=json.dumps({'isHistogram': True,
+                                               'fakeId': 'timedUpload'}))
+        os.unlink(outfile.name)
+        saved = Histogram().load(histogram['_id'], force=True)
+        self.assertGreaterEqual(saved['metrics']['phases']['upload'], 0)
+        self.assertNotIn('uploadSeconds', saved)
+
+    def testHistogramQuantiles(self):
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        histogram = self._saveHistogram(item, file, {
+            'label': False, 'bitmask': False, 'bins': 4,
+            'hist': [0, 4, 4, 2], 'binEdges': [0, 1, 2, 3, 4]})
+        path = '/histogram/%s/quantiles' % histogram['_id']
+        resp = self.request(path, user=self.admin, params={'q': '0,0.5,1'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['q'], [0, 0.5, 1])
+        self.assertEqual(resp.json['values'], [1, 2.25, 4])
+        resp = self.request(path, user=self.admin, params={'q': '2'})
+        self.assertStatus(resp, 400)
+        resp = self.request(path, user=self.admin, params={'q': 'low'})
+        self.assertStatus(resp, 400)
+
+    def testHistogramFrames(self):
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        histogram = self._saveHistogram(item, file, {
+            'label': False, 'bitmask': False, 'bins': 2,
+            'hist': [3, 5], 'binEdges': [0, 1, 2],
+            'frames': [{'hist': [3, 1], 'binEdges': [0, 1, 2]},
+                       {'hist': [0, 4], 'binEdges': [0, 1, 2]}]})
+        path = '/histogram/%s/data' % histogram['_id']
+        resp = self.request(path, user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], [3, 5])
+        self.assertEqual(len(resp.json['frames']), 2)
+        resp = self.request(path, user=self.admin, params={'frame': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], [0, 4])
+        self.assertEqual(resp.json['frame'], 1)
+        assert 'frames' not in resp.json
+        resp = self.request(path, user=self.admin, params={'frame': 2})
+        self.assertStatus(resp, 400)
+        resp = self.request('/histogram/%s/quantiles' % histogram['_id'],
+                            user=self.admin, params={'q': '0,1', 'frame': 0})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['values'], [0, 2])
+
+    def testHistogramRegion(self):
+        import numpy
+        import PIL.Image
+        from girder.plugins.histogram.models.histogram import Histogram
+        from histogram import formats, histogram, operations
+
+        path = 'plugins/large_image/plugin_tests/test_files/test_L_8.png'
+        file, item = self._uploadFile(path)
+        outputPath, tilesPath = histogram.start_processing(
+            path, False, 16, False, tiles=True)
+        contents = formats.toJSON(formats.read(outputPath))
+        os.unlink(outputPath)
+        saved = self._saveHistogram(item, file, contents)
+        Histogram().update({'_id': saved['_id']}, {'$set': {'tiles': True}})
+        pixels = numpy.array(PIL.Image.open(path))
+        height, width = pixels.shape
+        region = {'left': 1, 'top': 2, 'right': width - 3,
+                  'bottom': height - 1}
+        path = '/histogram/%s/region' % saved['_id']
+        # The region can't be found until the tile counts are uploaded.
+        resp = self.request(path, user=self.admin, params=region)
+        self.assertStatus(resp, 404)
+        tilesFile, _ = self._uploadFile(
+            tilesPath, name='tiles.hist', reference=json.dumps({
+                'isHistogram': True, 'fakeId': saved['fakeId'],
+                'tiles': True}))
+        os.unlink(tilesPath)
+        self.assertEqual(Histogram().load(saved['_id'], force=True)[
+            'tilesFileId'], tilesFile['_id'])
+        resp = self.request(path, user=self.admin, params=region)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['region'], region)
+        self.assertEqual(resp.json['hist'], operations.countValues(
+            pixels[2:height - 1, 1:width - 3], contents['binEdges']).tolist())
+        resp = self.request(path, user=self.admin, params={
+            'left': width, 'top': 0, 'right': width + 10, 'bottom': 10})
+        self.assertStatus(resp, 400)
+        # The tile counts aren't part of the histogram's data.
+        resp = self.request('/histogram/%s/data' % saved['_id'],
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertNotIn('tiles', resp.json)
+
+        saved = self._saveHistogram(item, file, {
+            'label': False, 'bitmask': False, 'bins': 3,
+            'hist': [1, 2, 3], 'binEdges': [0, 1, 2, 3]})
+        resp = self.request('/histogram/%s/region' % saved['_id'],
+                            user=self.admin, params=region)
+        self.assertStatus(resp, 400)
+
+    def testHistogramRebin(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        fine = self._saveHistogram(item, file, {
+            'label': False, 'bitmask': False, 'bins': 8, 'dtype': 'uint16',
+            'hist': [1, 0, 2, 0, 3, 0, 4, 5],
+            'binEdges': [10, 10.5, 11, 11.5, 12, 12.5, 13, 13.5, 14],
+            'metrics': {'phases': {'read': 1}, 'counters': {}}})
+        resp = self.request('/histogram/%s/rebin' % fine['_id'],
+                            user=self.admin, params={'bins': 2})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], [3, 12])
+        self.assertEqual(resp.json['binEdges'], [10, 12, 14])
+        resp = self.request('/histogram/%s/rebin' % fine['_id'],
+                            user=self.admin,
+                            params={'bins': 2, 'min': 5, 'max': 1})
+        self.assertStatus(resp, 400)
+
+        token = Token().createToken(self.admin)
+        derived = Histogram().createHistogramJob(
+            item, file, user=self.admin, token=token, bins=2)
+        assert 'expected' not in derived
+        self.assertEqual(derived['derivedFrom'], fine['_id'])
+        # The metrics are of the job that computed the original.
+        self.assertNotIn('metrics', derived)
+        data = Histogram().getData(derived)
+        self.assertEqual(data['hist'].tolist(), [3, 12])
+        self.assertEqual(data['bins'], 2)
+        other = Histogram().createHistogramJob(
+            item, file, user=self.admin, token=token, bins=16, cache=False)
+        assert other['expected']
+        # Approximate histograms aren't re-binned into exact ones.
+        Histogram().update({'_id': fine['_id']},
+                           {'$set': {'floatMethod': 'sketch'}})
+        self.assertIsNone(Histogram().deriveHistogram(
+            item, file, user=self.admin, bins=4))
+
+    def testHistogramData(self):
+        from girder.plugins.histogram.models.histogram import Histogram
+
+        file, item = self._uploadFile(
+            'plugins/large_image/plugin_tests/test_files/test_L_8.png')
+        contents = {'label': False, 'bitmask': False, 'bins': 3,
+                    'hist': [1, 2, 3], 'binEdges': [0, 1, 2, 3]}
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as outfile:
+            json.dump(contents, outfile)
+        histogramFile, _ = self._uploadFile(outfile.name,
+                                            name='histogram.json')
+        os.unlink(outfile.name)
+        histogram = Histogram().save({
+            'itemId': item['_id'],
+            'sourceFileId': file['_id'],
+            'bins': 3,
+            'label': False,
+            'bitmask': False,
+            'fakeId': 'data',
+        })
+        histogram = Histogram().attachFile(histogram, histogramFile)
+        assert histogram.get('data') is not None
+
+        resp = self.request('/histogram/%s/data' % histogram['_id'],
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['hist'], contents['hist'])
+        self.assertEqual(resp.json['binEdges'], contents['binEdges'])
+        self.assertEqual(resp.json['bins'], 3)
@@ -0,0 +1,771 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Girder plugin framework and tests adapted from Kitware Inc. source and
+#  documentation by the Imaging and Visualization Group, Advanced Biomedical
+#  Computational Science, Frederick National Laboratory for Cancer Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import PIL.Image
+
+from histogram import (cache, formats, histogram, operations, readers,
+                       sketch)
+
+
+class ComputeHistogramTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _writeImage(self, array, name='image.tiff', **kwargs):
+        path = os.path.join(self.tempdir, name)
+        PIL.Image.fromarray(array).save(path, **kwargs)
+        return path
+
+    def _computeHistogram(self, path, label, bins, bitmask, streaming,
+                          mapped, workers=1):
+        return histogram._chunksHistogram(
+            histogram._imageChunks(path, streaming, mapped), label, bins,
+            bitmask, workers)
+
+    def _assertHistogramsEqual(self, path, label, bins, bitmask, **kwargs):
+        hist, binEdges = self._computeHistogram(
+            path, label, bins, bitmask, streaming=False, mapped=False)
+        for streaming, mapped in ((True, False), (False, True)):
+            streamHist, streamBinEdges = self._computeHistogram(
+                path, label, bins, bitmask, streaming, mapped, **kwargs)
+            self.assertEqual(hist.tolist(), streamHist.tolist())
+            self.assertEqual(binEdges.tolist(), streamBinEdges.tolist())
+        return hist, binEdges
+
+    def testStreamingStrips(self):
+        array = numpy.random.randint(0, 200, (300, 170)).astype(numpy.uint8)
+        path = self._writeImage(array, tiffinfo={278: 16})  # RowsPerStrip
+        for label in (False, True):
+            for bitmask in (False, True):
+                self._assertHistogramsEqual(path, label, 256, bitmask)
+        hist, binEdges = self._assertHistogramsEqual(path, False, 256, False)
+        self.assertEqual(hist.sum(), array.size)
+        self.assertEqual(binEdges[0], array.min())
+        self.assertEqual(binEdges[-1], array.max() + 1)
+
+    def testIntegerCounts(self):
+        array = numpy.random.randint(0, 4000, (300, 170)).astype(numpy.uint16)
+        path = self._writeImage(array, tiffinfo={278: 32})
+        for bins in (1, 10, 256, 5000):
+            hist, binEdges = self._assertHistogramsEqual(
+                path, False, bins, False)
+            expectedHist, expectedBinEdges = numpy.histogram(array, bins=bins)
+            self.assertEqual(hist.tolist(), expectedHist.tolist())
+            self.assertEqual(binEdges.tolist(), expectedBinEdges.tolist())
+        hist, binEdges = self._assertHistogramsEqual(path, True, 256, False)
+        self.assertEqual(hist.sum(), numpy.count_nonzero(array))
+
+    def testBitmask(self):
+        array = numpy.random.randint(0, 1 << 16, (120, 80)).astype(numpy.uint16)
+        array[array % 3 == 0] = 0
+        path = self._writeImage(array, tiffinfo={278: 16})
+        for label in (False, True):
+            hist, binEdges = self._assertHistogramsEqual(path, label, 0, True)
+            self.assertEqual(len(hist), 17 - label)
+            self.assertEqual(binEdges.tolist(), list(range(label, 17)))
+            if not label:
+                self.assertEqual(hist[0], (array == 0).sum())
+            for bit in range(16):
+                self.assertEqual(hist[bit + 1 - label],
+                                 (array & (1 << bit) > 0).sum())
+
+    def testParallel(self):
+        array = numpy.random.randint(0, 1000, (300, 170)).astype(numpy.uint16)
+        path = self._writeImage(array, tiffinfo={278: 16})
+        floatPath = self._writeImage(
+            array.astype(numpy.float32) / 7, 'float.tiff', tiffinfo={278: 16})
+        for workers in (2, 3, 40):
+            for label in (False, True):
+                for bitmask in (False, True):
+                    self._assertHistogramsEqual(
+                        path, label, 256, bitmask, workers=workers)
+                self._assertHistogramsEqual(
+                    floatPath, label, 100, False, workers=workers)
+
+    def testStreamingFloat(self):
+        array = numpy.random.rand(200, 130).astype(numpy.float32)
+        path = self._writeImage(array, tiffinfo={278: 7})
+        self._assertHistogramsEqual(path, False, 100, False)
+        self._assertHistogramsEqual(path, True, 17, False)
+
+    def testNonFiniteFloats(self):
+        array = numpy.random.rand(200, 130).astype(numpy.float32)
+        array[:10] = 0
+        array[20, :5] = numpy.nan
+        array[30, :3] = numpy.inf
+        array[40, :2] = -numpy.inf
+        path = self._writeImage(array, tiffinfo={278: 7})
+        finite = array[numpy.isfinite(array)]
+        for label in (False, True):
+            values = finite[finite != 0] if label else finite
+            expected = numpy.histogram(values, bins=20)
+            for floatMethod in (None,) + histogram.FLOAT_METHODS:
+                for streaming in (False, True):
+                    hist, binEdges = histogram.computeHistogram(
+                        path, label, 20, False, streaming,
+                        floatMethod=floatMethod)
+                    self.assertEqual(hist.sum(), values.size)
+                    self.assertEqual(binEdges[0], values.min())
+                    self.assertEqual(binEdges[-1], values.max())
+                    if floatMethod is None:
+                        self.assertEqual(hist.tolist(),
+                                         expected[0].tolist())
+
+    def testFloatMethods(self):
+        array = numpy.random.rand(200, 130).astype(numpy.float32)
+        array[:10] = 0
+        # SMinSampleValue, SMaxSampleValue
+        path = self._writeImage(array, tiffinfo={278: 7, 340: 0.0, 341: 1.0})
+        self.assertEqual(histogram.discoverRange(path), (0, 1))
+        for label in (False, True):
+            for workers in (1, 3):
+                hist, binEdges = histogram.computeHistogram(
+                    path, label, 10, False, workers=workers,
+                    floatMethod='range')
+                values = array[array != 0] if label else array
+                expected = numpy.histogram(values, bins=10, range=(0, 1))
+                self.assertEqual(hist.tolist(), expected[0].tolist())
+                self.assertEqual(binEdges.tolist(), expected[1].tolist())
+
+                hist, binEdges = histogram.computeHistogram(
+                    path, label, 10, False, workers=workers,
+                    floatMethod='sketch')
+                expected = numpy.histogram(values, bins=10)
+                self.assertEqual(hist.sum(), values.size)
+                self.assertTrue(numpy.allclose(binEdges, expected[1]))
+                self.assertLess(numpy.abs(hist - expected[0]).max(),
+                                values.size * 0.01)
+
+        # Bins narrower than the sketch's buckets are counted exactly.
+        offset = (1000 + numpy.random.rand(200, 130)).astype(numpy.float32)
+        path = self._writeImage(offset, 'offset.tiff', tiffinfo={278: 7})
+        counted = sketch.QuantileSketch()
+        counted.add(offset)
+        self.assertFalse(counted.resolves(counted.histogram(16)[1]))
+        counted = sketch.QuantileSketch()
+        counted.add(array)
+        self.assertTrue(counted.resolves(counted.histogram(256)[1]))
+        for workers in (1, 3):
+            hist, binEdges = histogram.computeHistogram(
+                path, False, 16, False, workers=workers,
+                floatMethod='sketch')
+            expected = numpy.histogram(offset.astype(numpy.float64), bins=16)
+            self.assertEqual(hist.tolist(), expected[0].tolist())
+            self.assertEqual(binEdges.tolist(), expected[1].tolist())
+
+        # Values outside of the recorded range widen the end bins.
+        path = self._writeImage(array, 'narrow.tiff',
+                                tiffinfo={340: 0.25, 341: 0.5})
+        hist, binEdges = histogram.computeHistogram(
+            path, False, 5, False, floatMethod='range')
+        self.assertEqual(hist.sum(), array.size)
+        self.assertEqual(binEdges[0], array.min())
+        self.assertEqual(binEdges[-1], array.max())
+        self.assertEqual(hist[0], (array < 0.3).sum())
+        self.assertEqual(hist[-1], (array >= 0.45).sum())
+
+        path = self._writeImage(array, 'plain.tiff')
+        self.assertIsNone(histogram.discoverRange(path))
+        hist, binEdges = histogram.computeHistogram(
+            path, False, 10, False, floatMethod='range')
+        self.assertEqual(hist.tolist(),
+                         numpy.histogram(array, bins=10)[0].tolist())
+        with self.assertRaises(ValueError):
+            histogram.computeHistogram(path, False, 10, False,
+                                       floatMethod='guess')
+
+
+    def testMapped(self):
+        for dtype in (numpy.uint8, numpy.uint16, numpy.int32, numpy.float32):
+            array = (numpy.random.rand(300, 170) * 1000).astype(dtype)
+            path = self._writeImage(array, tiffinfo={278: 16})
+            chunks = histogram._imageChunks(path, mapped=True)
+            chunk = next(chunks())
+            self.assertIsInstance(chunk.base, numpy.memmap)
+            self.assertEqual(numpy.concatenate(list(chunks())).tolist(),
+                             array.tolist())
+            self._assertHistogramsEqual(path, False, 100, False, workers=3)
+        path = self._writeImage(array, 'lzw.tiff', compression='tiff_lzw')
+        chunk = next(histogram._imageChunks(path, mapped=True)())
+        self.assertNotIsInstance(chunk.base, numpy.memmap)
+        self.assertIsNone(histogram.computeMappedHistogram(
+            path, False, 100, False))
+        path = self._writeImage(array, tiffinfo={278: 16})
+        result = histogram.computeMappedHistogram(path, False, 100, False)
+        hist, binEdges = histogram.computeArrayHistogram(
+            array, False, 100, False)
+        self.assertEqual(result['hist'].tolist(), hist.tolist())
+        self.assertEqual(result['binEdges'].tolist(), binEdges.tolist())
+        self.assertEqual(result['dtype'], 'float32')
+
+    def testReaders(self):
+        array = numpy.random.randint(0, 1000, (600, 40)).astype('>u2')
+        path = os.path.join(self.tempdir, 'image.npy')
+        numpy.save(path, array)
+        image = readers.openImage(path, ('mapped',))
+        self.assertEqual(image.reader.name, 'numpy')
+        self.assertTrue(image.mapped and image.tiled)
+        self.assertFalse(image.multichannel)
+        self.assertEqual(image.shape, (600, 40))
+        chunks = histogram._imageChunks(path)
+        self.assertEqual(numpy.concatenate(list(chunks())).tolist(),
+                         array.tolist())
+        self.assertEqual(
+            histogram._chunksHistogram(chunks, False, 10, False)[0].tolist(),
+            numpy.histogram(array, bins=10)[0].tolist())
+        stack = numpy.random.randint(0, 256, (3, 20, 30, 3)).astype(
+            numpy.uint8)
+        numpy.save(path, stack)
+        image = readers.openImage(path)
+        self.assertEqual((image.shape, image.channels, image.frames),
+                         ((20, 30), 3, 3))
+        self.assertEqual(image.frame(2).read().tolist(), stack[2].tolist())
+
+        path = self._writeImage(array.astype(numpy.uint16),
+                                compression='tiff_lzw')
+        image = readers.openImage(path, ('mapped',))
+        self.assertEqual(image.reader.name, 'pil')
+        self.assertFalse(image.mapped)
+        self.assertIn('pil', readers.registeredReaders())
+
+        class ArrayReader(readers.Reader):
+            name = 'test'
+            capabilities = frozenset(('mapped',))
+
+            def open(self, in_path):
+                chunks = histogram._arrayChunks(array)
+                return readers.Image(self, array.shape, lambda: array,
+                                     mappedChunks=chunks)
+
+        readers.register(ArrayReader(), 0)
+        try:
+            self.assertEqual(readers.registeredReaders()[0], 'test')
+            self.assertEqual(readers.openImage(path).reader.name, 'test')
+        finally:
+            readers.unregister('test')
+        self.assertNotIn('test', readers.registeredReaders())
+
+        path = os.path.join(self.tempdir, 'image.txt')
+        with open(path, 'w') as fp:
+            fp.write('not an image')
+        with self.assertRaises(ValueError):
+            readers.openImage(path)
+
+    def testFrames(self):
+        for dtype, high in ((numpy.uint16, 4000), (numpy.float32, 1)):
+            stack = (numpy.random.rand(4, 50, 30) * high).astype(dtype)
+            stack[1, :5] = 0
+            for compression in ('raw', 'tiff_lzw'):
+                path = os.path.join(self.tempdir, 'stack.tiff')
+                frames = [PIL.Image.fromarray(frame) for frame in stack]
+                frames[0].save(path, save_all=True,
+                               append_images=frames[1:],
+                               compression=compression)
+                for label in (False, True):
+                    for workers in (1, 3, 6):
+                        hist, binEdges = histogram._chunksHistogram(
+                            histogram._imageChunks(path), label, 20, False,
+                            workers)
+                        computed, frameResults, imageDtype = \
+                            histogram.computeFrameHistograms(
+                                path, label, 20, False, workers=workers)
+                        self.assertEqual(imageDtype, dtype)
+                        expected = histogram.computeArrayHistogram(
+                            stack.reshape(-1, 30), label, 20, False)
+                        self.assertEqual(hist.tolist(), expected[0].tolist())
+                        self.assertEqual(computed[0].tolist(),
+                                         expected[0].tolist())
+                        self.assertEqual(computed[1].tolist(),
+                                         expected[1].tolist())
+                        self.assertEqual(len(frameResults), 4)
+                        for frame, result in zip(stack, frameResults):
+                            expected = histogram.computeArrayHistogram(
+                                frame, label, 20, False)
+                            self.assertEqual(result[0].tolist(),
+                                             expected[0].tolist())
+                            self.assertEqual(result[1].tolist(),
+                                             expected[1].tolist())
+        stack = stack.astype(numpy.uint16) * 1000
+        frames = [PIL.Image.fromarray(frame) for frame in stack]
+        frames[0].save(path, save_all=True, append_images=frames[1:])
+        computed, frameResults, _ = histogram.computeFrameHistograms(
+            path, True, 0, True, workers=2)
+        self.assertEqual(computed[0].tolist(), histogram.computeArrayHistogram(
+            stack.reshape(-1, 30), True, 0, True)[0].tolist())
+        self.assertEqual(frameResults[3][0].tolist(),
+                         histogram.computeArrayHistogram(
+                             stack[3], True, 0, True)[0].tolist())
+
+        outputPath = histogram.start_processing(
+            path, False, 10, False, fileFormat='json', frames=True)
+        result = formats.read(outputPath)
+        os.unlink(outputPath)
+        self.assertEqual(len(result['frames']), 4)
+        frame = operations.frameHistogram(result, 2)
+        self.assertEqual(frame['frame'], 2)
+        self.assertEqual(frame['hist'].tolist(), numpy.histogram(
+            stack[2], bins=10)[0].tolist())
+        self.assertEqual(frame['cumulative'][-1], stack[2].size)
+        self.assertEqual(result['cumulative'][-1], stack.size)
+        with self.assertRaises(ValueError):
+            operations.frameHistogram(result, 4)
+        self.assertNotIn('frames', operations.rebinHistogram(result, 5))
+
+    def testTiles(self):
+        array = numpy.random.randint(0, 1000, (700, 900)).astype(numpy.uint16)
+        array[:100] = 0
+        paths = [self._writeImage(array, 'strips.tiff', tiffinfo={278: 16}),
+                 self._writeImage(array, 'lzw.tiff', tiffinfo={278: 16},
+                                  compression='tiff_lzw'),
+                 self._writeImage(array.astype(numpy.float32) / 7,
+                                  'float.tiff', tiffinfo={278: 16})]
+        for path in paths:
+            pixels = numpy.array(PIL.Image.open(path))
+            for prefer in ((), ('mapped',), ('tiled',)):
+                image = readers.openImage(path, prefer)
+                if not image.mapped and not image.tiled:
+                    # e.g., LZW strips when tifffile isn't installed.
+                    continue
+                chunks = image.mappedChunks or image.tileChunks
+                read = []
+
+                def countingChunks(*args, **kwargs):
+                    for chunk in chunks(*args, **kwargs):
+                        read.append(chunk)
+                        yield chunk
+
+                image.mappedChunks = image.tileChunks = countingChunks
+                image.read = None  # The image is never read whole.
+                self.assertEqual(
+                    image.readRegion(30, 40, 70, 45).tolist(),
+                    pixels[40:45, 30:70].tolist())
+                # The region is in one strip of 16 rows.
+                self.assertEqual(len(read), 1)
+            for label, bitmask in ((False, False), (True, False),
+                                   (False, True)):
+                if bitmask and pixels.dtype == numpy.float32:
+                    continue
+                for streaming, workers in ((False, 1), (True, 3)):
+                    outputPath, tilesPath = histogram.start_processing(
+                        path, label, 50, bitmask, streaming, workers,
+                        fileFormat='binary', tiles=True)
+                    result = formats.read(outputPath)
+                    tiles = formats.read(tilesPath)
+                    os.unlink(outputPath)
+                    os.unlink(tilesPath)
+                    self.assertNotIn('tiles', result)
+                    self.assertEqual(tiles['shape'], [700, 900])
+                    self.assertEqual(tiles['hist'].shape[:2], (3, 4))
+                    # Counts are stored in the smallest unsigned dtype.
+                    self.assertEqual(tiles['hist'].dtype.kind, 'u')
+                    self.assertLessEqual(tiles['hist'].dtype.itemsize, 4)
+                    self.assertEqual(tiles['hist'].sum(axis=(0, 1)).tolist(),
+                                     result['hist'].tolist())
+                    for region in ((0, 0, 900, 700), (10, 20, 600, 650),
+                                   (300, 300, 310, 305), (256, 0, 512, 700),
+                                   (-5, 650, 2000, 2000)):
+                        regionResult = operations.regionHistogram(
+                            result, tiles, *region, readRegion=lambda left, top,
+                            right, bottom: pixels[top:bottom, left:right])
+                        bounds = regionResult['region']
+                        expected = operations.countValues(
+                            pixels[bounds['top']:bounds['bottom'],
+                                   bounds['left']:bounds['right']],
+                            result['binEdges'], label, bitmask)
+                        self.assertEqual(regionResult['hist'].tolist(),
+                                         expected.tolist())
+        self.assertEqual(regionResult['region'], {
+            'left': 0, 'top': 650, 'right': 900, 'bottom': 700})
+        with self.assertRaises(ValueError):
+            operations.regionHistogram(
+                result, tiles, 1000, 0, 1100, 10, readRegion=None)
+
+        # Multi-channel images have no tile counts.
+        rgb = numpy.random.randint(0, 255, (40, 30, 3)).astype(numpy.uint8)
+        outputPath, tilesPath = histogram.start_processing(
+            self._writeImage(rgb, 'rgb.tiff'), False, 50, False, tiles=True)
+        result = formats.read(outputPath)
+        tiles = formats.read(tilesPath)
+        os.unlink(outputPath)
+        os.unlink(tilesPath)
+        self.assertEqual(tiles, {})
+        with self.assertRaises(ValueError):
+            operations.regionHistogram(
+                result, tiles, 0, 0, 10, 10, readRegion=None)
+
+    def testMetrics(self):
+        array = numpy.random.randint(0, 1000, (300, 200)).astype(numpy.uint16)
+        path = self._writeImage(array, 'metrics.tiff', tiffinfo={278: 16})
+        for fileFormat in formats.FORMATS:
+            outputPath, tilesPath = histogram.start_processing(
+                path, False, 50, False, workers=2, fileFormat=fileFormat,
+                tiles=True)
+            result = formats.read(outputPath)
+            with open(outputPath, 'rb') as handle:
+                header = formats.readHeader(handle)
+            os.unlink(outputPath)
+            os.unlink(tilesPath)
+            taskMetrics = result['metrics']
+            self.assertEqual(header['metrics'], taskMetrics)
+            if fileFormat == 'binary':
+                self.assertNotIn('hist', header)
+            for phase in ('histogram', 'tiles', 'read', 'count', 'serialize'):
+                self.assertGreaterEqual(taskMetrics['phases'][phase], 0)
+            self.assertEqual(taskMetrics['counters']['sourceBytes'],
+                             os.path.getsize(path))
+            # The tile pass reads the image a second time.
+            self.assertEqual(taskMetrics['counters']['pixelsRead'],
+                             2 * array.size)
+            self.assertGreater(taskMetrics['counters']['processPeakRss'], 0)
+            self.assertGreaterEqual(
+                taskMetrics['counters']['peakRssIncrease'], 0)
+            self.assertLessEqual(taskMetrics['counters']['peakRssIncrease'],
+                                 taskMetrics['counters']['processPeakRss'])
+            self.assertNotIn('finished', taskMetrics)
+            self.assertEqual(result['hist'].sum(), array.size)
+
+    def _assertChannelsEqual(self, result, array, label, bins):
+        self.assertEqual(list(result), list(histogram.CHANNELS[
+            :array.shape[2]]))
+        for channel, name in enumerate(result):
+            hist, binEdges = histogram.computeArrayHistogram(
+                numpy.ascontiguousarray(array[:, :, channel]), label, bins,
+                False)
+            self.assertEqual(result[name][0].tolist(), hist.tolist())
+            self.assertEqual(result[name][1].tolist(), binEdges.tolist())
+
+    def testChannels(self):
+        for mode, channels in (('RGB', 3), ('RGBA', 4)):
+            array = numpy.random.randint(
+                0, 256, (120, 70, channels)).astype(numpy.uint8)
+            array[:10] = 0
+            path = self._writeImage(array, '%s.tiff' % mode,
+                                    tiffinfo={278: 16})
+            for streaming, mapped in ((False, False), (True, False),
+                                      (False, True)):
+                for label in (False, True):
+                    result = self._computeHistogram(
+                        path, label, 256, False, streaming, mapped,
+                        workers=3)
+                    self._assertChannelsEqual(result, array, label, 256)
+        array = numpy.random.rand(50, 40, 3).astype(numpy.float32)
+        array[0] = 0
+        for label in (False, True):
+            for bins in (1, 10, 256):
+                result = histogram.computeArrayHistogram(
+                    array, label, bins, False)
+                self._assertChannelsEqual(result, array, label, bins)
+        with self.assertRaises(ValueError):
+            histogram.computeArrayHistogram(array, False, 10, True)
+
+        path = self._writeImage(array[:, :, :3].astype(numpy.uint8) + 1,
+                                'rgb.png')
+        outputPath = histogram.start_processing(path, False, 256, False,
+                                                fileFormat='json')
+        result = formats.read(outputPath)
+        os.unlink(outputPath)
+        self.assertEqual(sorted(result['channels']), ['blue', 'green', 'red'])
+        self.assertEqual(result['channels']['red']['hist'].tolist(), [2000])
+        merged = operations.merge([result, result])
+        self.assertEqual(merged['channels']['blue']['hist'].tolist(), [4000])
+
+    def testFormats(self):
+        array = numpy.random.randint(0, 1000, (30, 17)).astype(numpy.uint16)
+        path = self._writeImage(array)
+        for fileFormat in formats.FORMATS:
+            outputPath = histogram.start_processing(
+                path, False, 64, False, fileFormat=fileFormat)
+            self.assertTrue(outputPath.endswith(
+                formats.EXTENSIONS[fileFormat]))
+            result = formats.read(outputPath)
+            os.unlink(outputPath)
+            hist, binEdges = numpy.histogram(array, bins=64)
+            self.assertEqual(result['bins'], 64)
+            self.assertFalse(result['label'])
+            self.assertEqual(result['hist'].tolist(), hist.tolist())
+            self.assertEqual(result['hist'].dtype.kind, 'i')
+            self.assertEqual(result['binEdges'].tolist(), binEdges.tolist())
+        big = 2 ** 53 + 1
+        data = formats.dumps({'a': numpy.arange(6).reshape(2, 3), 'b': [
+            {'c': numpy.ones(3)}], 'd': numpy.array([big], dtype='>i8'),
+            'e': numpy.array([3], dtype=numpy.uint8),
+            'f': numpy.array([0.5, 1.5], dtype=numpy.float32)}, 'binary')
+        self.assertEqual(data[:4], b'HIST')
+        result = formats.loads(data)
+        self.assertEqual(result['a'].tolist(), [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(result['a'].dtype, numpy.int64)
+        self.assertEqual(result['b'][0]['c'].tolist(), [1, 1, 1])
+        self.assertEqual(result['d'].tolist(), [big])
+        self.assertEqual(result['e'].dtype, numpy.uint8)
+        self.assertEqual(result['f'].tolist(), [0.5, 1.5])
+        self.assertEqual(result['f'].dtype, numpy.float32)
+        self.assertLess(len(formats.dumps({
+            'hist': numpy.arange(65536, dtype=numpy.uint32)}, 'binary')),
+            65536 * 4 + 256)
+
+    def testMerge(self):
+        first = numpy.random.randint(0, 100, 1000).astype(numpy.uint8)
+        second = numpy.random.randint(50, 200, 1000).astype(numpy.uint8)
+        histograms = []
+        for array in (first, second):
+            path = self._writeImage(array.reshape(40, 25), '%d.tiff' % len(
+                histograms))
+            hist, binEdges = histogram.computeHistogram(path, False, 256,
+                                                        False)
+            histograms.append({'label': False, 'bitmask': False,
+                               'bins': 256, 'hist': hist,
+                               'binEdges': binEdges})
+        merged = operations.merge(histograms)
+        hist, binEdges = histogram.computeArrayHistogram(
+            numpy.concatenate((first, second)), False, 256, False)
+        self.assertEqual(merged['hist'].tolist(), hist.tolist())
+        self.assertEqual(merged['binEdges'].tolist(), binEdges.tolist())
+        merged = operations.merge(histograms[:1] * 3)
+        self.assertEqual(merged['hist'].tolist(),
+                         (histograms[0]['hist'] * 3).tolist())
+
+        floats = [{'label': False, 'bitmask': False, 'bins': 4,
+                   'hist': numpy.array([1, 2, 3, 4]),
+                   'binEdges': numpy.linspace(0, 1, 5)},
+                  {'label': False, 'bitmask': False, 'bins': 2,
+                   'hist': numpy.array([2, 2]),
+                   'binEdges': numpy.array([1, 1.5, 2])}]
+        merged = operations.merge(floats)
+        self.assertEqual(merged['binEdges'].tolist(),
+                         numpy.linspace(0, 2, 5).tolist())
+        self.assertEqual(merged['hist'].tolist(), [3, 7, 2, 2])
+        self.assertEqual(operations.rebin(
+            [1, 2, 3, 4], numpy.linspace(0, 1, 5), [0, 0.125, 1]).tolist(),
+            [0.5, 9.5])
+
+    def testQuantiles(self):
+        array = numpy.random.randint(0, 1000, (200, 100)).astype(numpy.uint16)
+        path = self._writeImage(array)
+        outputPath = histogram.start_processing(path, False, 1000, False)
+        result = formats.read(outputPath)
+        os.unlink(outputPath)
+        self.assertEqual(result['cumulative'].tolist(),
+                         numpy.cumsum(result['hist']).tolist())
+        q = [0, 0.02, 0.5, 0.98, 1]
+        values = operations.quantiles(
+            result['hist'], result['binEdges'], q, result['cumulative'])
+        self.assertEqual(values, operations.quantiles(
+            result['hist'], result['binEdges'], q))
+        self.assertEqual(values[0], array.min())
+        self.assertEqual(values[-1], array.max())
+        for value, expected in zip(values, numpy.quantile(array, q)):
+            self.assertLess(abs(value - expected), 2)
+        self.assertEqual(operations.quantiles(
+            [0, 4, 0], [0, 1, 2, 3], [0, 0.25, 1]), [1, 1.25, 2])
+        self.assertEqual(operations.quantiles([0], [0, 1], [0.5]), [None])
+
+    def _histogramFile(self, path, label, bins, bitmask=False):
+        outputPath = histogram.start_processing(path, label, bins, bitmask)
+        result = formats.read(outputPath)
+        os.unlink(outputPath)
+        return result
+
+    def testDerive(self):
+        array = numpy.random.randint(0, 4000, (300, 170)).astype(numpy.uint16)
+        path = self._writeImage(array)
+        for label in (False, True):
+            fine = self._histogramFile(path, label, 5000)
+            self.assertEqual(fine['dtype'], 'uint16')
+            self.assertIn('metrics', fine)
+            for bins in (1, 7, 256, 4000):
+                derived = operations.derive(fine, bins)
+                expected = self._histogramFile(path, label, bins)
+                self.assertEqual(derived['bins'], bins)
+                self.assertNotIn('metrics', derived)
+                for key in ('hist', 'binEdges', 'cumulative'):
+                    self.assertEqual(derived[key].tolist(),
+                                     expected[key].tolist())
+            self.assertIsNone(operations.derive(
+                self._histogramFile(path, label, 100), 10))
+        path = self._writeImage((array % 256).astype(numpy.uint8), 'u8.tiff')
+        fine = self._histogramFile(path, False, 256)
+        self.assertEqual(operations.derive(fine, 10)['hist'].tolist(),
+                         fine['hist'].tolist())
+        self.assertNotIn('metrics', operations.derive(fine, 10))
+        path = self._writeImage(array.astype(numpy.float32), 'f.tiff')
+        self.assertIsNone(operations.derive(
+            self._histogramFile(path, False, 5000), 10))
+
+    def testRebin(self):
+        array = numpy.random.randint(0, 4000, (300, 170)).astype(numpy.uint16)
+        path = self._writeImage(array)
+        fine = self._histogramFile(path, False, 5000)
+        rebinned = operations.rebinHistogram(fine, 10, 1000, 2000)
+        hist, binEdges = numpy.histogram(array, bins=10, range=(1000, 2000))
+        self.assertEqual(rebinned['hist'].tolist(), hist.tolist())
+        self.assertEqual(rebinned['binEdges'].tolist(), binEdges.tolist())
+        u8 = (array % 256).astype(numpy.uint8)
+        path = self._writeImage(u8, 'u8.tiff')
+        rebinned = operations.rebinHistogram(
+            self._histogramFile(path, False, 256), 4)
+        self.assertEqual(rebinned['hist'].tolist(),
+                         numpy.histogram(u8, bins=4)[0].tolist())
+        floats = {'label': False, 'bitmask': False, 'bins': 2,
+                  'hist': numpy.array([2, 4]),
+                  'binEdges': numpy.array([0, 1, 2])}
+        rebinned = operations.rebinHistogram(floats, 4)
+        self.assertEqual(rebinned['hist'].tolist(), [1, 1, 2, 2])
+        self.assertEqual(rebinned['cumulative'].tolist(), [1, 2, 4, 6])
+        with self.assertRaises(ValueError):
+            operations.rebinHistogram(floats, 4, 2, 1)
+
+    def testSourceCache(self):
+        downloads = []
+
+        def download(fileId, path):
+            downloads.append(fileId)
+            with open(path, 'wb') as outfile:
+                outfile.write(b'x' * 100)
+
+        sourceCache = cache.SourceCache(
+            os.path.join(self.tempdir, 'cache'), 250)
+        path = sourceCache.fetch('a', '2020-01-01 00:00:00', '.tiff', download)
+        self.assertTrue(path.endswith('.tiff'))
+        self.assertEqual(sourceCache.fetch(
+            'a', '2020-01-01 00:00:00', '.tiff', download), path)
+        self.assertEqual(downloads, ['a'])
+        self.assertNotEqual(sourceCache.fetch(
+            'a', '2020-01-02 00:00:00', '.tiff', download), path)
+        self.assertEqual(downloads, ['a', 'a'])
+        # Mark the first file as used long ago so that it can be evicted
+        os.utime(path, (0, os.stat(path).st_mtime))
+        sourceCache.fetch('b', None, '', download)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(os.listdir(sourceCache.directory)), 2)
+
+    def testDecodedCache(self):
+        array = numpy.random.randint(0, 1000, (300, 170)).astype(numpy.uint16)
+        path = self._writeImage(array, compression='tiff_lzw')
+        decoded = cache.DecodedCache(array.nbytes)
+        key = decoded.key(path, None)
+        self.assertIsNone(decoded.get(key))
+        chunks = decoded.record(key, histogram._imageChunks(path))
+        hist = histogram._chunksHistogram(chunks, False, 64, False, 3)
+        cachedChunks = decoded.get(key)
+        self.assertIsNotNone(cachedChunks)
+        self.assertEqual(numpy.concatenate(list(cachedChunks())).tolist(),
+                         array.tolist())
+        for workers in (1, 2, 5):
+            cachedHist = histogram._chunksHistogram(
+                cachedChunks, False, 64, False, workers)
+            self.assertEqual(cachedHist[0].tolist(), hist[0].tolist())
+        small = cache.DecodedCache(array.nbytes - 1)
+        chunks = small.record(key, histogram._imageChunks(path))
+        histogram._chunksHistogram(chunks, False, 64, False)
+        self.assertIsNone(small.get(key))
+        # The default size is bounded and not disabled
+        self.assertGreater(cache._defaultDecodedCacheSize(), 0)
+        self.assertLessEqual(cache._defaultDecodedCacheSize(),
+                             cache.DECODED_CACHE_DEFAULT)
+
+    def testBatchErrors(self):
+        array = numpy.random.randint(0, 256, (40, 30)).astype(numpy.uint8)
+        path = self._writeImage(array)
+        corrupt = os.path.join(self.tempdir, 'corrupt.png')
+        with open(corrupt, 'wb') as outfile:
+            outfile.write(b'not an image')
+        # histogramBatch is a bound task; it doesn't use the task when there
+        # is no job manager.
+        outputPaths = histogram.histogramBatch(
+            None, [path, corrupt, path], False, 16, False)
+        results = [formats.read(outputPath) for outputPath in outputPaths]
+        for outputPath in outputPaths:
+            os.unlink(outputPath)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['hist'].sum(), array.size)
+        self.assertIn('error', results[1])
+        self.assertNotIn('hist', results[1])
+        self.assertEqual(results[2]['hist'].tolist(),
+                         results[0]['hist'].tolist())
+
+    def testVariants(self):
+        variants = [{'bins': 256}, {'bins': 10, 'label': True},
+                    {'bitmask': True}, {'bitmask': True, 'label': True}]
+        for dtype, high in ((numpy.uint8, 256), (numpy.uint16, 1 << 16),
+                            (numpy.int16, 1 << 15), (numpy.float32, 1)):
+            array = (numpy.random.rand(100, 60) * high).astype(dtype)
+            array[:5] = 0
+            if dtype == numpy.int16:
+                array[5:10] *= -1
+            chunks = histogram._arrayChunks(array)
+            if dtype == numpy.float32:
+                variants = variants[:2]
+            results = histogram._chunksHistograms(chunks, variants, workers=2)
+            self.assertEqual(len(results), len(variants))
+            for variant, (hist, binEdges) in zip(variants, results):
+                expected = histogram._chunksHistogram(
+                    chunks, variant.get('label', False), variant.get('bins'),
+                    variant.get('bitmask', False))
+                self.assertEqual(hist.tolist(), expected[0].tolist())
+                self.assertEqual(binEdges.tolist(), expected[1].tolist())
+
+        array = numpy.random.randint(0, 256, (40, 30, 3)).astype(numpy.uint8)
+        path = self._writeImage(array, 'rgb.png')
+        outputPaths = histogram.start_processing_variants(
+            path, [{'bins': 256}, {'bins': 16, 'label': True}])
+        results = [formats.read(outputPath) for outputPath in outputPaths]
+        for outputPath in outputPaths:
+            os.unlink(outputPath)
+        self.assertFalse(results[0]['label'])
+        self.assertTrue(results[1]['label'])
+        for result, label in zip(results, (False, True)):
+            self._assertChannelsEqual({
+                name: (channel['hist'], channel['binEdges'])
+                for name, channel in result['channels'].items()},
+                array, label, 256)
+
+        # Variants without bins use the default number of bins
+        array = (numpy.random.rand(50, 40) * 4096).astype(numpy.uint16)
+        path = self._writeImage(array, 'gray16.tiff')
+        outputPaths = histogram.start_processing_variants(
+            path, [{'bins': 4}, {'label': True}, {'bitmask': True}])
+        results = [formats.read(outputPath) for outputPath in outputPaths]
+        for outputPath in outputPaths:
+            os.unlink(outputPath)
+        self.assertEqual([result['bins'] for result in results],
+                         [4, histogram.DEFAULT_BINS, histogram.DEFAULT_BINS])
+        self.assertEqual(len(results[1]['hist']), histogram.DEFAULT_BINS)
+        chunks = histogram._arrayChunks(array.astype(numpy.float32))
+        hist, _ = histogram._chunksHistograms(chunks, [{'label': True}])[0]
+        self.assertEqual(len(hist), histogram.DEFAULT_BINS)
+        with self.assertRaisesRegex(ValueError, 'bins'):
+            histogram._chunksHistograms(chunks, [{'bins': 'many'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
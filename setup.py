@@ -5,6 +5,7 @@ with open('README.rst') as readme_file:
 
 requirements = [
     'large_image',
+    'numpy',
     'pytiff',
     'girder-worker-utils'
 ]